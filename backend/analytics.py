@@ -0,0 +1,263 @@
+import itertools
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the time-to-diagnosis histogram buckets
+TIME_BUCKETS = (10, 30, 60, 120, 300, 600, 1800, 3600, math.inf)
+
+# Confusion entry of every guess that is not the name of a disease in the model
+OTHER_GUESS = "other"
+
+
+class DiagnosisAnalytics:
+    """
+    Running aggregates of submitted diagnoses. Every submission adds a fixed
+    number of counters (one per test it ordered), so recording is O(1) in the
+    history and reading the stats is O(distinct counters).
+
+    Counters are keyed by tuples:
+
+        ("submissions",), ("correct",)
+        ("disease", kb, disease, "submissions"/"correct")      per-disease accuracy
+        ("confusion", kb, disease, guess)                      what the disease was taken for (a disease name or OTHER_GUESS)
+        ("test_count", n, "submissions"/"correct")             accuracy by number of tests ordered
+        ("kind", kind, "submissions"/"correct")                by kinds ordered: none/binary/findings/both
+        ("test", kb, test, "submissions"/"correct")            accuracy of cases that ordered the test
+        ("time", "count"/"sum"), ("time_bucket", bound)        seconds from new case to diagnosis
+
+    Increments go to one of shards in-memory dicts (assigned per thread), each
+    with its own lock, so request threads rarely contend. Every flush_interval
+    seconds a background thread moves the pending increments into the totals
+    and, with a database path, adds them to a SQLite table and reads the table
+    back, so several worker processes sharing the file see each other's counts.
+
+    Params:
+        path (str): SQLite database file (optional; aggregates are kept in memory only if None)
+        shards (int): number of pending-increment shards
+        flush_interval (float): seconds between flushes
+    """
+
+    def __init__(self, path=None, shards=16, flush_interval=5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._shards = [[{}, threading.Lock()] for _ in range(shards)]
+        self._next_shard = itertools.count()
+        self._local = threading.local()
+        self._totals = {}
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+
+        if path:
+            self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            with self._db:
+                self._db.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value NUMERIC NOT NULL)")
+            self._totals = self._read()
+        self._flusher = threading.Thread(target=self._flush_loop, name="diagnosis-analytics", daemon=True)
+        self._flusher.start()
+
+
+    def diagnosis_submitted(self, kb, disease, guess, correct, tests, seconds=None, known=()):
+        """
+        Records one submitted diagnosis. Callers record each case at most once.
+
+        Params:
+            kb (str): knowledge base of the case
+            disease (str): disease of the case
+            guess (str): submitted diagnosis (lower case)
+            correct (bool)
+            tests (dict): test name => True for multi-finding tests, False for binary ones
+            seconds (float): time from new case to this submission (optional)
+            known (collection): lower-case disease names of the model; any other
+                guess is counted as OTHER_GUESS, so free text cannot add counters
+        """
+        c = int(correct)
+        binary = not all(tests.values())
+        findings = any(tests.values())
+        kind = "both" if binary and findings else "findings" if findings else "binary" if tests else "none"
+        increments = [
+            (("submissions",), 1), (("correct",), c),
+            (("disease", kb, disease, "submissions"), 1), (("disease", kb, disease, "correct"), c),
+            (("confusion", kb, disease, guess if guess in known else OTHER_GUESS), 1),
+            (("test_count", len(tests), "submissions"), 1), (("test_count", len(tests), "correct"), c),
+            (("kind", kind, "submissions"), 1), (("kind", kind, "correct"), c)
+        ]
+        for test_name in tests:
+            increments.append((("test", kb, test_name, "submissions"), 1))
+            increments.append((("test", kb, test_name, "correct"), c))
+        if seconds is not None:
+            bound = next(b for b in TIME_BUCKETS if seconds <= b)
+            increments += [(("time", "count"), 1), (("time", "sum"), seconds), (("time_bucket", bound), 1)]
+
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = self._shards[next(self._next_shard) % len(self._shards)]
+        with shard[1]:
+            counters = shard[0]
+            for key, amount in increments:
+                counters[key] = counters.get(key, 0) + amount
+
+
+    def counters(self):
+        """
+        Returns every counter: the flushed totals plus increments still pending.
+        """
+        with self._flush_lock:
+            merged = dict(self._totals)
+            for shard in self._shards:
+                with shard[1]:
+                    pending = list(shard[0].items())
+                for key, amount in pending:
+                    merged[key] = merged.get(key, 0) + amount
+        return merged
+
+
+    def stats(self):
+        """
+        Returns the aggregates as nested JSON-ready dicts (see summarize).
+        """
+        return summarize(self.counters())
+
+
+    def flush(self):
+        """
+        Moves pending increments into the totals (and the database) now.
+        """
+        with self._flush_lock:
+            pending = {}
+            for shard in self._shards:
+                with shard[1]:
+                    counters, shard[0] = shard[0], {}
+                for key, amount in counters.items():
+                    pending[key] = pending.get(key, 0) + amount
+
+            if not self.path:
+                for key, amount in pending.items():
+                    self._totals[key] = self._totals.get(key, 0) + amount
+                return
+
+            try:
+                with self._db:
+                    self._db.executemany(
+                        "INSERT INTO counters (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                        [(_encode(key), amount) for key, amount in pending.items()]
+                    )
+            except sqlite3.Error:
+                # Keep the increments for the next flush
+                shard = self._shards[0]
+                with shard[1]:
+                    for key, amount in pending.items():
+                        shard[0][key] = shard[0].get(key, 0) + amount
+                raise
+            self._totals = self._read()
+
+
+    def close(self):
+        """
+        Flushes pending increments and stops the background thread.
+        """
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+        if self.path:
+            self._db.close()
+
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error:
+                logger.exception("Could not flush diagnosis analytics to '%s'", self.path)
+
+
+    def _read(self):
+        """
+        Returns the counters stored in the database.
+        """
+        return {_decode(key): value for key, value in self._db.execute("SELECT key, value FROM counters")}
+
+
+def _encode(key):
+    return json.dumps(key, separators=(",", ":"))
+
+
+def _decode(key):
+    # math.inf is stored as JSON Infinity, which json reads back as float('inf')
+    return tuple(json.loads(key))
+
+
+def summarize(counters):
+    """
+    Builds the aggregates served by /api/stats from raw counters.
+
+    Returns:
+        stats (dict): {"submissions", "correct", "accuracy",
+            "diseases": {kb: {disease: {"submissions", "correct", "accuracy", "guesses": {guess: n}}}},
+            "by_test_count": {n: {"submissions", "correct", "accuracy"}},
+            "by_kind": {kind: {...}}, "by_test": {kb: {test: {...}}},
+            "time_to_diagnosis": {"count", "mean_seconds", "buckets": {"<=bound": n}}}
+    """
+    diseases, by_test_count, by_kind, by_test = {}, {}, {}, {}
+    buckets = {}
+    for key, value in counters.items():
+        kind = key[0]
+        if kind == "disease":
+            diseases.setdefault(key[1], {}).setdefault(key[2], {"guesses": {}})[key[3]] = value
+        elif kind == "confusion":
+            diseases.setdefault(key[1], {}).setdefault(key[2], {"guesses": {}})["guesses"][key[3]] = value
+        elif kind == "test_count":
+            by_test_count.setdefault(str(key[1]), {})[key[2]] = value
+        elif kind == "kind":
+            by_kind.setdefault(key[1], {})[key[2]] = value
+        elif kind == "test":
+            by_test.setdefault(key[1], {}).setdefault(key[2], {})[key[3]] = value
+        elif kind == "time_bucket":
+            buckets[key[1]] = value
+
+    for group in [by_test_count, by_kind] + list(diseases.values()) + list(by_test.values()):
+        for entry in group.values():
+            _add_accuracy(entry)
+
+    time_count = counters.get(("time", "count"), 0)
+    stats = _add_accuracy({"submissions": counters.get(("submissions",), 0), "correct": counters.get(("correct",), 0)})
+    stats.update({
+        "diseases": diseases,
+        "by_test_count": dict(sorted(by_test_count.items(), key=lambda item: int(item[0]))),
+        "by_kind": by_kind,
+        "by_test": by_test,
+        "time_to_diagnosis": {
+            "count": time_count,
+            "mean_seconds": counters.get(("time", "sum"), 0) / time_count if time_count else None,
+            "buckets": {("<=" + format(b, "g") if b != math.inf else "more"): buckets[b] for b in sorted(buckets)}
+        }
+    })
+    return stats
+
+
+def _add_accuracy(entry):
+    entry.setdefault("submissions", 0)
+    entry.setdefault("correct", 0)
+    entry["accuracy"] = entry["correct"] / entry["submissions"] if entry["submissions"] else None
+    return entry
+
+
+def create_analytics(path=None):
+    """
+    Returns DiagnosisAnalytics flushing to path.
+
+    Params:
+        path (str): SQLite database file (optional, defaults to the
+            SYMPLI_ANALYTICS_DB environment variable; aggregates are kept in
+            memory only when neither is set)
+    """
+    return DiagnosisAnalytics(
+        path or os.environ.get("SYMPLI_ANALYTICS_DB"),
+        flush_interval=float(os.environ.get("SYMPLI_ANALYTICS_FLUSH_INTERVAL", 5.0))
+    )
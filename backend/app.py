@@ -5,15 +5,108 @@ import json
 import random
 import os
 import math
+import time
 import uuid
+import numpy as np
 import load_case
-import bayes
+import model
+import posterior
+import sessions
+import reloader
+import recommend
+import metrics
+import journal
+import sensitivity
+import analytics
+import case_pool
+import compact_case
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 app.secret_key = "my_secret_key"
 
-user_cases = {}
+user_cases = sessions.create_store()
+
+# Routes that change a session's case hold its lock from reading the case to
+# storing it again, so concurrent requests of one session do not lose updates
+SESSION_LOCKS = sessions.SessionLocks()
+
+# Event log of session changes (off unless SYMPLI_JOURNAL names a folder); sessions
+# missing from user_cases after a restart are rebuilt from it on first access.
+# Sessions user_cases evicts are dropped from it, so they stay gone
+JOURNAL = journal.create_journal(ttl=user_cases.ttl)
+if JOURNAL:
+    user_cases.on_evict = JOURNAL.expired
+
+# Running aggregates of submitted diagnoses, served on /api/stats (flushed to
+# SQLite when SYMPLI_ANALYTICS_DB names a database file)
+ANALYTICS = analytics.create_analytics()
+
+# Request latency, engine timings and state gauges, served on /metrics
+METRICS = metrics.Registry()
+metrics.instrument_app(app, METRICS)
+ENGINE_LATENCY = METRICS.histogram("sympli_engine_duration_seconds", "Time spent in Bayes engine and case loading functions.", ("function",))
+ENGINE_FUNCTIONS = [
+    (load_case, "load_disease_templates", "load_case.load_disease_templates"),
+    (load_case, "generate_random_case", "load_case.generate_random_case"),
+    (load_case, "generate_cases", "load_case.generate_cases"),
+    (model, "compile_model", "model.compile_model"),
+    (model.CompiledModel, "log_starting_likelihood_array", "model.log_starting_likelihood_array"),
+    (model.CompiledModel, "test_log_likelihood", "model.test_log_likelihood"),
+    (posterior.LogPosterior, "add", "posterior.add"),
+    (posterior.LogPosterior, "add_sparse", "posterior.add_sparse"),
+    (posterior.LogPosterior, "top", "posterior.top"),
+    (posterior.LogPosterior, "probabilities", "posterior.probabilities"),
+    (recommend, "recommend_tests", "recommend.recommend_tests"),
+    (sensitivity, "analyse", "sensitivity.analyse")
+]
+
+
+def enable_engine_timings():
+    """
+    Times the ENGINE_FUNCTIONS on ENGINE_LATENCY. They are wrapped in place for
+    the whole process, so this is done when a server starts serving (see
+    start_server and asgi.lifespan), not on import: tools and tests that import
+    app call them unwrapped. Later calls do nothing.
+    """
+    metrics.instrument_functions(ENGINE_LATENCY, ENGINE_FUNCTIONS)
+
+
+# Number of sessions sampled to estimate session memory
+SESSION_MEMORY_SAMPLE = 32
+
+
+def estimate_session_memory():
+    """
+    Estimates bytes held by all sessions from a sample. Objects every case of a
+    model shares through its layout (vocabularies, disease names) are held once
+    by the model, not per session, and are left out.
+    """
+    sample = user_cases.sample(SESSION_MEMORY_SAMPLE)
+    if not sample:
+        return 0
+    seen = set()
+    for case in sample:
+        metrics.deep_sizeof(case.layout, seen)
+    per_session = sum(metrics.deep_sizeof(case, seen) for case in sample) / len(sample)
+    return int(per_session * len(user_cases))
+
+
+METRICS.gauge("sympli_sessions", "Sessions held in user_cases.", lambda: len(user_cases))
+METRICS.gauge("sympli_session_memory_bytes", "Estimated memory held by sessions.", estimate_session_memory)
+METRICS.gauge("sympli_session_store_events", "Session store hits, misses and evictions since start.",
+              lambda: {(k,): v for k, v in user_cases.stats().items() if k != "entries"}, ("event",))
+METRICS.gauge("sympli_templates", "Disease templates in the current version of each loaded knowledge base.",
+              lambda: {(name,): len(kb.current.model.names) for name, kb in KNOWLEDGE_BASES.resident().items()}, ("knowledge_base",))
+METRICS.gauge("sympli_knowledge_base_versions", "Versions retained for sessions by each loaded knowledge base.",
+              lambda: {(name,): len(kb.versions) for name, kb in KNOWLEDGE_BASES.resident().items()}, ("knowledge_base",))
+METRICS.gauge("sympli_case_pool_cases", "Ready-made cases pooled per knowledge base.",
+              lambda: {(kb,): n for kb, n in CASE_POOL.sizes().items()} if CASE_POOL else {}, ("knowledge_base",))
+METRICS.gauge("sympli_case_pool_events", "New cases served from the pool (hit) or generated on request (miss) since start.",
+              lambda: {("hit",): CASE_POOL.hits, ("miss",): CASE_POOL.misses} if CASE_POOL else {}, ("event",))
+METRICS.gauge("sympli_knowledge_bases_resident", "Knowledge bases currently loaded.", lambda: len(KNOWLEDGE_BASES.resident()))
+METRICS.gauge("sympli_knowledge_base_events", "Knowledge-base loads and evictions since start.",
+              lambda: {("load",): KNOWLEDGE_BASES.loads, ("eviction",): KNOWLEDGE_BASES.evictions}, ("event",))
 
 @app.before_request
 def ensure_session_id():
@@ -24,25 +117,519 @@ def ensure_session_id():
         session['session_id'] = str(uuid.uuid4())
 
 
-DISEASE_TEMPLATES = load_case.load_disease_templates()
+# Named knowledge bases (template folders), selected per case with ?kb=. Each is
+# loaded on first use and reloaded when its files change; each case keeps the
+# knowledge base and ModelVersion it was created with (see reloader.KnowledgeBaseCache).
+# With SYMPLI_SHARED_MODEL set (a segment name prefix), worker processes share
+# one copy of each compiled model in shared memory
+KNOWLEDGE_BASES = reloader.KnowledgeBaseCache(
+    reloader.parse_knowledge_bases(os.environ.get("SYMPLI_KNOWLEDGE_BASES", "digestive=digestive diseases;other=other-diseases")),
+    default=os.environ.get("SYMPLI_DEFAULT_KNOWLEDGE_BASE", "digestive"),
+    max_resident=int(os.environ.get("SYMPLI_MAX_KNOWLEDGE_BASES", 4)),
+    check_interval=float(os.environ.get("SYMPLI_RELOAD_INTERVAL", 2.0)),
+    shared_memory=os.environ.get("SYMPLI_SHARED_MODEL")
+)
+
+MAX_BULK_CASES = 50000
+MAX_RECOMMEND_BUDGET = 65536
+MAX_SENSITIVITY_SAMPLES = 10000
+# Most (sample, disease) probabilities /api/sensitivity keeps for its intervals (samples x top)
+MAX_SENSITIVITY_CELLS = 1 << 22
+
+def parse_active_set_epsilon(value):
+    """
+    Parses SYMPLI_ACTIVE_SET_EPSILON.
+
+    Params:
+        value (str): variable value, or None when not set
+
+    Returns:
+        epsilon (float): None when not set or empty
+
+    Raises:
+        ValueError: if value is not a number strictly between 0 and 1
+    """
+    if not value:
+        return None
+    try:
+        epsilon = float(value)
+    except ValueError:
+        epsilon = None
+    if epsilon is None or not 0 < epsilon < 1:
+        raise ValueError(f"SYMPLI_ACTIVE_SET_EPSILON must be a probability between 0 and 1 (exclusive), got {value!r}")
+    return epsilon
+
+
+# Probability below which a case's diseases are parked, so test orders only
+# update the ones still in the running (off unless SYMPLI_ACTIVE_SET_EPSILON is
+# set; see posterior.LogPosterior). Parked diseases are reported as 0.
+ACTIVE_SET_EPSILON = parse_active_set_epsilon(os.environ.get("SYMPLI_ACTIVE_SET_EPSILON"))
+
+
+@app.before_request
+def start_server():
+    """
+    With the first request served (not on import, so tools importing app are
+    not affected): starts the background thread that picks up changed disease
+    templates and enables the engine timings.
+    """
+    if not KNOWLEDGE_BASES.started:
+        KNOWLEDGE_BASES.start()
+        enable_engine_timings()
+
+
+def current_session_id():
+    """
+    Returns the session_id of a client that sends back its session cookie, or
+    the shared 'test_user' session for a request without one. The frontend's
+    cross-origin fetches never send cookies, so its requests can only share a
+    session. A client that keeps cookies gets its own session from its second
+    request on (ensure_session_id sets the cookie on the first response).
+    """
+    if app.config["SESSION_COOKIE_NAME"] not in request.cookies:
+        return 'test_user'
+    return session['session_id']
+
+
+def requested_knowledge_base():
+    """
+    Returns the name of the knowledge base asked for with ?kb=, or the default.
+    """
+    return request.args.get("kb") or KNOWLEDGE_BASES.default
+
+
+def error(message, status):
+    """
+    Returns an error payload and status code.
+    """
+    return {"error": message}, status
+
+
+def unknown_knowledge_base(name):
+    """
+    Payload and status for a knowledge base that is not configured.
+    """
+    return {"error": f"Unknown knowledge base '{name}'", "knowledge_bases": KNOWLEDGE_BASES.names()}, 404
+
+
+def case_version(case):
+    """
+    Returns the ModelVersion a case was created with, or None if that version is
+    no longer retained.
+    """
+    try:
+        return KNOWLEDGE_BASES.get(case.knowledge_base).get(case.model_version)
+    except KeyError:
+        return None
+
+
+def version_expired():
+    """
+    Payload and status for a case whose knowledge-base version has been dropped.
+    """
+    return error("Case was created with an outdated knowledge base; start a new case", 409)
+
+
+def parse_top(top):
+    """
+    Parses the top query parameter (number of diseases to return probabilities for).
+
+    Params:
+        top (str): parameter value, or None when not given
+
+    Returns:
+        top (int): None when not given
+        error (tuple): (payload, 400) if top is not a positive integer, else None
+    """
+    if top is None:
+        return None, None
+    if not top.isdigit() or int(top) < 1:
+        return None, error("top must be a positive integer", 400)
+    return int(top), None
+
+
+def parse_delta(delta):
+    """
+    Parses the delta query parameter (minimum change in probability to report).
+
+    Params:
+        delta (str): parameter value, or None when not given
+
+    Returns:
+        delta (float): None when not given
+        error (tuple): (payload, 400) if delta is not a number between 0 and 1, else None
+    """
+    if delta is None:
+        return None, None
+    try:
+        delta = float(delta)
+    except ValueError:
+        delta = -1.0
+    if not 0 <= delta <= 1:
+        return None, error("delta must be a number between 0 and 1", 400)
+    return delta, None
+
+
+def probability_fields(post, top=None):
+    """
+    Returns {"probabilities": {name: prob}} for every disease, or with top, the
+    top diseases only plus "other_probability", the mass of the rest.
+    """
+    if top is None:
+        return {"probabilities": post.probabilities()}
+    probs, other = post.top(top)
+    return {"probabilities": probs, "other_probability": other}
+
+
+def visible_case(case, top=None):
+    """
+    Returns the JSON shape of a case shown to the user: everything except the
+    disease name and internal fields, with the log-posterior normalised into
+    "probabilities" (see probability_fields).
+    """
+    demographics, symptoms, vitals = case.fields()
+    visible = {
+        "knowledge_base": case.knowledge_base,
+        "demographics": demographics,
+        "symptoms": symptoms,
+        "vitals": vitals,
+        "tests": dict(case.tests)
+    }
+    visible.update(probability_fields(case.posterior, top))
+    return visible
+
+
+def case_etag(case, top):
+    """
+    Returns an ETag for the visible state of a case. A case only changes by
+    ordering tests, so its id and the number of tests ordered identify its state.
+    """
+    return f"{case.case_id}-{len(case.tests)}-{top or 'all'}"
+
+
+def create_case(version, kb, seed, case_id):
+    """
+    Generates the case for a seed from a knowledge-base version, with its
+    starting posterior. The same seed and version always give the same case.
+
+    Params:
+        version (reloader.ModelVersion)
+        kb (str): knowledge-base name
+        seed (int): random seed
+        case_id (str): case id
+
+    Returns:
+        case (compact_case.CompactCase): case as stored in user_cases
+    """
+    case = load_case.generate_random_case(version.templates, random.Random(seed))
+
+    # Posterior is kept as an unnormalised log vector; probabilities are only built for responses
+    post = posterior.from_model(version.model, ACTIVE_SET_EPSILON)
+    post.add(version.model.log_starting_likelihood_array(case["demographics"], case["symptoms"], case["vitals"]))
+    return compact_case.from_case(case, version.model, post, case_id, kb, version.version)
+
+
+def make_pooled_case(kb):
+    """
+    Generates a case for CASE_POOL from the current version of knowledge base
+    kb. Raises KeyError once kb is no longer loaded, so evicted knowledge bases
+    are not reloaded just to fill their pool; the default one is loaded (in the
+    background, at startup) if needed.
+
+    Returns:
+        seed (int), case (dict): see create_case
+    """
+    if kb != KNOWLEDGE_BASES.default and kb not in KNOWLEDGE_BASES.resident():
+        raise KeyError(kb)
+    version = KNOWLEDGE_BASES.get(kb).current_for_cases()
+    seed = random.getrandbits(63)
+    return seed, create_case(version, kb, seed, uuid.uuid4().hex)
+
+
+# Ready-made cases per knowledge base, kept between SYMPLI_CASE_POOL_LOW and
+# SYMPLI_CASE_POOL_HIGH by a background thread so new_case only pops one
+# (off when SYMPLI_CASE_POOL_HIGH is 0). The thread starts with the first request
+# served, not on import, so tools that import app do not run it
+CASE_POOL = case_pool.create_pool(make_pooled_case)
+
+
+@app.before_request
+def start_case_pool():
+    """
+    Starts filling CASE_POOL, beginning with the default knowledge base, if not
+    started yet.
+    """
+    if CASE_POOL and not CASE_POOL.started:
+        CASE_POOL.watch(KNOWLEDGE_BASES.default)
+        CASE_POOL.start()
+
+
+def compiled_model(kb, version):
+    """
+    Returns the CompiledModel of a knowledge-base version, for cases loaded from
+    a session store that pickles them (see compact_case.set_layout_resolver).
+
+    Raises:
+        LookupError: if the knowledge base is not configured or the version is no longer retained
+    """
+    found = KNOWLEDGE_BASES.get(kb).get(version)
+    if found is None:
+        raise LookupError(f"Version {version} of knowledge base '{kb}' is no longer retained")
+    return found.model
+
+
+compact_case.set_layout_resolver(compiled_model)
+
+
+def get_case(session_id):
+    """
+    Returns the case of a session from user_cases, or rebuilt from the journal
+    (its seed and recorded test results) if it is only there. None if neither
+    has it, or its knowledge-base version is no longer available.
+    """
+    case = user_cases.get(session_id)
+    if case is not None or JOURNAL is None:
+        return case
+
+    entry = JOURNAL.sessions.get(session_id)
+    if entry is None:
+        return None
+    try:
+        version = KNOWLEDGE_BASES.get(entry.kb).get(entry.version)
+    except KeyError:
+        version = None
+    if version is None:
+        return None
+
+    try:
+        case = create_case(version, entry.kb, entry.seed, entry.case_id)
+    except reloader.StaleVersionError:
+        return None
+    case.created_at = entry.created_at
+    case.diagnosed = entry.diagnosed
+    for test_name, result in entry.tests:
+        case.add_test(test_name, result)
+        case.posterior.add_sparse(*version.model.test_log_likelihood(test_name, result))
+    user_cases[session_id] = case
+    return case
+
+
+def reset_session(session_id):
+    """
+    Removes the case of a session from user_cases (and the journal).
+    """
+    user_cases.pop(session_id, None)
+    if JOURNAL:
+        JOURNAL.reset(session_id)
+
+
+# The operations behind the case routes, shared by the Flask routes below and
+# the ASGI app in asgi.py. They take parsed arguments and return (payload,
+# status); reading and writing user_cases is left to the caller.
+
+def start_case(session_id, kb, top=None):
+    """
+    Generates a new case from the current version of knowledge base kb, or
+    takes a ready-made one from CASE_POOL.
+
+    Returns:
+        case (dict): the new case to store for session_id, or None on error
+        payload (dict), status (int): response
+    """
+    try:
+        version = KNOWLEDGE_BASES.get(kb).current_for_cases()
+    except KeyError:
+        return None, *unknown_knowledge_base(kb)
+    pooled = CASE_POOL.take(kb, version.version) if CASE_POOL else None
+    if pooled:
+        seed, case = pooled
+    else:
+        seed = random.getrandbits(63)
+        case = create_case(version, kb, seed, uuid.uuid4().hex)
+    case.created_at = time.time()
+    if JOURNAL:
+        JOURNAL.case_created(session_id, kb, version.version, seed, case.case_id, case.created_at)
+    return case, visible_case(case, top), 200
+
+
+def order_test_on(case, session_id, test_name, top=None, delta=None):
+    """
+    Orders one test for a case, see the order_test route. The case is updated
+    in place when the status is 200 and must then be stored again.
+
+    Returns:
+        payload (dict), status (int): response
+    """
+    if not test_name:
+        return error("No test specified", 400)
+
+    if test_name in case.tests:
+        return error("Test already ordered.", 400)
+
+    version = case_version(case)
+    if not version:
+        return version_expired()
+
+    test_data = version.model.diagnostic_tests(case.name).get(test_name)
+    if not test_data:
+        return error(f"Test '{test_name}' not available", 404)
+
+    result = load_case.sample_test_result(test_data)
+    case.add_test(test_name, result)
+
+    before = case.posterior.probability_array() if delta is not None else None
+    base, rows, values = version.model.test_log_likelihood(test_name, result)
+    case.posterior.add_sparse(base, rows, values, version.model.test_log_likelihood_max(test_name, result))
+    if JOURNAL:
+        JOURNAL.test_ordered(session_id, test_name, result)
+
+    response = {
+        "test_name": test_name,
+        "result": result
+    }
+    if delta is not None:
+        response["changes"] = posterior.changes(case.posterior.names, before, case.posterior.probability_array(), delta)
+    if top is not None:
+        response.update(probability_fields(case.posterior, top))
+    return response, 200
+
+
+def order_tests_on(case, session_id, test_names, top=None, delta=None):
+    """
+    Orders a panel of tests for a case with a single posterior update, see the
+    order_tests route. The case is updated in place when the status is 200 and
+    must then be stored again.
+
+    Returns:
+        payload (dict), status (int): response
+    """
+    if not test_names or not isinstance(test_names, list) or not all(isinstance(t, str) for t in test_names):
+        return error("No tests specified", 400)
+
+    if len(set(test_names)) != len(test_names):
+        return error("Test listed more than once.", 400)
+
+    ordered = [t for t in test_names if t in case.tests]
+    if ordered:
+        return error(f"Test already ordered: {', '.join(ordered)}.", 400)
+
+    version = case_version(case)
+    if not version:
+        return version_expired()
+
+    all_test_data = version.model.diagnostic_tests(case.name)
+    missing = [t for t in test_names if not all_test_data.get(t)]
+    if missing:
+        return error(f"Test '{missing[0]}' not available", 404)
+
+    # Sum of log likelihoods = product of the likelihood vectors, summed over
+    # the diseases each test lists
+    results = []
+    base, all_rows, all_values = 0.0, [], []
+    for test_name in test_names:
+        result = load_case.sample_test_result(all_test_data[test_name])
+        case.add_test(test_name, result)
+        test_base, rows, values = version.model.test_log_likelihood(test_name, result)
+        base += test_base
+        all_rows.append(rows)
+        all_values.append(values)
+        results.append({"test_name": test_name, "result": result})
+
+    before = case.posterior.probability_array() if delta is not None else None
+    rows, inverse = np.unique(np.concatenate(all_rows), return_inverse=True)
+    case.posterior.add_sparse(base, rows, np.bincount(inverse, np.concatenate(all_values), minlength=len(rows)))
+    if JOURNAL:
+        for r in results:
+            JOURNAL.test_ordered(session_id, r["test_name"], r["result"])
+
+    response = {"results": results}
+    if delta is not None:
+        response["changes"] = posterior.changes(case.posterior.names, before, case.posterior.probability_array(), delta)
+    if delta is None or top is not None:
+        response.update(probability_fields(case.posterior, top))
+    return response, 200
+
+
+def diagnose(case, session_id, guess):
+    """
+    Compares a guess against the disease of a case, see the submit_diagnosis route.
+    Only the first diagnosis of a case is counted in ANALYTICS; the caller stores
+    the case back when status is 200, as it is then marked diagnosed.
+
+    Returns:
+        payload (dict), status (int): response
+    """
+    guess = guess.lower()
+    actual = case.name.lower()
+
+    correct = guess == actual
+    if JOURNAL:
+        JOURNAL.diagnosis_submitted(session_id, guess, correct)
+    if not case.diagnosed:
+        case.diagnosed = True
+        # Multi-finding tests are the ones with a list of findings as result
+        tests = {test_name: isinstance(result, list) for test_name, result in case.tests.items()}
+        created = case.created_at
+        ANALYTICS.diagnosis_submitted(case.knowledge_base, case.name, guess, correct, tests,
+                                      time.time() - created if created is not None else None,
+                                      case.layout.lower_names)
+    feedback = "Correct!" if correct else f"Incorrect. The correct answer was '{actual.title()}'."
+
+    return {
+        "correct": correct,
+        "submitted": guess,
+        "feedback": feedback
+    }, 200
+
 
 @app.route('/api/new_case', methods=['GET'])
 def new_case():
     """
-    Generates a new case from DISEASE_TEMPLATES and saves it into user_cases with
-    key session_id.
+    Generates a new case from the current version of the knowledge base named by
+    kb (query parameter, default KNOWLEDGE_BASES.default) and saves it into
+    user_cases with key session_id. Returns 404 error if kb is not configured.
+    The case is taken from CASE_POOL when it has one ready.
+
+    With top (query parameter), returns probabilities for the top diseases only (see probability_fields).
+    """
+    session_id = current_session_id()
+    top, failed = parse_top(request.args.get("top"))
+    if failed:
+        return jsonify(failed[0]), failed[1]
+    with SESSION_LOCKS.hold(session_id):
+        case, payload, status = start_case(session_id, requested_knowledge_base(), top)
+        if case is not None:
+            user_cases[session_id] = case
+    return jsonify(payload), status
+
+
+@app.route('/api/new_cases', methods=['GET'])
+def new_cases():
     """
-    # session_id = session.get('session_id', 'test_user')  # fallback ID
-    session_id = 'test_user'
-    new_case = load_case.generate_random_case(DISEASE_TEMPLATES)
-    user_cases[session_id] = new_case
-    case = user_cases[session_id]
+    Generates a batch of n cases (query parameter, default 1) from the current
+    version of knowledge base kb (as in new_case) without attaching them to the session. Disease names
+    are hidden unless labels=true is passed. The normalised priors are the same
+    for every case, so they are sent once rather than with each case.
+    Returns 400 error if n is not an integer between 1 and MAX_BULK_CASES, 404 if kb is not configured.
 
-    case["probabilities"] = bayes.update(case["probabilities"], bayes.comp_starting_likelihoods(DISEASE_TEMPLATES, case["demographics"], case["symptoms"], case["vitals"]))
+    Returns JSON of {"probabilities": {disease: prior}, "cases": [case, ...]}
+    """
+    n = request.args.get("n", "1")
+    if not n.isdigit() or not 1 <= int(n) <= MAX_BULK_CASES:
+        return jsonify({"error": f"n must be an integer between 1 and {MAX_BULK_CASES}"}), 400
+    labels = request.args.get("labels", "false").lower() == "true"
 
-    visible = {k: v for k, v in new_case.items() if k != "name"}
+    kb = requested_knowledge_base()
+    try:
+        version = KNOWLEDGE_BASES.get(kb).current_for_cases()
+    except KeyError:
+        payload, status = unknown_knowledge_base(kb)
+        return jsonify(payload), status
+    cases = load_case.generate_cases(version.templates, int(n), sampler=version.sampler)
+    dropped = ("probabilities",) if labels else ("probabilities", "name")
+    cases = [{k: v for k, v in case.items() if k not in dropped} for case in cases]
 
-    return jsonify(visible)
+    return jsonify({"probabilities": version.sampler.probabilities, "cases": cases})
 
 
 @app.route('/api/current_case', methods=['GET'])
@@ -50,71 +637,176 @@ def get_current_case():
     """
     Gets current session_id and uses it to get current case, which is displayed without disease name.
     Returns 404 error if the case does not exist.
+
+    With top (query parameter), returns probabilities for the top diseases only (see probability_fields).
+    The response carries an ETag; a request whose If-None-Match matches it gets
+    an empty 304 response without the case being serialised.
     """
-    session_id = 'test_user'
-    # session_id = session.get('session_id', 'test_user')  # fallback ID
-    case = user_cases.get(session_id)
+    session_id = current_session_id()
+    top, failed = parse_top(request.args.get("top"))
+    if failed:
+        return jsonify(failed[0]), failed[1]
+    case = get_case(session_id)
     if not case:
         return jsonify({"error": "No case generated yet"}), 404
 
-    visible = {k: v for k, v in case.items() if k != "name"}
-    return jsonify(visible)
+    etag = case_etag(case, top)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(visible_case(case, top))
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 
 @app.route('/api/order_test', methods=['POST'])
 def order_test():
     """
     Gets current session_id and uses it to get current case and disease name.
-    Returns 400 error if the case does not exist.
+    Returns 400 error if the case does not exist, 409 if its knowledge-base version was dropped.
 
     Takes test name from request and returns 400 error if "test" does not exist.
 
-    Pulls test_data from DISEASE_TEMPLATES and returns 404 error if "test_name" does not exist for the disease.
+    Pulls test_data from the compiled model's template index and returns 404 error if "test_name" does not exist for the disease.
 
     Randomly generates test result ("positive" or "negative") based on sensitivity.
 
-    Returns JSON of {"test_name": test_name, "result": ("positive" or "negative")}
+    Returns JSON of {"test_name": test_name, "result": ("positive" or "negative")}. With delta
+    (query parameter) also returns "changes": {name: prob} for the diseases whose probability
+    moved by more than delta, and with top the top diseases' probabilities (see probability_fields).
     """
-    session_id = 'test_user'  # Use same session ID as new_case
-    case = user_cases.get(session_id)
-    if not case:
-        return jsonify({"error": "No case generated"}), 400
+    session_id = current_session_id()
+    top, failed = parse_top(request.args.get("top"))
+    if not failed:
+        delta, failed = parse_delta(request.args.get("delta"))
+    if failed:
+        return jsonify(failed[0]), failed[1]
+    with SESSION_LOCKS.hold(session_id):
+        case = get_case(session_id)
+        if not case:
+            return jsonify({"error": "No case generated"}), 400
+        data = request.get_json()
+        payload, status = order_test_on(case, session_id, data.get("test"), top, delta)
+        if status == 200:
+            user_cases[session_id] = case
+    return jsonify(payload), status
+
+
+@app.route('/api/order_tests', methods=['POST'])
+def order_tests():
+    """
+    Orders a panel of tests at once. Gets current session_id and uses it to get current case and disease name.
+    Returns 400 error if the case does not exist, 409 if its knowledge-base version was dropped.
 
-    data = request.get_json()
-    test_name = data.get("test")
-    if not test_name:
-        return jsonify({"error": "No test specified"}), 400
+    Takes list of test names from request ("tests") and returns 400 error if it is empty, repeats a
+    test or includes a test already ordered, and 404 error if a test does not exist for the disease.
+    Nothing is ordered unless every test is valid.
 
-    if test_name in case["tests"]:
-        return jsonify({"error": "Test already ordered."}), 400
+    Randomly generates every result like order_test, multiplies their likelihood vectors
+    together and applies a single posterior update.
 
-    test_data = None
-    hidden_disease = case["name"]
-    for d in DISEASE_TEMPLATES:
-        if d["name"].lower() == hidden_disease.lower():
-            test_data = d["diagnostic_tests"][test_name]
+    Returns JSON of {"results": [{"test_name", "result"}, ...], "probabilities": {name: prob}}.
+    With top (query parameter), returns probabilities for the top diseases only (see probability_fields);
+    with delta, returns "changes" as order_test does instead of "probabilities".
+    """
+    session_id = current_session_id()
+    top, failed = parse_top(request.args.get("top"))
+    if not failed:
+        delta, failed = parse_delta(request.args.get("delta"))
+    if failed:
+        return jsonify(failed[0]), failed[1]
+    with SESSION_LOCKS.hold(session_id):
+        case = get_case(session_id)
+        if not case:
+            return jsonify({"error": "No case generated"}), 400
+        data = request.get_json()
+        payload, status = order_tests_on(case, session_id, data.get("tests"), top, delta)
+        if status == 200:
+            user_cases[session_id] = case
+    return jsonify(payload), status
+
+
+@app.route('/api/recommend_tests', methods=['GET'])
+def recommend_tests():
+    """
+    Gets current session_id and uses it to get current case.
+    Returns 400 error if the case does not exist, 409 if its knowledge-base version was dropped.
 
-    if not test_data:
-        return jsonify({"error": f"Test '{test_name}' not available"}), 404
+    Ranks every test not yet ordered by the expected reduction in entropy of the
+    case's posterior. Multi-finding tests with more finding sets than budget
+    (query parameter, default recommend.DEFAULT_BUDGET) are estimated by sampling.
 
-    if test_data["Binary"]:
-        result = "positive" if random.random() < test_data["sensitivity"] else "negative"
-    else:
-        result = []
-        for finding in test_data:
-            if finding != "Binary":
-                if random.random() < test_data[finding]["sensitivity"]:
-                    result.append(finding)
-    case["tests"][test_name] = result
+    Returns JSON of {"entropy": bits, "recommendations": [{"test", "expected_information_gain"}, ...]}
+    """
+    session_id = current_session_id()
+    case = get_case(session_id)
+    if not case:
+        return jsonify({"error": "No case generated"}), 400
+
+    version = case_version(case)
+    if not version:
+        payload, status = version_expired()
+        return jsonify(payload), status
 
-    case["probabilities"] = bayes.update(case["probabilities"], bayes.comp_test_likelihood(DISEASE_TEMPLATES, test_name, result))
+    budget = request.args.get("budget", str(recommend.DEFAULT_BUDGET))
+    if not budget.isdigit() or not 1 <= int(budget) <= MAX_RECOMMEND_BUDGET:
+        return jsonify({"error": f"budget must be an integer between 1 and {MAX_RECOMMEND_BUDGET}"}), 400
 
+    probs = case.posterior.probability_array()
     return jsonify({
-        "test_name": test_name,
-        "result": result
+        "entropy": float(recommend.entropy(probs)),
+        "recommendations": recommend.recommend_tests(version.model, probs, case.tests, int(budget))
     })
 
 
+@app.route('/api/sensitivity', methods=['GET'])
+def sensitivity_analysis():
+    """
+    Gets current session_id and uses it to get current case.
+    Returns 400 error if the case does not exist, 409 if its knowledge-base version was dropped.
+
+    Evaluates the case's posterior under samples (query parameter, default
+    sensitivity.DEFAULT_SAMPLES) models whose symptom probabilities, sensitivities
+    and specificities are perturbed with Beta noise of the given concentration
+    (default sensitivity.DEFAULT_CONCENTRATION), see sensitivity.analyse.
+
+    Returns JSON of {"samples", "concentration", "level", "parameters",
+    "diseases": [{"name", "probability", "mean", "lower", "upper", "top_frequency"}]}
+    for the top (default 10) diseases, with level (default 0.95) credible intervals.
+    Returns 400 error if samples x top (top capped at the number of diseases) is
+    over MAX_SENSITIVITY_CELLS.
+    """
+    session_id = current_session_id()
+    case = get_case(session_id)
+    if not case:
+        return jsonify({"error": "No case generated"}), 400
+
+    version = case_version(case)
+    if not version:
+        payload, status = version_expired()
+        return jsonify(payload), status
+
+    samples = request.args.get("samples", str(sensitivity.DEFAULT_SAMPLES))
+    if not samples.isdigit() or not 1 <= int(samples) <= MAX_SENSITIVITY_SAMPLES:
+        return jsonify({"error": f"samples must be an integer between 1 and {MAX_SENSITIVITY_SAMPLES}"}), 400
+    top, failed = parse_top(request.args.get("top", "10"))
+    if failed:
+        return jsonify(failed[0]), failed[1]
+    top = min(top, len(version.model.names))
+    if int(samples) * top > MAX_SENSITIVITY_CELLS:
+        return jsonify({"error": f"samples x top must be at most {MAX_SENSITIVITY_CELLS}"}), 400
+    try:
+        concentration = float(request.args.get("concentration", sensitivity.DEFAULT_CONCENTRATION))
+        level = float(request.args.get("level", sensitivity.DEFAULT_LEVEL))
+    except ValueError:
+        concentration = level = -1.0
+    if not concentration > 0 or not 0 < level < 1:
+        return jsonify({"error": "concentration must be positive and level between 0 and 1"}), 400
+
+    return jsonify(sensitivity.analyse(version.model, case.to_dict(), int(samples), concentration, level, top))
+
+
 @app.route('/submit_diagnosis', methods=['POST'])
 @cross_origin()
 def submit_diagnosis():
@@ -126,33 +818,69 @@ def submit_diagnosis():
 
     Returns JSON of {"correct": T/F, "submitted": user guess, "feedback": Correct/Incorrect + details}
     """
-    session_id = 'test_user'  # Use same session ID as new_case
-    current_case = user_cases.get(session_id)
-    if not current_case:
-        return jsonify({"error": "No case generated"}), 400
+    session_id = current_session_id()
+    with SESSION_LOCKS.hold(session_id):
+        current_case = get_case(session_id)
+        if not current_case:
+            return jsonify({"error": "No case generated"}), 400
+        data = request.get_json()
+        payload, status = diagnose(current_case, session_id, data.get("diagnosis", ""))
+        if status == 200:
+            user_cases[session_id] = current_case
+    return jsonify(payload), status
 
-    data = request.get_json()
-    guess = data.get("diagnosis", "").lower()
-    actual = current_case["name"].lower()
 
-    correct = guess == actual
-    feedback = "Correct!" if correct else f"Incorrect. The correct answer was '{actual.title()}'."
+@app.route('/api/reset')
+def reset_case():
+    """
+    Removes case associated with current session_id from user_cases.
+    """
+    session_id = current_session_id()
+    with SESSION_LOCKS.hold(session_id):
+        reset_session(session_id)
+    return jsonify({"status": "case cleared"})
+
 
+@app.route('/api/stats')
+def diagnosis_stats():
+    """
+    Returns JSON of the running aggregates of submitted diagnoses: overall and
+    per-disease accuracy, what each disease was taken for, accuracy by number and
+    kind of tests ordered and per test, and time to diagnosis (see analytics.summarize).
+    """
+    return jsonify(ANALYTICS.stats())
+
+
+@app.route('/api/knowledge_bases')
+def knowledge_bases():
+    """
+    Returns JSON of {"default": name, "knowledge_bases": [{"name", "resident", "version"}, ...]};
+    version is null for knowledge bases that are not loaded.
+    """
+    resident = KNOWLEDGE_BASES.resident()
     return jsonify({
-        "correct": correct,
-        "submitted": guess,
-        "feedback": feedback
+        "default": KNOWLEDGE_BASES.default,
+        "knowledge_bases": [
+            {"name": name, "resident": name in resident, "version": resident[name].current.version if name in resident else None}
+            for name in KNOWLEDGE_BASES.names()
+        ]
     })
 
 
-@app.route('/api/reset')
-def reset_case():
+@app.route('/metrics')
+def metrics_endpoint():
     """
-    Removes case associated with current session_id from user_cases.
+    Returns request latencies, engine timings and session/template gauges in Prometheus text format.
     """
-    session_id = 'test_user'  # Use same session ID as new_case
-    user_cases.pop(session_id, None)
-    return jsonify({"status": "case cleared"})
+    return METRICS.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+@app.route('/api/session_stats')
+def session_stats():
+    """
+    Returns JSON of the session store counters: {"entries", "hits", "misses", "evictions"}
+    """
+    return jsonify(user_cases.stats())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,438 @@
+"""
+ASGI variant of the case API, for serving many concurrent sessions from one
+event loop. Run it with any ASGI server from the backend folder, e.g.
+
+    uvicorn asgi:app --port 5050
+
+It serves the same routes as app.py (/api/new_case, /api/current_case,
+/api/order_test, /api/order_tests, /submit_diagnosis, /api/reset) with the same
+responses, and shares its state: the session store, journal and knowledge
+bases are those of app.py. Bayes work (case generation, posterior updates,
+serialising probabilities) runs on a bounded pool of SYMPLI_ASGI_WORKERS
+threads, and session-store reads and writes on a separate pool, so the event
+loop only parses requests and writes responses. When SYMPLI_ASGI_QUEUE requests
+are already waiting for a worker, new ones get 503 rather than queueing without
+bound.
+"""
+import asyncio
+import json
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+import app as wsgi
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get("SYMPLI_ASGI_WORKERS", os.cpu_count() or 4))
+MAX_QUEUED = int(os.environ.get("SYMPLI_ASGI_QUEUE", 256))
+IO_WORKERS = int(os.environ.get("SYMPLI_ASGI_IO_WORKERS", 8))
+MAX_BODY = 64 * 1024
+
+COMPUTE = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="sympli-compute")
+IO = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="sympli-io")
+
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-methods", b"GET, POST, OPTIONS"),
+    (b"access-control-allow-headers", b"Content-Type"),
+]
+
+# Sessions use Flask's signed session cookie, so a client can move between app.py and asgi.py
+SESSION_COOKIE = wsgi.app.config["SESSION_COOKIE_NAME"]
+SESSION_SERIALIZER = wsgi.app.session_interface.get_signing_serializer(wsgi.app)
+
+
+class Overloaded(Exception):
+    """
+    Raised when MAX_QUEUED requests are already waiting for a compute worker.
+    """
+
+
+class Request:
+    """
+    The parts of an HTTP request the routes use.
+
+    Params:
+        method (str): HTTP method
+        path (str): request path
+        args (dict): query parameters (first value of each)
+        headers (dict): lower-cased header names => values
+        body (bytes): request body
+        session_id (str): session of the request (see session_for)
+    """
+
+    def __init__(self, method, path, args, headers, body, session_id):
+        self.method = method
+        self.path = path
+        self.args = args
+        self.headers = headers
+        self.body = body
+        self.session_id = session_id
+
+
+    def get_json(self):
+        """
+        Returns the body parsed as JSON (a dict), or {} if it is empty or not valid JSON.
+        """
+        try:
+            data = json.loads(self.body or b"{}")
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+
+class Limiter:
+    """
+    Runs functions on COMPUTE with at most WORKERS running and MAX_QUEUED waiting.
+    """
+
+    def __init__(self, workers, max_queued):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.waiting = 0
+        self._semaphore = None
+
+
+    async def run(self, func, *args):
+        if self._semaphore is None:
+            # Created lazily so it belongs to the server's event loop
+            self._semaphore = asyncio.Semaphore(self.workers)
+        if self._semaphore.locked() and self.waiting >= self.max_queued:
+            raise Overloaded()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(COMPUTE, partial(func, *args))
+        finally:
+            self._semaphore.release()
+
+
+LIMITER = Limiter(WORKERS, MAX_QUEUED)
+
+
+class SessionLocks:
+    """
+    sessions.SessionLocks for the event loop: an asyncio.Lock per session, held
+    across the awaits of a route that reads a session's case, changes it and
+    stores it again. A session's lock exists only while a request holds or
+    waits for it.
+    """
+
+    def __init__(self):
+        self._locks = {}  # session_id => [lock, requests holding or waiting for it]
+
+
+    @asynccontextmanager
+    async def hold(self, session_id):
+        entry = self._locks.get(session_id)
+        if entry is None:
+            entry = self._locks[session_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[session_id]
+
+
+    def __len__(self):
+        return len(self._locks)
+
+
+SESSION_LOCKS = SessionLocks()
+
+
+async def compute(func, *args):
+    """
+    Runs CPU-bound func(*args) on the compute pool.
+    """
+    return await LIMITER.run(func, *args)
+
+
+async def io(func, *args):
+    """
+    Runs blocking session-store func(*args) on the I/O pool.
+    """
+    return await asyncio.get_running_loop().run_in_executor(IO, partial(func, *args))
+
+
+def session_for(headers):
+    """
+    Returns the session of a request as app.current_session_id does: the
+    session_id in a valid session cookie; a new one for a cookie that does not
+    verify; the shared 'test_user' session for a request without a cookie.
+
+    Returns:
+        session_id (str)
+        cookie (bytes): Set-Cookie header value giving the client a session of
+            its own, or None if it already has one
+    """
+    morsel = SimpleCookie(headers.get("cookie", "")).get(SESSION_COOKIE)
+    if morsel is not None:
+        try:
+            return SESSION_SERIALIZER.loads(morsel.value)["session_id"], None
+        except Exception:
+            pass
+    session_id = str(uuid.uuid4())
+    value = SESSION_SERIALIZER.dumps({"session_id": session_id})
+    cookie = f"{SESSION_COOKIE}={value}; HttpOnly; Path=/".encode()
+    return (session_id if morsel is not None else 'test_user'), cookie
+
+
+def encode(payload):
+    """
+    Serialises a payload as JSON bytes, in the compact form Flask's jsonify uses.
+    """
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+async def new_case(request):
+    """
+    See app.new_case.
+    """
+    session_id = request.session_id
+    top, failed = wsgi.parse_top(request.args.get("top"))
+    if failed:
+        return failed
+    kb = request.args.get("kb") or wsgi.KNOWLEDGE_BASES.default
+    async with SESSION_LOCKS.hold(session_id):
+        case, payload, status = await compute(_encoded_start_case, session_id, kb, top)
+        if case is not None:
+            await io(wsgi.user_cases.__setitem__, session_id, case)
+    return payload, status
+
+
+def _encoded_start_case(session_id, kb, top):
+    case, payload, status = wsgi.start_case(session_id, kb, top)
+    return case, encode(payload), status
+
+
+async def current_case(request):
+    """
+    See app.get_current_case. Returns (payload, status, headers).
+    """
+    session_id = request.session_id
+    top, failed = wsgi.parse_top(request.args.get("top"))
+    if failed:
+        return failed
+    case = await io(wsgi.get_case, session_id)
+    if not case:
+        return {"error": "No case generated yet"}, 404
+
+    etag = wsgi.case_etag(case, top)
+    headers = [(b"etag", f'"{etag}"'.encode()), (b"cache-control", b"private, no-cache")]
+    if etag in _etags(request.headers.get("if-none-match", "")):
+        return b"", 304, headers
+    return await compute(lambda: encode(wsgi.visible_case(case, top))), 200, headers
+
+
+def _etags(header):
+    """
+    Returns the entity tags listed in an If-None-Match header, without quotes or weak prefixes.
+    """
+    tags = set()
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tags.add(tag.strip('"'))
+    return tags
+
+
+async def order_test(request):
+    """
+    See app.order_test.
+    """
+    return await _order(request, wsgi.order_test_on, "test")
+
+
+async def order_tests(request):
+    """
+    See app.order_tests.
+    """
+    return await _order(request, wsgi.order_tests_on, "tests")
+
+
+async def _order(request, operation, field):
+    session_id = request.session_id
+    top, failed = wsgi.parse_top(request.args.get("top"))
+    if not failed:
+        delta, failed = wsgi.parse_delta(request.args.get("delta"))
+    if failed:
+        return failed
+    async with SESSION_LOCKS.hold(session_id):
+        case = await io(wsgi.get_case, session_id)
+        if not case:
+            return {"error": "No case generated"}, 400
+
+        data = request.get_json()
+        payload, status = await compute(lambda: _encoded(operation(case, session_id, data.get(field), top, delta)))
+        if status == 200:
+            await io(wsgi.user_cases.__setitem__, session_id, case)
+    return payload, status
+
+
+def _encoded(response):
+    payload, status = response
+    return encode(payload), status
+
+
+async def submit_diagnosis(request):
+    """
+    See app.submit_diagnosis.
+    """
+    session_id = request.session_id
+    async with SESSION_LOCKS.hold(session_id):
+        case = await io(wsgi.get_case, session_id)
+        if not case:
+            return {"error": "No case generated"}, 400
+        data = request.get_json()
+        # Appends to the journal and analytics, which take locks shared with their flush threads
+        payload, status = await io(wsgi.diagnose, case, session_id, str(data.get("diagnosis", "")))
+        if status == 200:
+            await io(wsgi.user_cases.__setitem__, session_id, case)
+    return payload, status
+
+
+async def reset(request):
+    """
+    See app.reset_case.
+    """
+    async with SESSION_LOCKS.hold(request.session_id):
+        await io(wsgi.reset_session, request.session_id)
+    return {"status": "case cleared"}, 200
+
+
+# path => (methods, handler). Handlers return (payload, status) or
+# (payload, status, headers); a payload that is not bytes is encoded as JSON
+ROUTES = {
+    "/api/new_case": (("GET",), new_case),
+    "/api/current_case": (("GET",), current_case),
+    "/api/order_test": (("POST",), order_test),
+    "/api/order_tests": (("POST",), order_tests),
+    "/submit_diagnosis": (("POST",), submit_diagnosis),
+    "/api/reset": (("GET",), reset),
+}
+
+
+async def app(scope, receive, send):
+    """
+    ASGI 3 application.
+    """
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    route = ROUTES.get(scope["path"])
+    method = scope["method"]
+    if route is None:
+        await respond(send, {"error": "Not found"}, 404)
+        return
+    if method == "OPTIONS":
+        await respond(send, b"", 204)
+        return
+    methods, handler = route
+    if method not in methods:
+        await respond(send, {"error": "Method not allowed"}, 405, [(b"allow", ", ".join(methods).encode())])
+        return
+
+    body = await read_body(receive)
+    if body is None:
+        await respond(send, {"error": "Request body too large"}, 413)
+        return
+
+    args = {k: v[0] for k, v in parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+    session_id, cookie = session_for(headers)
+    try:
+        payload, status, *extra = await handler(Request(method, scope["path"], args, headers, body, session_id))
+        response_headers = extra[0] if extra else []
+        if cookie:
+            response_headers.append((b"set-cookie", cookie))
+        await respond(send, payload, status, response_headers)
+    except Overloaded:
+        await respond(send, {"error": "Server busy"}, 503, [(b"retry-after", b"1")])
+    except Exception:
+        logger.exception("Error handling %s %s", method, scope["path"])
+        await respond(send, {"error": "Internal server error"}, 500)
+
+
+async def read_body(receive):
+    """
+    Returns the request body, or None if it is longer than MAX_BODY.
+    """
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_BODY:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+async def respond(send, payload, status, headers=()):
+    """
+    Sends a complete response. A payload that is not bytes is encoded as JSON.
+    """
+    body = payload if isinstance(payload, bytes) else encode(payload)
+    response_headers = list(CORS_HEADERS) + list(headers)
+    if body:
+        response_headers.append((b"content-type", b"application/json"))
+    response_headers.append((b"content-length", str(len(body)).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": response_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def lifespan(receive, send):
+    """
+    Handles server startup and shutdown: starts the case pool and the engine
+    timings (see app.enable_engine_timings), checks for
+    changed templates in the background while running, and flushes the journal
+    on shutdown.
+    """
+    checker = None
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            checker = asyncio.create_task(check_templates())
+            wsgi.start_case_pool()
+            wsgi.enable_engine_timings()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if checker:
+                checker.cancel()
+            if wsgi.JOURNAL:
+                await io(wsgi.JOURNAL.flush)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def check_templates():
+    """
+    Picks up changed disease templates every check interval, off the event loop
+    (app.py runs the same check on a daemon thread, see KnowledgeBaseCache.start).
+    """
+    while True:
+        await asyncio.sleep(wsgi.KNOWLEDGE_BASES.check_interval)
+        try:
+            await io(wsgi.KNOWLEDGE_BASES.maybe_check)
+        except Exception:
+            logger.exception("Could not check disease templates")
@@ -1,5 +1,12 @@
 import math
 
+# Probabilities used when a template does not specify a feature, so templates
+# with different symptom and test sets can be scored together
+DEFAULT_SYMPTOM_PROBABILITY = 0.05
+DEFAULT_CATEGORY_PROBABILITY = 0.01
+DEFAULT_TEST_SENSITIVITY = 0.01
+DEFAULT_TEST_SPECIFICITY = 0.99
+
 def update(priors, likelihoods):
     """
     Updates priors using Bayes Theorem.
@@ -26,6 +33,9 @@ def update(priors, likelihoods):
 def comp_starting_likelihoods(disease_templates, demographics, symptoms, vitals):
     """
     Computes P(demographics, symptoms, vitals|disease) for each disease in disease_templates.
+    Symptoms a disease does not list have probability DEFAULT_SYMPTOM_PROBABILITY,
+    sex/race values missing from its distributions DEFAULT_CATEGORY_PROBABILITY,
+    and vitals it does not list (or the case lacks) are skipped.
 
     Params:
         disease_templates (list): list of dicts describing diseases
@@ -43,17 +53,18 @@ def comp_starting_likelihoods(disease_templates, demographics, symptoms, vitals)
 
         # For all demographics, multiply likelihood by P(demographic|disease)
         likelihood *= normal_pdf(demographics["age"], disease["demographics"]["age"]["mean"], disease["demographics"]["age"]["std"])
-        likelihood *= disease["demographics"]["sex_distribution"][demographics["sex"]]
-        likelihood *= disease["demographics"]["race_distribution"][demographics["race"]]
+        likelihood *= disease["demographics"]["sex_distribution"].get(demographics["sex"], DEFAULT_CATEGORY_PROBABILITY)
+        likelihood *= disease["demographics"]["race_distribution"].get(demographics["race"], DEFAULT_CATEGORY_PROBABILITY)
 
         # For all symptoms, multiply likelihood by P(symptom|disease)
         for symptom, present in symptoms.items(): # update symptoms
-            p = disease["symptoms"][symptom]["probability"]
+            p = disease["symptoms"][symptom]["probability"] if symptom in disease["symptoms"] else DEFAULT_SYMPTOM_PROBABILITY
             likelihood *= p if present else (1-p)
 
         # For all vitals, multiply likelihood by P(vital|disease)
         for vital, details in disease["vitals"].items():
-            likelihood *= normal_pdf(vitals[vital], details["mean"], details["std"])
+            if vital in vitals:
+                likelihood *= normal_pdf(vitals[vital], details["mean"], details["std"])
 
         likelihoods[disease["name"]] = likelihood
 
@@ -63,6 +74,9 @@ def comp_starting_likelihoods(disease_templates, demographics, symptoms, vitals)
 def comp_test_likelihood(disease_templates, test_name, result):
     """
     Computes P(test_results|disease) for each disease in disease_templates.
+    Diseases that do not list a binary test use DEFAULT_TEST_SENSITIVITY and
+    DEFAULT_TEST_SPECIFICITY; diseases that do not list a multi-finding test are
+    unaffected by it.
 
     Params:
         disease_templates (list): list of dicts describing diseases
@@ -77,14 +91,15 @@ def comp_test_likelihood(disease_templates, test_name, result):
     for disease in disease_templates:
         likelihood = 1.0
 
-        # Binary test
-        if disease["diagnostic_tests"][test_name]["Binary"]:
-            if test_name in disease["diagnostic_tests"]:
+        # Binary test (a disease without the test is binary iff the result is)
+        listed = test_name in disease["diagnostic_tests"]
+        if disease["diagnostic_tests"][test_name]["Binary"] if listed else isinstance(result, str):
+            if listed:
                 sens = disease["diagnostic_tests"][test_name]["sensitivity"]
                 spec = disease["diagnostic_tests"][test_name]["specificity"]
             else:
-                sens = 0.01
-                spec = 0.99
+                sens = DEFAULT_TEST_SENSITIVITY
+                spec = DEFAULT_TEST_SPECIFICITY
 
             # Multiply likelihood by sens if test is positive (true pos) and spec if test is negative (false neg)
             if result == "positive":
@@ -92,7 +107,7 @@ def comp_test_likelihood(disease_templates, test_name, result):
             else:
                 likelihood *= (1 - spec)
         # Not binary test, multiply likelihood by sensitivity or (1 - spec) for each possible finding
-        else:
+        elif listed:
             for finding in disease["diagnostic_tests"][test_name]:
                 if finding != "Binary":
                     if finding in result:
@@ -0,0 +1,27 @@
+"""
+Benchmarks of the Bayes engine and case generation over synthetic knowledge
+bases. Run from the backend folder:
+
+    python -m benchmarks.run                       # time and print results
+    python -m benchmarks.run --compare             # also compare against benchmarks/baseline.json
+    python -m benchmarks.run --save-baseline       # replace the stored baseline
+
+Record the baseline with the versions pinned in requirements.txt, and again in
+any change that means to alter performance. Every report includes a
+calibration time (a fixed workload independent of this code), and --compare
+scales the baseline by it, so machine speed cancels out. A benchmark is a
+regression when it is more than --tolerance (default 2.0, see
+DEFAULT_TOLERANCE) times slower than that, and by more than
+MIN_REGRESSION_SECONDS. A warning is printed when the baseline was recorded
+with another Python or numpy.
+
+Load test of the case routes with concurrent virtual users (see benchmarks/load.py):
+
+    python -m benchmarks.load                      # Flask test client in this process
+    python -m benchmarks.load --target server      # app.py on a local port, over HTTP
+    python -m benchmarks.load --target http://127.0.0.1:5050 --users 200 --duration 60
+
+The first two share one interpreter between users and server, so latencies
+include the users' own time; point it at a separately started server (app.py,
+or asgi.py under an ASGI server) for release numbers.
+"""
@@ -0,0 +1,292 @@
+import argparse
+import http.cookiejar
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import numpy as np
+import load_case
+
+PERCENTILES = (50, 95, 99)
+
+# Sessions and session memory are read from these /metrics gauges
+SESSION_GAUGES = ("sympli_sessions", "sympli_session_memory_bytes")
+
+
+class FlaskClient:
+    """
+    One virtual user against the Flask app in this process, through its test
+    client (which keeps the user's cookies).
+    """
+
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+
+    def request(self, method, path, body=None):
+        """
+        Returns (status, parsed JSON or text) of a request.
+        """
+        response = self.client.open(path, method=method, json=body)
+        if response.is_json:
+            return response.status_code, response.get_json()
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HTTPClient:
+    """
+    One virtual user against a running server, with its own cookie jar.
+    """
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+
+    def request(self, method, path, body=None):
+        """
+        Returns (status, parsed JSON or text) of a request.
+        """
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if data is not None:
+            req.add_header("Content-Type", "application/json")
+        try:
+            with self.opener.open(req, timeout=self.timeout) as response:
+                status, content_type, text = response.status, response.headers.get("Content-Type", ""), response.read()
+        except urllib.error.HTTPError as e:
+            status, content_type, text = e.code, e.headers.get("Content-Type", ""), e.read()
+        if "json" in content_type:
+            return status, json.loads(text)
+        return status, text.decode()
+
+
+class Recorder:
+    """
+    Collects request latencies and status codes per route from every virtual user.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+
+    def timed(self, client, route, method, path, body=None):
+        """
+        Makes a request through client and records it under route.
+
+        Returns:
+            status (int), data (dict or str): as client.request
+        """
+        start = time.perf_counter()
+        try:
+            status, data = client.request(method, path, body)
+        except OSError:
+            status, data = 0, None  # connection failed
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies.setdefault(route, []).append(elapsed)
+            codes = self.statuses.setdefault(route, {})
+            codes[status] = codes.get(status, 0) + 1
+        return status, data
+
+
+def run_flow(client, recorder, tests, diseases, rng, max_tests=4, reset_rate=0.8, think_time=0.0):
+    """
+    Plays one realistic session: new case, view it, order a few tests (some of
+    which the disease may not have), submit a diagnosis and usually reset.
+
+    Params:
+        client (FlaskClient or HTTPClient): virtual user
+        recorder (Recorder)
+        tests (list): test names to order from
+        diseases (list): disease names to guess from
+        rng (random.Random)
+        max_tests (int): most tests ordered per case (at least 1)
+        reset_rate (float): fraction of flows ending with /api/reset; the rest
+            leave their case behind like a user closing the tab
+        think_time (float): mean seconds between a user's requests
+    """
+    def pause():
+        if think_time:
+            time.sleep(rng.expovariate(1 / think_time))
+
+    status, _ = recorder.timed(client, "new_case", "GET", "/api/new_case")
+    if status != 200:
+        return
+    pause()
+    recorder.timed(client, "current_case", "GET", "/api/current_case")
+    for test_name in rng.sample(tests, rng.randint(1, min(max_tests, len(tests)))):
+        pause()
+        recorder.timed(client, "order_test", "POST", "/api/order_test", {"test": test_name})
+    pause()
+    recorder.timed(client, "submit_diagnosis", "POST", "/submit_diagnosis", {"diagnosis": rng.choice(diseases)})
+    if rng.random() < reset_rate:
+        recorder.timed(client, "reset", "GET", "/api/reset")
+
+
+def read_gauges(client):
+    """
+    Returns {gauge: value} of SESSION_GAUGES from the /metrics endpoint.
+    """
+    status, text = client.request("GET", "/metrics")
+    gauges = {}
+    if status == 200:
+        for line in text.splitlines():
+            name, _, value = line.partition(" ")
+            if name in SESSION_GAUGES:
+                gauges[name] = float(value)
+    return gauges
+
+
+def run(make_client, templates, users=50, duration=10.0, sample_interval=1.0, seed=0, **flow_args):
+    """
+    Runs users virtual users, each replaying flows back to back, for duration
+    seconds, while sampling the session gauges every sample_interval seconds.
+
+    Params:
+        make_client (function): returns a new virtual user client
+        templates (list): disease templates of the served knowledge base
+        users (int): concurrent virtual users
+        duration (float): seconds to run
+        sample_interval (float): seconds between memory samples
+        seed (int): random seed
+        flow_args: passed to run_flow
+
+    Returns:
+        report (dict): {"meta", "routes": [{"route", "requests", "throughput", "p50", "p95", "p99", "statuses"}],
+            "flows", "memory": [{"t", "sessions", "session_memory_bytes"}]}
+    """
+    tests = sorted({t for template in templates for t in template["diagnostic_tests"]})
+    diseases = [template["name"] for template in templates]
+    recorder = Recorder()
+    flows = [0] * users
+    stop = threading.Event()
+
+    def user(i):
+        client, rng = make_client(), random.Random(seed * 100003 + i)
+        # Requests without a session cookie share the 'test_user' session, so
+        # take the cookie from a first response before the flows start
+        client.request("GET", "/api/session_stats")
+        while not stop.is_set():
+            run_flow(client, recorder, tests, diseases, rng, **flow_args)
+            flows[i] += 1
+
+    memory = []
+    monitor = make_client()
+    start = time.perf_counter()
+
+    def sample():
+        gauges = read_gauges(monitor)
+        memory.append({
+            "t": round(time.perf_counter() - start, 3),
+            "sessions": gauges.get("sympli_sessions"),
+            "session_memory_bytes": gauges.get("sympli_session_memory_bytes")
+        })
+
+    threads = [threading.Thread(target=user, args=(i,), daemon=True) for i in range(users)]
+    sample()
+    for t in threads:
+        t.start()
+    while not stop.wait(min(sample_interval, max(0.0, duration - (time.perf_counter() - start)))):
+        sample()
+        if time.perf_counter() - start >= duration:
+            stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    sample()
+
+    routes = []
+    for route, latencies in recorder.latencies.items():
+        p = np.percentile(latencies, PERCENTILES)
+        routes.append({
+            "route": route,
+            "requests": len(latencies),
+            "throughput": len(latencies) / elapsed,
+            **{f"p{q}": float(v) for q, v in zip(PERCENTILES, p)},
+            "statuses": {str(k): v for k, v in sorted(recorder.statuses[route].items())}
+        })
+    return {
+        "meta": {"users": users, "duration": elapsed, "seed": seed, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "routes": routes,
+        "flows": sum(flows),
+        "memory": memory
+    }
+
+
+def start_server(flask_app, host="127.0.0.1", port=0):
+    """
+    Serves flask_app from a background thread with a threaded WSGI server.
+
+    Returns:
+        server (werkzeug.serving.BaseWSGIServer): call shutdown() to stop it
+        url (str): base URL of the server
+    """
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no line per request
+    server = make_server(host, port, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="load-test-server", daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+def format_report(report):
+    """
+    Returns the report as text: one row per route, then the session gauge samples.
+    """
+    lines = [f"{report['meta']['users']} users, {report['meta']['duration']:.1f}s, {report['flows']} flows",
+             f"{'route':<18}{'requests':>10}{'req/s':>10}{'p50':>10}{'p95':>10}{'p99':>10}  statuses"]
+    for r in report["routes"]:
+        lines.append(f"{r['route']:<18}{r['requests']:>10}{r['throughput']:>10.1f}"
+                     + "".join(f"{r[f'p{q}'] * 1000:>8.2f}ms" for q in PERCENTILES)
+                     + "  " + " ".join(f"{k}:{v}" for k, v in r["statuses"].items()))
+    lines.append(f"{'t':>8}{'sessions':>12}{'memory':>14}")
+    for m in report["memory"]:
+        memory = "-" if m["session_memory_bytes"] is None else f"{m['session_memory_bytes'] / 1024:.0f}KiB"
+        sessions = "-" if m["sessions"] is None else f"{m['sessions']:.0f}"
+        lines.append(f"{m['t']:>8.1f}{sessions:>12}{memory:>14}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the case routes with concurrent virtual users replaying session flows.")
+    parser.add_argument("--target", default="client",
+                        help="'client' (Flask test client in this process), 'server' (start app.py on a local port) or a base URL")
+    parser.add_argument("--folder", default="digestive diseases", help="template folder of the served knowledge base")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--max-tests", type=int, default=4, help="most tests ordered per case")
+    parser.add_argument("--reset-rate", type=float, default=0.8, help="fraction of flows ending with a reset")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean seconds between a user's requests")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="seconds between session memory samples")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    server = None
+    if args.target in ("client", "server"):
+        import app
+        if args.target == "client":
+            make_client = lambda: FlaskClient(app.app)
+        else:
+            server, url = start_server(app.app)
+            make_client = lambda: HTTPClient(url)
+    else:
+        make_client = lambda: HTTPClient(args.target)
+
+    report = run(make_client, load_case.load_disease_templates(args.folder), args.users, args.duration, args.sample_interval, args.seed,
+                 max_tests=args.max_tests, reset_rate=args.reset_rate, think_time=args.think_time)
+    if server:
+        server.shutdown()
+    print(format_report(report))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(0 if all(not any(k == "0" or k.startswith("5") for k in r["statuses"]) for r in report["routes"]) else 1)
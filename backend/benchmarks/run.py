@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+import load_case
+import bayes
+import model
+import posterior
+from benchmarks import synthetic
+
+DEFAULT_SCALES = [2, 10, 100, 1000, 10000]
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Slowdown, relative to the calibration time, above which compare reports a
+# regression. The microsecond-scale benchmarks settle at one of two speeds per
+# process (memory layout), up to about 1.8x apart between runs of the same
+# build on one machine, so anything tighter fails on noise.
+DEFAULT_TOLERANCE = 2.0
+
+# Slowdowns of less than this many seconds per call are timer and layout noise
+# at the smallest scales, and are never reported as regressions.
+MIN_REGRESSION_SECONDS = 10e-6
+
+
+def measure(func, min_time=0.2, max_repeats=1000):
+    """
+    Calls func repeatedly for about min_time seconds (at least 3 times, at most
+    max_repeats) and returns the median seconds per call.
+    """
+    func()  # warm up caches
+    times = []
+    start = time.perf_counter()
+    while len(times) < max_repeats and (len(times) < 3 or time.perf_counter() - start < min_time):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    return statistics.median(times), len(times)
+
+
+def calibrate(min_time=0.2):
+    """
+    Times a fixed mix of interpreter and numpy work that does not depend on
+    this code. Stored with each report so compare can scale away differences
+    in machine speed and load between a run and its baseline.
+
+    Returns:
+        seconds (float): median seconds per call
+    """
+    values = np.random.default_rng(0).random(10000)
+    items = {str(i): i for i in range(1000)}
+
+    def work():
+        sum(v * 2 for v in items.values())
+        np.logaddexp(values, values[::-1]).sum()
+        np.sort(values)
+
+    return measure(work, min_time)[0]
+
+
+def benchmark_scale(n_diseases, min_time=0.2, seed=0):
+    """
+    Times every benchmark against a synthetic knowledge base of n_diseases.
+
+    Returns:
+        results (list): [{"benchmark", "scale", "seconds", "repeats"}]
+    """
+    templates = synthetic.generate_templates(n_diseases, seed=seed)
+    random.seed(seed)
+    case = load_case.generate_random_case(templates)
+    compiled = model.compile_model(templates)
+    binary_test = next(t for t, data in templates[0]["diagnostic_tests"].items() if data["Binary"])
+    finding_test = next(t for t, data in templates[0]["diagnostic_tests"].items() if not data["Binary"])
+    findings = [f for f in templates[0]["diagnostic_tests"][finding_test] if f != "Binary"][:2]
+    priors = case["probabilities"]
+    likelihoods = bayes.comp_starting_likelihoods(templates, case["demographics"], case["symptoms"], case["vitals"])
+    log_likelihoods = compiled.to_log_array(likelihoods)
+    post = posterior.from_model(compiled)
+    sparse_likelihood = compiled.test_log_likelihood(binary_test, "positive")
+    sampler = load_case.CaseSampler(templates)
+
+    benchmarks = {
+        "load_case.generate_random_case": lambda: load_case.generate_random_case(templates),
+        "load_case.generate_cases[1000]": lambda: load_case.generate_cases(templates, 1000, sampler=sampler),
+        "bayes.comp_starting_likelihoods": lambda: bayes.comp_starting_likelihoods(templates, case["demographics"], case["symptoms"], case["vitals"]),
+        "bayes.comp_test_likelihood[binary]": lambda: bayes.comp_test_likelihood(templates, binary_test, "positive"),
+        "bayes.comp_test_likelihood[findings]": lambda: bayes.comp_test_likelihood(templates, finding_test, findings),
+        "bayes.update": lambda: bayes.update(priors, likelihoods),
+        "model.compile_model": lambda: model.compile_model(templates),
+        "model.log_starting_likelihood_array": lambda: compiled.log_starting_likelihood_array(case["demographics"], case["symptoms"], case["vitals"]),
+        "model.test_log_likelihood_array[findings]": lambda: compiled.test_log_likelihood_array(finding_test, findings),
+        "model.test_log_likelihood[findings]": lambda: compiled.test_log_likelihood(finding_test, findings),
+        "posterior.add": lambda: post.add(log_likelihoods),
+        "posterior.add_sparse": lambda: post.add_sparse(*sparse_likelihood),
+        "posterior.probabilities": lambda: post.probabilities(),
+        "posterior.top[10]": lambda: post.top(10)
+    }
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        synthetic.write_templates(templates, folder)
+        seconds, repeats = measure(lambda: load_case.load_disease_templates(folder), min_time)
+        results.append({"benchmark": "load_case.load_disease_templates", "scale": n_diseases, "seconds": seconds, "repeats": repeats})
+
+    for name, func in benchmarks.items():
+        seconds, repeats = measure(func, min_time)
+        results.append({"benchmark": name, "scale": n_diseases, "seconds": seconds, "repeats": repeats})
+    return results
+
+
+def run(scales=DEFAULT_SCALES, min_time=0.2, seed=0):
+    """
+    Runs every benchmark at every scale.
+
+    Returns:
+        report (dict): {"meta": {...}, "results": [{"benchmark", "scale", "seconds", "repeats"}]}
+    """
+    calibration = calibrate(min_time)
+    results = []
+    for n in scales:
+        results.extend(benchmark_scale(n, min_time, seed))
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seed": seed,
+            "calibration": min(calibration, calibrate(min_time))
+        },
+        "results": results
+    }
+
+
+def compare(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares results against a baseline report. Each ratio is taken relative to
+    the ratio of the two reports' calibration times, so a baseline recorded on
+    another machine (or a busier one) still compares like for like. Slowdowns
+    under MIN_REGRESSION_SECONDS are ignored.
+
+    Params:
+        report (dict): output of run
+        baseline (dict): earlier output of run
+        tolerance (float): relative slowdown above which a benchmark counts as a regression
+
+    Returns:
+        regressions (list): [{"benchmark", "scale", "seconds", "baseline", "ratio"}] slower than tolerance allows
+    """
+    speed = 1.0
+    if report["meta"].get("calibration") and baseline["meta"].get("calibration"):
+        speed = report["meta"]["calibration"] / baseline["meta"]["calibration"]
+    base = {(r["benchmark"], r["scale"]): r["seconds"] for r in baseline["results"]}
+    regressions = []
+    for r in report["results"]:
+        before = base.get((r["benchmark"], r["scale"]))
+        if not before:
+            continue
+        expected = before * speed
+        if r["seconds"] / expected > tolerance and r["seconds"] - expected > MIN_REGRESSION_SECONDS:
+            regressions.append({"benchmark": r["benchmark"], "scale": r["scale"], "seconds": r["seconds"], "baseline": before, "ratio": r["seconds"] / expected})
+    return regressions
+
+
+def format_table(report):
+    """
+    Returns results as a text table, one row per benchmark and one column per scale.
+    """
+    scales = sorted({r["scale"] for r in report["results"]})
+    names = list(dict.fromkeys(r["benchmark"] for r in report["results"]))
+    seconds = {(r["benchmark"], r["scale"]): r["seconds"] for r in report["results"]}
+    width = max(len(n) for n in names)
+    lines = ["benchmark".ljust(width) + "".join(f"{s:>12}" for s in scales)]
+    for n in names:
+        lines.append(n.ljust(width) + "".join(f"{_duration(seconds.get((n, s))):>12}" for s in scales))
+    return "\n".join(lines)
+
+
+def _duration(seconds):
+    if seconds is None:
+        return "-"
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Bayes engine over synthetic knowledge bases.")
+    parser.add_argument("--scales", default=",".join(map(str, DEFAULT_SCALES)), help="comma-separated numbers of diseases")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to spend per benchmark and scale")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write results as JSON to this file")
+    parser.add_argument("--compare", action="store_true", help="compare against the stored baseline; exit 1 on regressions")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file (default: benchmarks/baseline.json)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="slowdown ratio, relative to the calibration run, counted as a regression")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    args = parser.parse_args()
+
+    report = run([int(s) for s in args.scales.split(",")], args.min_time, args.seed)
+    print(format_table(report))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for key in ("python", "numpy"):
+            if baseline["meta"].get(key) != report["meta"][key]:
+                print(f"WARNING baseline was recorded with {key} {baseline['meta'].get(key)}, this run uses {report['meta'][key]}", file=sys.stderr)
+        regressions = compare(report, baseline, args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION {r['benchmark']} at {r['scale']} diseases: {_duration(r['seconds'])} vs {_duration(r['baseline'])} ({r['ratio']:.2f}x)", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,93 @@
+import json
+import os
+import random
+
+RACES = ["white", "black", "hispanic", "asian", "other"]
+
+# name => (typical mean, spread of means across diseases, std)
+STANDARD_VITALS = {
+    "body_temperature": (37.5, 1.0, 0.6),
+    "pulse": (95, 15, 12),
+    "respiratory_rate": (19, 3, 3),
+    "blood_pressure_systolic": (120, 10, 12),
+    "blood_pressure_diastolic": (78, 6, 8)
+}
+
+
+def generate_templates(n_diseases, n_symptoms=7, n_vitals=5, n_binary_tests=3, n_finding_tests=3, n_findings=4, seed=0):
+    """
+    Generates synthetic disease templates in the schema of the files in
+    "digestive diseases/". Every template lists the same symptoms, vitals, tests
+    and findings (as the dict-based functions in bayes require).
+
+    Params:
+        n_diseases (int): number of templates
+        n_symptoms (int): symptoms per template
+        n_vitals (int): vitals per template; the five standard vitals first, then extra ones
+        n_binary_tests (int): binary tests per template
+        n_finding_tests (int): multi-finding tests per template
+        n_findings (int): findings per multi-finding test
+        seed (int): random seed
+
+    Returns:
+        templates (list): list of disease templates (dict)
+    """
+    rng = random.Random(seed)
+    symptoms = [f"symptom_{i:03d}" for i in range(n_symptoms)]
+    vitals = list(STANDARD_VITALS)[:n_vitals] + [f"vital_{i:03d}" for i in range(max(0, n_vitals - len(STANDARD_VITALS)))]
+
+    templates = []
+    for d in range(n_diseases):
+        male = round(rng.uniform(0.3, 0.7), 3)
+        race_weights = [rng.random() for _ in RACES]
+        total = sum(race_weights)
+
+        template_vitals = {}
+        for vital in vitals:
+            mean, spread, std = STANDARD_VITALS.get(vital, (50, 10, 5))
+            template_vitals[vital] = {"mean": round(rng.gauss(mean, spread), 2), "std": round(std * rng.uniform(0.7, 1.3), 2)}
+
+        tests = {}
+        for t in range(n_binary_tests):
+            tests[f"Binary_Test_{t:02d}"] = {
+                "Binary": True,
+                "sensitivity": round(rng.uniform(0.05, 0.95), 3),
+                "specificity": round(rng.uniform(0.05, 0.95), 3)
+            }
+        for t in range(n_finding_tests):
+            test = {"Binary": False}
+            for f in range(n_findings):
+                test[f"Finding_{t:02d}_{f:02d}"] = {
+                    "sensitivity": round(rng.uniform(0.01, 0.95), 3),
+                    "specificity": round(rng.uniform(0.3, 0.99), 3)
+                }
+            tests[f"Imaging_{t:02d}"] = test
+
+        templates.append({
+            "name": f"Synthetic Disease {d:05d}",
+            "prior": round(rng.uniform(0.01, 1.0), 4),
+            "demographics": {
+                "age": {"mean": round(rng.uniform(5, 85), 1), "std": round(rng.uniform(5, 20), 1)},
+                "sex_distribution": {"male": male, "female": round(1 - male, 3)},
+                "race_distribution": {r: round(w / total, 3) for r, w in zip(RACES, race_weights)}
+            },
+            "symptoms": {s: {"probability": round(rng.uniform(0.01, 0.99), 3)} for s in symptoms},
+            "vitals": template_vitals,
+            "diagnostic_tests": tests
+        })
+
+    return templates
+
+
+def write_templates(templates, folder):
+    """
+    Writes templates as one JSON file each, like "digestive diseases/".
+
+    Params:
+        templates (list): list of disease templates (dict)
+        folder (dir): destination folder, created if missing
+    """
+    os.makedirs(folder, exist_ok=True)
+    for i, template in enumerate(templates):
+        with open(os.path.join(folder, f"disease_{i:05d}.json"), "w") as f:
+            json.dump(template, f, indent=4)
@@ -0,0 +1,165 @@
+import logging
+import os
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class CasePool:
+    """
+    Per-knowledge-base pools of ready-made cases, each with its starting
+    posterior already computed, so a new case is a pop rather than a case
+    generation and a likelihood computation on the request thread.
+
+    Once start() is called, a background thread keeps every pool that has been
+    taken from (or watched) between the watermarks: once a pool drops below low it is refilled to high. A pool
+    that runs dry makes take() return None, and the caller generates the case
+    itself. Pooled cases belong to the knowledge-base version that made them;
+    when a newer version is asked for, the older cases are dropped.
+
+    Params:
+        make_case (function): make_case(kb) returns (seed, case) for a new case
+            of the current version of knowledge base kb, or raises KeyError if
+            the pool for kb should stop being refilled (e.g. kb was unloaded)
+        low (int): refill a pool once it holds fewer cases
+        high (int): refill a pool up to this many cases
+    """
+
+    def __init__(self, make_case, low=32, high=256):
+        self.make_case = make_case
+        self.low = low
+        self.high = high
+        self.hits = 0
+        self.misses = 0
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._closed = False
+        self._worker = None
+
+
+    @property
+    def started(self):
+        """
+        Whether start() has been called.
+        """
+        return self._worker is not None
+
+
+    def start(self):
+        """
+        Starts the background thread that refills the pools, if not started yet.
+        """
+        with self._lock:
+            if self._worker is None and not self._closed:
+                self._worker = threading.Thread(target=self._refill_loop, name="case-pool", daemon=True)
+                self._worker.start()
+
+
+    def take(self, kb, version):
+        """
+        Pops a pooled case of knowledge base kb made with version.
+
+        Params:
+            kb (str): knowledge-base name
+            version (str): current version of the knowledge base
+
+        Returns:
+            seed (int), case (compact_case.CompactCase): or None if the pool has no such case
+        """
+        with self._lock:
+            pool = self._pools.get(kb)
+            if pool is None:
+                pool = self._pools[kb] = deque()
+            taken = None
+            while pool:
+                seed, case = pool.popleft()
+                # Cases of any other version were made before a reload and are dropped
+                if case.model_version == version:
+                    taken = seed, case
+                    break
+            if taken is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            if len(pool) < self.low:
+                self._wake.notify()
+            return taken
+
+
+    def watch(self, kb):
+        """
+        Starts filling the pool of knowledge base kb before the first take().
+        """
+        with self._lock:
+            if kb not in self._pools:
+                self._pools[kb] = deque()
+                self._wake.notify()
+
+
+    def sizes(self):
+        """
+        Returns {kb: pooled cases}.
+        """
+        with self._lock:
+            return {kb: len(pool) for kb, pool in self._pools.items()}
+
+
+    def close(self):
+        """
+        Stops the background thread.
+        """
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        if self._worker is not None:
+            self._worker.join()
+
+
+    def _refill_loop(self):
+        """
+        Background thread: refills pools that dropped below low up to high, one case at a time.
+        """
+        while True:
+            with self._lock:
+                while not self._closed and not any(len(p) < self.low for p in self._pools.values()):
+                    self._wake.wait()
+                if self._closed:
+                    return
+                due = [kb for kb, p in self._pools.items() if len(p) < self.low]
+
+            for kb in due:
+                while True:
+                    with self._lock:
+                        pool = self._pools.get(kb)
+                        if self._closed or pool is None or len(pool) >= self.high:
+                            break
+                    try:
+                        made = self.make_case(kb)
+                    except KeyError:
+                        with self._lock:
+                            self._pools.pop(kb, None)
+                        break
+                    except Exception:
+                        logger.exception("Could not generate a pooled case for '%s'", kb)
+                        with self._lock:
+                            self._pools.pop(kb, None)
+                        break
+                    with self._lock:
+                        # A pool dropped meanwhile is not recreated here
+                        if self._pools.get(kb) is pool:
+                            pool.append(made)
+
+
+def create_pool(make_case):
+    """
+    Returns a CasePool with the watermarks from the SYMPLI_CASE_POOL_LOW and
+    SYMPLI_CASE_POOL_HIGH environment variables (default 32 and 256), or None
+    if SYMPLI_CASE_POOL_HIGH is 0. The pool does not refill until started.
+    """
+    high = int(os.environ.get("SYMPLI_CASE_POOL_HIGH", 256))
+    if high <= 0:
+        return None
+    low = min(int(os.environ.get("SYMPLI_CASE_POOL_LOW", 32)), high)
+    return CasePool(make_case, low, high)
@@ -0,0 +1,308 @@
+import struct
+import sys
+import types
+import weakref
+import numpy as np
+import posterior
+
+# Age, sex and race slots at the start of every CompactCase's fields
+_DEMOGRAPHICS = struct.Struct("<iHH")
+
+# Vital values are packed as this type, so only integers in its range fit
+_VITAL_TYPE = np.dtype("<i4")
+_VITAL_RANGE = np.iinfo(_VITAL_TYPE)
+
+# Stands in for the tests of a case before any are ordered
+_NO_TESTS = types.MappingProxyType({})
+
+_layouts = weakref.WeakKeyDictionary()
+_layouts_by_key = weakref.WeakValueDictionary()
+
+# Finds the compiled model of a layout key when a pickled case is loaded, see set_layout_resolver
+_resolve_model = None
+
+
+class CaseLayout:
+    """
+    Slot positions shared by every CompactCase of one compiled model: the
+    disease, symptom and vital vocabularies and the demographic categories,
+    in model order.
+
+    A layout with a key, (knowledge base, model version), pickles as just that
+    key: loading a pickled case then finds the layout of that version again
+    (see set_layout_resolver) rather than carrying the vocabularies in every
+    pickled session.
+
+    Params:
+        compiled (model.CompiledModel)
+        key (tuple): (knowledge_base, model_version) of the model (optional)
+    """
+
+    def __init__(self, compiled, key=None):
+        self.key = key
+        self.names = compiled.names
+        self.symptoms = compiled.symptoms
+        self.vitals = compiled.vitals
+        self.sexes = compiled.sexes
+        self.races = compiled.races
+        self._build_indexes()
+
+
+    def __reduce__(self):
+        if self.key is not None:
+            return _layout_by_key, (self.key,)
+        return _layout_from_state, (self.__getstate__(),)
+
+
+    def __getstate__(self):
+        return {"key": None, "names": self.names, "symptoms": self.symptoms, "vitals": self.vitals, "sexes": self.sexes, "races": self.races}
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_indexes()
+
+
+    def _build_indexes(self):
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.lower_names = frozenset(name.lower() for name in self.names)
+        self.symptom_index = {k: i for i, k in enumerate(self.symptoms)}
+        self.vital_index = {k: i for i, k in enumerate(self.vitals)}
+        self.sex_index = {k: i for i, k in enumerate(self.sexes)}
+        self.race_index = {k: i for i, k in enumerate(self.races)}
+        self.symptom_bytes = (len(self.symptoms) + 7) // 8
+        self.vital_bytes = (len(self.vitals) + 7) // 8
+
+
+    def encode(self, demographics, symptoms, vitals):
+        """
+        Packs the fixed-slot fields of a case into bytes: age, sex and race;
+        bitsets of the symptoms the case lists and of those present; a bitset
+        of the vitals it lists, then their (integer) values in vocabulary order.
+
+        Params:
+            demographics (dict): {"age": (int), "sex": (str), "race": (str)}
+            symptoms (dict): {symptom: T/F}
+            vitals (dict): {vital: (int)}
+
+        Returns:
+            fields (bytes)
+
+        Raises ValueError if a vital is not an integer (generated cases only
+        have integer vitals), rather than truncating it.
+        """
+        listed = np.zeros(len(self.symptoms), dtype=bool)
+        present = np.zeros(len(self.symptoms), dtype=bool)
+        for symptom, value in symptoms.items():
+            i = self.symptom_index[symptom]
+            listed[i] = True
+            present[i] = value
+        measured = np.zeros(len(self.vitals), dtype=bool)
+        values = np.zeros(len(self.vitals), dtype=_VITAL_TYPE)
+        for vital, value in vitals.items():
+            if value != int(value) or not _VITAL_RANGE.min <= value <= _VITAL_RANGE.max:
+                raise ValueError(f"Vital '{vital}' is {value!r}; only integers can be packed")
+            i = self.vital_index[vital]
+            measured[i] = True
+            values[i] = value
+        return b"".join([
+            _DEMOGRAPHICS.pack(demographics["age"], self.sex_index[demographics["sex"]], self.race_index[demographics["race"]]),
+            np.packbits(listed, bitorder="little").tobytes(),
+            np.packbits(present, bitorder="little").tobytes(),
+            np.packbits(measured, bitorder="little").tobytes(),
+            values[measured].tobytes()
+        ])
+
+
+    def decode(self, fields):
+        """
+        Unpacks bytes from encode.
+
+        Returns:
+            demographics (dict), symptoms (dict), vitals (dict): as given to encode
+        """
+        age, sex, race = _DEMOGRAPHICS.unpack_from(fields)
+        start = _DEMOGRAPHICS.size
+        bits = np.unpackbits(np.frombuffer(fields, np.uint8, 2 * self.symptom_bytes + self.vital_bytes, start), bitorder="little")
+        s, v = 8 * self.symptom_bytes, len(self.vitals)
+        listed, present, measured = bits[:len(self.symptoms)], bits[s:s + len(self.symptoms)], bits[2 * s:2 * s + v]
+        values = np.frombuffer(fields, _VITAL_TYPE, offset=start + 2 * self.symptom_bytes + self.vital_bytes)
+
+        symptoms = {self.symptoms[i]: bool(present[i]) for i in np.flatnonzero(listed).tolist()}
+        vitals = dict(zip([self.vitals[i] for i in np.flatnonzero(measured).tolist()], values.tolist()))
+        return {"age": age, "sex": self.sexes[sex], "race": self.races[race]}, symptoms, vitals
+
+
+class CompactCase:
+    """
+    A session's case held in as little memory as practical, so a node can keep
+    100k+ sessions: the posterior is a LogPosterior (a float array in model
+    disease order), the disease is its position in that order, and the
+    demographics, symptoms and vitals are packed into one bytes object (see
+    CaseLayout.encode). Key strings live once, in the CaseLayout shared by
+    every case of the model. The JSON shape of a case is only built for
+    responses (see to_dict).
+
+    Attributes:
+        case_id (str), knowledge_base (str), model_version (str)
+        disease (int): position of the case's disease in the model
+        created_at (float): time.time() when the case was handed out, or None
+        diagnosed (bool): whether a diagnosis has been submitted for the case
+        posterior (posterior.LogPosterior)
+    """
+
+    __slots__ = ("case_id", "knowledge_base", "model_version", "disease", "created_at", "diagnosed", "posterior", "_tests", "_fields", "_layout")
+
+    def __init__(self, layout, case_id, knowledge_base, model_version, disease, fields, post):
+        self._layout = layout
+        self.case_id = case_id
+        self.knowledge_base = sys.intern(knowledge_base)
+        self.model_version = model_version
+        self.disease = disease
+        self.created_at = None
+        self.diagnosed = False
+        self.posterior = post
+        self._tests = None
+        self._fields = fields
+
+
+    def __getstate__(self):
+        # The posterior's names are the layout's, so they are not pickled twice
+        state = {name: getattr(self, name) for name in self.__slots__}
+        post = self.posterior.__getstate__()
+        del post["names"]
+        state["posterior"] = post
+        return state
+
+
+    def __setstate__(self, state):
+        post = posterior.LogPosterior.__new__(posterior.LogPosterior)
+        post.__setstate__({**state.pop("posterior"), "names": state["_layout"].names})
+        self.posterior = post
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+    @property
+    def name(self):
+        """
+        Name of the case's disease.
+        """
+        return self._layout.names[self.disease]
+
+
+    @property
+    def layout(self):
+        """
+        The CaseLayout shared by every case of the model.
+        """
+        return self._layout
+
+
+    @property
+    def tests(self):
+        """
+        {test name: result} of the tests ordered so far, in order (read-only; see add_test).
+        """
+        return self._tests if self._tests is not None else _NO_TESTS
+
+
+    def add_test(self, test_name, result):
+        """
+        Records the result of an ordered test.
+        """
+        if self._tests is None:
+            self._tests = {}
+        self._tests[test_name] = result
+
+
+    def fields(self):
+        """
+        Returns demographics (dict), symptoms (dict), vitals (dict), in the shape of load_case.generate_random_case.
+        """
+        return self._layout.decode(self._fields)
+
+
+    def to_dict(self):
+        """
+        Returns the case as {"name", "knowledge_base", "demographics", "symptoms", "vitals", "tests"}.
+        """
+        demographics, symptoms, vitals = self.fields()
+        return {
+            "name": self.name,
+            "knowledge_base": self.knowledge_base,
+            "demographics": demographics,
+            "symptoms": symptoms,
+            "vitals": vitals,
+            "tests": dict(self.tests)
+        }
+
+
+def layout_for(compiled, key=None):
+    """
+    Returns the CaseLayout of a compiled model, made once per model.
+
+    Params:
+        compiled (model.CompiledModel)
+        key (tuple): (knowledge_base, model_version) of the model (optional), see CaseLayout
+    """
+    layout = _layouts.get(compiled)
+    if layout is None:
+        layout = _layouts[compiled] = CaseLayout(compiled, key)
+    if key is not None:
+        if layout.key is None:
+            layout.key = key
+        _layouts_by_key[key] = layout
+    return layout
+
+
+def set_layout_resolver(resolve):
+    """
+    Sets how pickled cases find their layout: resolve(knowledge_base, model_version)
+    returns that version's CompiledModel, or raises LookupError if it is gone.
+    Loading a case whose version is gone then raises LookupError too.
+    """
+    global _resolve_model
+    _resolve_model = resolve
+
+
+def _layout_by_key(key):
+    """
+    Unpickles a CaseLayout pickled by key.
+    """
+    layout = _layouts_by_key.get(key)
+    if layout is not None:
+        return layout
+    if _resolve_model is None:
+        raise LookupError(f"No layout resolver for knowledge base '{key[0]}' version {key[1]}")
+    return layout_for(_resolve_model(*key), key)
+
+
+def _layout_from_state(state):
+    """
+    Unpickles a CaseLayout without a key.
+    """
+    layout = CaseLayout.__new__(CaseLayout)
+    layout.__setstate__(state)
+    return layout
+
+
+def from_case(case, compiled, post, case_id, knowledge_base, model_version):
+    """
+    Packs a case dict (as from load_case.generate_random_case) into a CompactCase.
+
+    Params:
+        case (dict): {"name", "demographics", "symptoms", "vitals", "tests"}
+        compiled (model.CompiledModel): model the case was generated from
+        post (posterior.LogPosterior): posterior of the case
+        case_id (str), knowledge_base (str), model_version (str)
+
+    Returns:
+        case (CompactCase)
+    """
+    layout = layout_for(compiled, (knowledge_base, model_version))
+    compact = CompactCase(layout, case_id, knowledge_base, model_version, layout.index[case["name"]],
+                          layout.encode(case["demographics"], case["symptoms"], case["vitals"]), post)
+    for test_name, result in case["tests"].items():
+        compact.add_test(test_name, result)
+    return compact
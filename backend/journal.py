@@ -0,0 +1,385 @@
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SessionJournal:
+    """
+    Append-only event log of session changes, so sessions survive a restart or
+    crash. Events are small JSON lines:
+
+        {"e": "new", "s": session_id, "kb": name, "v": version, "seed": seed, "id": case_id, "c": created_at}
+        {"e": "test", "s": session_id, "test": name, "r": result}
+        {"e": "diagnosis", "s": session_id, "guess": guess, "correct": T/F}
+        {"e": "reset", "s": session_id}
+        {"e": "expire", "s": [session_id, ...]}
+
+    Every event also carries "t", its time.time(). A case is regenerated from its knowledge-base version and seed, and test
+    results are recorded rather than re-sampled, so replaying the events gives
+    back the same case and posterior.
+
+    Appends only add the line to an in-memory buffer; a background thread
+    writes and fsyncs the buffer every fsync_interval seconds (or sooner once
+    batch_size events are pending), so many events share one fsync and a crash
+    loses at most the last interval. The fsync runs outside the lock appends
+    take. The journal also folds events into self.sessions, a JournalEntry per
+    live session with only what it takes to regenerate the case.
+
+    Sessions the session store evicts are recorded with expired() and dropped
+    from the state. Sessions idle for longer than ttl (by their last event) are
+    dropped on recovery and at every snapshot, so sessions that expired while
+    the server was down are not brought back either.
+
+    Every snapshot_every events the state is written to a snapshot and the log
+    starts a new segment; older segments are deleted once the snapshot is in
+    place. Recovery reads the snapshot and replays only the segments written
+    after it. Replaying an event twice has no effect, so a crash at any point
+    of a snapshot leaves a recoverable journal.
+
+    Files in folder: snapshot.json and journal.<generation>.log segments.
+
+    Params:
+        folder (dir): journal folder, created if missing
+        fsync_interval (float): maximum seconds between fsyncs
+        batch_size (int): pending events that trigger an early fsync
+        snapshot_every (int): events between snapshots (None to never snapshot automatically)
+        ttl (float): seconds after its last event a session expires (optional, never if None)
+    """
+
+    def __init__(self, folder, fsync_interval=0.05, batch_size=512, snapshot_every=100000, ttl=None):
+        self.folder = folder
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        self.snapshot_every = snapshot_every
+        self.ttl = ttl
+        os.makedirs(folder, exist_ok=True)
+
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._buffer = []
+        self._since_snapshot = 0
+        self._closed = False
+
+        start = time.perf_counter()
+        self.generation, replayed = self._recover()
+        self._expire_idle()
+        logger.info("Recovered %d sessions from '%s' (%d events replayed) in %.3fs",
+                    len(self.sessions), folder, replayed, time.perf_counter() - start)
+
+        # New events go to a fresh segment, so a torn last line is never appended to
+        self.generation += 1
+        self._file = open(self._segment(self.generation), "a", encoding="utf-8")
+        self._flusher = threading.Thread(target=self._flush_loop, name="session-journal", daemon=True)
+        self._flusher.start()
+
+
+    def case_created(self, session_id, kb, version, seed, case_id, created_at):
+        self._append({"e": "new", "s": session_id, "kb": kb, "v": version, "seed": seed, "id": case_id, "c": created_at})
+
+
+    def test_ordered(self, session_id, test_name, result):
+        self._append({"e": "test", "s": session_id, "test": test_name, "r": result})
+
+
+    def diagnosis_submitted(self, session_id, guess, correct):
+        self._append({"e": "diagnosis", "s": session_id, "guess": guess, "correct": correct})
+
+
+    def reset(self, session_id):
+        self._append({"e": "reset", "s": session_id})
+
+
+    def expired(self, session_ids):
+        """
+        Records sessions evicted by the session store (usable as its on_evict).
+        """
+        self._append({"e": "expire", "s": list(session_ids)})
+
+
+    def flush(self):
+        """
+        Writes and fsyncs every pending event now.
+        """
+        self._sync()
+
+
+    def snapshot(self):
+        """
+        Writes the folded session state to snapshot.json and deletes the segments
+        it covers. Appends only wait while the state is copied and the segment
+        switched, not while the snapshot is written.
+        """
+        with self._snapshot_lock:
+            self._snapshot()
+
+
+    def _snapshot(self):
+        """
+        snapshot() without the snapshot lock. Caller holds self._snapshot_lock.
+        """
+        with self._write_lock:
+            self._write()
+            with self._lock:
+                # Events appended since the write above are still buffered, and go to the new segment
+                self._expire_idle()
+                sessions = {s: entry.to_dict() for s, entry in self.sessions.items()}
+                self.generation += 1
+                generation = self.generation
+                self._since_snapshot = 0
+            self._file.close()
+            self._file = open(self._segment(generation), "a", encoding="utf-8")
+
+        path = os.path.join(self.folder, "snapshot.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"generation": generation, "sessions": sessions}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        for segment, g in self._segments():
+            if g < generation:
+                os.remove(segment)
+
+
+    def close(self):
+        """
+        Flushes pending events and stops the background thread.
+        """
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        self._flusher.join()
+        with self._write_lock:
+            self._write()
+            self._file.close()
+
+
+    def _append(self, event):
+        event["t"] = time.time()
+        line = json.dumps(event, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._closed:
+                raise ValueError("Journal is closed")
+            self._buffer.append(line)
+            _fold(self.sessions, event)
+            self._since_snapshot += 1
+            if len(self._buffer) >= self.batch_size or (self.snapshot_every and self._since_snapshot >= self.snapshot_every):
+                self._wake.notify()
+
+
+    def _flush_loop(self):
+        """
+        Background thread: fsyncs pending events at least every fsync_interval and
+        takes snapshots when due.
+        """
+        while True:
+            with self._lock:
+                self._wake.wait(self.fsync_interval)
+                if self._closed:
+                    return
+                due = self.snapshot_every and self._since_snapshot >= self.snapshot_every
+            try:
+                self._sync()
+                if due:
+                    self.snapshot()
+            except OSError:
+                logger.exception("Could not write session journal '%s'", self.folder)
+
+
+    def _sync(self):
+        """
+        Writes and fsyncs the buffered events to the current segment.
+        """
+        with self._write_lock:
+            self._write()
+
+
+    def _write(self):
+        """
+        Takes the buffered events under the lock, then writes and fsyncs them
+        without it, so appends never wait for the disk. Caller holds
+        self._write_lock, which keeps the writes in order.
+        """
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+        if lines:
+            self._file.write("".join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+
+    def _expire_idle(self):
+        """
+        Drops sessions whose last event is more than ttl seconds old. Caller holds
+        the lock (or is still in __init__).
+        """
+        if self.ttl is None:
+            return
+        cutoff = time.time() - self.ttl
+        for session_id in [s for s, entry in self.sessions.items() if (entry.last_event or cutoff) < cutoff]:
+            del self.sessions[session_id]
+
+
+    def _recover(self):
+        """
+        Loads the snapshot and replays the segments after it into self.sessions.
+
+        Returns:
+            generation (int): newest generation found
+            replayed (int): number of events replayed
+        """
+        generation = 0
+        path = os.path.join(self.folder, "snapshot.json")
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            generation = data["generation"]
+            self.sessions = {s: JournalEntry.from_dict(entry) for s, entry in data["sessions"].items()}
+
+        replayed = 0
+        for segment, g in self._segments():
+            if g < generation:
+                continue
+            with open(segment, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # Torn write at a crash: the rest of this segment was never synced
+                        logger.warning("Ignoring damaged event in '%s'", segment)
+                        break
+                    _fold(self.sessions, event)
+                    replayed += 1
+            generation = max(generation, g)
+        return generation, replayed
+
+
+    def _segments(self):
+        """
+        Returns [(path, generation)] of the journal segments, oldest first.
+        """
+        segments = []
+        for segment in glob.glob(os.path.join(glob.escape(self.folder), "journal.*.log")):
+            g = os.path.basename(segment)[len("journal."):-len(".log")]
+            if g.isdigit():
+                segments.append((segment, int(g)))
+        return sorted(segments, key=lambda s: s[1])
+
+
+    def _segment(self, generation):
+        return os.path.join(self.folder, f"journal.{generation:08d}.log")
+
+
+class JournalEntry:
+    """
+    The state of one live session in the journal: what it takes to regenerate
+    its case (see app.get_case). Knowledge-base, version and test names are
+    interned, so the many sessions on one version share those strings.
+
+    Attributes:
+        kb (str): knowledge-base name
+        version (str): knowledge-base version the case was created with
+        seed (int): seed the case was generated from
+        case_id (str)
+        created_at (float): time.time() when the case was handed out, or None
+        tests (tuple): ((test name, result), ...) of the tests ordered, in order
+        diagnosed (bool): whether a diagnosis was submitted
+        last_event (float): time.time() of the session's last event, or None
+    """
+
+    __slots__ = ("kb", "version", "seed", "case_id", "created_at", "tests", "diagnosed", "last_event")
+
+    def __init__(self, kb, version, seed, case_id, created_at=None, tests=(), diagnosed=False, last_event=None):
+        self.kb = sys.intern(kb)
+        self.version = sys.intern(version)
+        self.seed = seed
+        self.case_id = case_id
+        self.created_at = created_at
+        self.tests = tuple((sys.intern(t), r) for t, r in tests)
+        self.diagnosed = diagnosed
+        self.last_event = last_event
+
+
+    def add_test(self, test_name, result):
+        """
+        Records an ordered test. A test is only ordered once per case, so
+        replaying its event again changes nothing.
+        """
+        if all(t != test_name for t, _ in self.tests):
+            self.tests += ((sys.intern(test_name), result),)
+
+
+    def to_dict(self):
+        """
+        Returns the entry as written to snapshot.json.
+        """
+        entry = {"kb": self.kb, "v": self.version, "seed": self.seed, "id": self.case_id, "c": self.created_at,
+                 "tests": dict(self.tests), "t": self.last_event}
+        if self.diagnosed:
+            entry["diagnosed"] = True
+        return entry
+
+
+    @classmethod
+    def from_dict(cls, entry):
+        """
+        Reads an entry written by to_dict.
+        """
+        return cls(entry["kb"], entry["v"], entry["seed"], entry["id"], entry.get("c"), entry["tests"].items(),
+                   entry.get("diagnosed", False), entry.get("t"))
+
+
+def _fold(sessions, event):
+    """
+    Applies one event to the session state.
+    """
+    kind, session_id = event["e"], event["s"]
+    if kind == "new":
+        # Events written before "c" was recorded: the case was handed out when the event was
+        sessions[session_id] = JournalEntry(event["kb"], event["v"], event["seed"], event["id"], event.get("c", event.get("t")),
+                                            last_event=event.get("t"))
+    elif kind == "test":
+        entry = sessions.get(session_id)
+        if entry is not None:
+            entry.add_test(event["test"], event["r"])
+            entry.last_event = event.get("t")
+    elif kind == "diagnosis":
+        entry = sessions.get(session_id)
+        if entry is not None:
+            entry.diagnosed = True
+            entry.last_event = event.get("t")
+    elif kind == "reset":
+        sessions.pop(session_id, None)
+    elif kind == "expire":
+        for s in session_id:
+            sessions.pop(s, None)
+
+
+def create_journal(folder=None, ttl=None):
+    """
+    Returns a SessionJournal for folder, or None if journaling is off.
+
+    Params:
+        folder (dir): journal folder (optional, defaults to the SYMPLI_JOURNAL
+            environment variable; journaling is off when neither is set)
+        ttl (float): seconds after its last event a session expires (optional,
+            pass the session store's ttl)
+    """
+    folder = folder or os.environ.get("SYMPLI_JOURNAL")
+    if not folder:
+        return None
+    return SessionJournal(
+        folder,
+        fsync_interval=float(os.environ.get("SYMPLI_JOURNAL_FSYNC_INTERVAL", 0.05)),
+        snapshot_every=int(os.environ.get("SYMPLI_JOURNAL_SNAPSHOT_EVERY", 100000)),
+        ttl=ttl
+    )
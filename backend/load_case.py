@@ -1,11 +1,20 @@
+import hashlib
 import json
 import random
 import os
 import math
+import numpy as np
+
+# Used for templates that leave out their prior or demographics
+DEFAULT_PRIOR = 0.1
+DEFAULT_AGE = {"mean": 50, "std": 25}
+DEFAULT_SEX_DISTRIBUTION = {"male": 0.5, "female": 0.5}
+DEFAULT_RACE_DISTRIBUTION = {"white": 0.2, "black": 0.2, "hispanic": 0.2, "asian": 0.2, "other": 0.2}
 
 def load_disease_templates(folder="digestive diseases"):
     """
-    Returns list of disease templates from given folder.
+    Returns list of disease templates from given folder, in filename order,
+    normalized with normalize_template.
 
     Params:
         folder (dir): folder with JSON disease templates.
@@ -14,14 +23,151 @@ def load_disease_templates(folder="digestive diseases"):
         templates (list): list of disease templates (dict)
     """
     templates = []
-    for filename in os.listdir(folder):
+    for filename in sorted(os.listdir(folder)):
         if filename.endswith(".json"):
             with open(os.path.join(folder, filename), 'r') as f:
-                templates.append(json.load(f))
+                templates.append(normalize_template(json.load(f)))
     return templates
 
 
-def generate_random_case(templates):
+def normalize_template(template):
+    """
+    Returns a disease template in the schema of the files in "digestive diseases/",
+    so templates written for other specialties (e.g. "other-diseases/") can be
+    loaded alongside them. The template itself is not modified.
+
+    - "disease" is accepted for "name"
+    - a missing prior or demographics get DEFAULT_PRIOR, DEFAULT_AGE and the default distributions
+    - a body temperature mean above 50 is taken as Fahrenheit and converted to Celsius
+    - a test with a single "accuracy" is binary with that sensitivity and specificity
+    - a missing "Binary" flag is inferred: tests with a sensitivity are binary, others list findings
+    - descriptive fields ("source", "description") are dropped
+
+    Params:
+        template (dict): disease template as read from JSON
+
+    Returns:
+        template (dict): normalized disease template
+    """
+    demographics = template.get("demographics", {})
+    normalized = {
+        "name": template.get("name", template.get("disease")),
+        "prior": template.get("prior", DEFAULT_PRIOR),
+        "demographics": {
+            "age": demographics.get("age", DEFAULT_AGE),
+            "sex_distribution": demographics.get("sex_distribution", DEFAULT_SEX_DISTRIBUTION),
+            "race_distribution": demographics.get("race_distribution", DEFAULT_RACE_DISTRIBUTION)
+        },
+        "symptoms": template.get("symptoms", {}),
+        "vitals": {},
+        "diagnostic_tests": {}
+    }
+
+    for vital, info in template.get("vitals", {}).items():
+        info = {k: v for k, v in info.items() if k in ("mean", "std")}
+        if vital == "body_temperature" and isinstance(info.get("mean"), (int, float)) and info["mean"] > 50:
+            info = {"mean": round((info["mean"] - 32) * 5 / 9, 2), "std": round(info.get("std", 0) * 5 / 9, 2)}
+        normalized["vitals"][vital] = info
+
+    for test_name, test_data in template.get("diagnostic_tests", {}).items():
+        if "accuracy" in test_data:
+            test_data = {"Binary": True, "sensitivity": test_data["accuracy"], "specificity": test_data["accuracy"]}
+        elif test_data.get("Binary", "sensitivity" in test_data):
+            test_data = {"Binary": True, "sensitivity": test_data.get("sensitivity"), "specificity": test_data.get("specificity")}
+        else:
+            test_data = {"Binary": False, **{f: info for f, info in test_data.items() if isinstance(info, dict)}}
+        normalized["diagnostic_tests"][test_name] = test_data
+
+    return normalized
+
+
+def template_file_stats(folder):
+    """
+    Returns (mtime, size) of every JSON template in folder, used to tell whether
+    templates changed since they were loaded.
+
+    Params:
+        folder (dir): folder with JSON disease templates.
+
+    Returns:
+        stats (dict): {filename: (mtime_ns, size)}, sorted by filename
+    """
+    stats = {}
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith(".json"):
+            st = os.stat(os.path.join(folder, filename))
+            stats[filename] = (st.st_mtime_ns, st.st_size)
+    return stats
+
+
+def templates_fingerprint(stats):
+    """
+    Returns a short version string for a set of template files.
+
+    Params:
+        stats (dict): {filename: (mtime_ns, size)} from template_file_stats
+
+    Returns:
+        fingerprint (str)
+    """
+    return hashlib.sha1(repr(sorted((f, tuple(s)) for f, s in stats.items())).encode()).hexdigest()[:12]
+
+
+def validate_template(template):
+    """
+    Checks a disease template against the schema the rest of the app relies on.
+
+    Params:
+        template (dict): disease template
+
+    Returns:
+        problems (list): descriptions of everything wrong with it; empty if valid
+    """
+    problems = []
+
+    def probability(value, where):
+        if not isinstance(value, (int, float)) or not 0 <= value <= 1:
+            problems.append(f"{where} must be a probability between 0 and 1")
+
+    def distribution(value, where):
+        if not isinstance(value, dict) or not isinstance(value.get("mean"), (int, float)) or not isinstance(value.get("std"), (int, float)) or value["std"] <= 0:
+            problems.append(f"{where} must have a numeric mean and a positive std")
+
+    if not isinstance(template.get("name"), str):
+        problems.append("name is missing")
+    if not isinstance(template.get("prior"), (int, float)) or template["prior"] <= 0:
+        problems.append("prior must be a positive number")
+
+    demographics = template.get("demographics", {})
+    distribution(demographics.get("age"), "demographics.age")
+    for key in ("sex_distribution", "race_distribution"):
+        for value, p in demographics.get(key, {}).items():
+            probability(p, f"demographics.{key}.{value}")
+        if not demographics.get(key):
+            problems.append(f"demographics.{key} is missing")
+
+    for symptom, info in template.get("symptoms", {}).items():
+        probability(info.get("probability"), f"symptoms.{symptom}.probability")
+
+    for vital, info in template.get("vitals", {}).items():
+        distribution(info, f"vitals.{vital}")
+
+    for test_name, test_data in template.get("diagnostic_tests", {}).items():
+        if "Binary" not in test_data:
+            problems.append(f"diagnostic_tests.{test_name}.Binary is missing")
+        elif test_data["Binary"]:
+            probability(test_data.get("sensitivity"), f"diagnostic_tests.{test_name}.sensitivity")
+            probability(test_data.get("specificity"), f"diagnostic_tests.{test_name}.specificity")
+        else:
+            for finding, info in test_data.items():
+                if finding != "Binary":
+                    probability(info.get("sensitivity"), f"diagnostic_tests.{test_name}.{finding}.sensitivity")
+                    probability(info.get("specificity"), f"diagnostic_tests.{test_name}.{finding}.specificity")
+
+    return problems
+
+
+def generate_random_case(templates, rng=random):
     """
     Randomly selects case from templates based on priors in population, generates
     demographics, symptoms, and vitals from probabilities in the case template. Case
@@ -29,6 +175,7 @@ def generate_random_case(templates):
 
     Params:
         templates (list): list of disease templates (dict)
+        rng (random.Random): source of randomness (optional, defaults to the random module)
 
     Returns:
         case (dict): {"name", "probabilities", "demographics", "symptoms", "vitals", "tests"}
@@ -42,7 +189,7 @@ def generate_random_case(templates):
     probs = {k: v / total for k, v in probs.items()}
 
     # Use random.choices to pick a disease using priors
-    disease_name = random.choices(
+    disease_name = rng.choices(
         population=list(probs.keys()),
         weights=list(probs.values()),
         k=1
@@ -60,16 +207,16 @@ def generate_random_case(templates):
     probs = dict(sorted(probs.items()))
 
     # Demographics
-    age = int(random.gauss(disease_template["demographics"]["age"]["mean"], disease_template["demographics"]["age"]["std"]))
+    age = int(rng.gauss(disease_template["demographics"]["age"]["mean"], disease_template["demographics"]["age"]["std"]))
     if age < 0:
         age = 0
 
-    sex = random.choices(
+    sex = rng.choices(
         population=list(disease_template["demographics"]["sex_distribution"].keys()),
         weights=list(disease_template["demographics"]["sex_distribution"].values())
     )[0]
 
-    race = random.choices(
+    race = rng.choices(
         population=list(disease_template["demographics"]["race_distribution"].keys()),
         weights=list(disease_template["demographics"]["race_distribution"].values())
     )[0]
@@ -77,17 +224,13 @@ def generate_random_case(templates):
     # Symptoms
     symptoms = {}
     for symptom, info in disease_template["symptoms"].items():
-        symptoms[symptom] = random.random() < info["probability"]  # True with given probability
+        symptoms[symptom] = rng.random() < info["probability"]  # True with given probability
 
     # Vitals
     vitals_template = disease_template["vitals"]
-    vitals = {
-        "body_temperature": int(random.gauss(vitals_template["body_temperature"]["mean"], vitals_template["body_temperature"]["std"])),
-        "pulse": int(random.gauss(vitals_template["pulse"]["mean"], vitals_template["pulse"]["std"])),
-        "respiratory_rate": int(random.gauss(vitals_template["respiratory_rate"]["mean"], vitals_template["respiratory_rate"]["std"])),
-        "blood_pressure_systolic": int(random.gauss(vitals_template["blood_pressure_systolic"]["mean"], vitals_template["blood_pressure_systolic"]["std"])),
-        "blood_pressure_diastolic": int(random.gauss(vitals_template["blood_pressure_diastolic"]["mean"], vitals_template["blood_pressure_diastolic"]["std"]))
-    }
+    vitals = {}
+    for vital, info in vitals_template.items():
+        vitals[vital] = int(rng.gauss(info["mean"], info["std"]))
 
     return {
         "name": disease_template["name"],
@@ -102,6 +245,258 @@ def generate_random_case(templates):
         "tests": {}
     }
 
+
+def sample_test_result(test_data, rng=random):
+    """
+    Randomly generates the result of a test for a patient with the disease that
+    test_data belongs to, based on sensitivity.
+
+    Params:
+        test_data (dict): the disease template's entry for the test
+        rng (random.Random): source of randomness (optional, defaults to the random module)
+
+    Returns:
+        result (str/list): "positive"/"negative" for binary tests, list of findings otherwise
+    """
+    if test_data["Binary"]:
+        return "positive" if rng.random() < test_data["sensitivity"] else "negative"
+
+    result = []
+    for finding in test_data:
+        if finding != "Binary":
+            if rng.random() < test_data[finding]["sensitivity"]:
+                result.append(finding)
+    return result
+
+
+# Vital names of hand-written cases (like sample_case.json) => template vital names
+SAMPLE_CASE_VITALS = {"heart_rate": "pulse", "pulse": "pulse", "temperature": "body_temperature",
+                      "body_temperature": "body_temperature", "respiratory_rate": "respiratory_rate"}
+
+# Free-text results read as a negative binary test; any other text describes a positive one
+NEGATIVE_RESULTS = ("negative", "normal", "unremarkable", "not detected", "none", "absent")
+
+
+def convert_sample_case(sample, templates):
+    """
+    Converts a hand-written case in the format of sample_case.json into the
+    case format of generate_random_case, so it can be scored like a generated one.
+
+    - symptoms listed as phrases ("chest pain") become {"chest_pain": True}; unlisted symptoms are unknown, not absent
+    - "gender" is the sex; a missing race is "unknown" (every disease gets the default probability)
+    - heart_rate and temperature map to pulse and body_temperature (Fahrenheit above 50, converted to
+      Celsius as in normalize_template), and "140/90" blood pressure to systolic and diastolic
+    - free-text test results are read as "negative" if they start with a word in NEGATIVE_RESULTS and
+      "positive" otherwise; for multi-finding tests, the findings whose names appear in the text.
+      A result that is already "positive"/"negative" or a list is kept.
+      Tests no template lists are dropped.
+
+    Params:
+        sample (dict): case as in sample_case.json
+        templates (list): disease templates the case will be scored against
+
+    Returns:
+        case (dict): {"name", "demographics", "symptoms", "vitals", "tests"}; name is the sample's diagnosis
+    """
+    vitals = {}
+    for vital, value in sample.get("vitals", {}).items():
+        if vital == "blood_pressure" and isinstance(value, str) and "/" in value:
+            systolic, diastolic = value.split("/", 1)
+            vitals["blood_pressure_systolic"] = float(systolic)
+            vitals["blood_pressure_diastolic"] = float(diastolic)
+            continue
+        vital = SAMPLE_CASE_VITALS.get(vital, vital)
+        if vital == "body_temperature" and value > 50:
+            value = round((value - 32) * 5 / 9, 2)
+        vitals[vital] = value
+
+    test_kinds = {}
+    for template in templates:
+        for test_name, test_data in template["diagnostic_tests"].items():
+            test_kinds.setdefault(test_name, test_data)
+
+    tests = {}
+    for test_name, result in sample.get("tests", {}).items():
+        test_data = test_kinds.get(test_name)
+        if test_data is None:
+            continue
+        if isinstance(result, list) or result in ("positive", "negative"):
+            tests[test_name] = result
+        elif test_data["Binary"]:
+            tests[test_name] = "negative" if result.lower().startswith(NEGATIVE_RESULTS) else "positive"
+        else:
+            text = result.lower().replace("_", " ")
+            tests[test_name] = [f for f in test_data if f != "Binary" and f.lower().replace("_", " ") in text]
+
+    return {
+        "name": sample.get("diagnosis"),
+        "demographics": {
+            "age": sample.get("age", DEFAULT_AGE["mean"]),
+            "sex": sample.get("gender", sample.get("sex")),
+            "race": sample.get("race", "unknown")
+        },
+        "symptoms": {s.strip().lower().replace(" ", "_"): True for s in sample.get("symptoms", [])},
+        "vitals": vitals,
+        "tests": tests
+    }
+
+
+def build_alias_table(weights):
+    """
+    Builds a Walker/Vose alias table for sampling indices in proportion to weights
+    in O(1) per draw.
+
+    Params:
+        weights (list/np.ndarray): non-negative weights, not necessarily normalized
+
+    Returns:
+        prob (np.ndarray): acceptance probability of each column
+        alias (np.ndarray): index used when column i is rejected
+    """
+    weights = np.asarray(weights, dtype=float)
+    k = len(weights)
+    scaled = weights * (k / weights.sum())
+    prob = np.ones(k)
+    alias = np.arange(k)
+
+    small = [i for i in range(k) if scaled[i] < 1.0]
+    large = [i for i in range(k) if scaled[i] >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1.0 - scaled[s]
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+
+    return prob, alias
+
+
+def sample_alias(prob, alias, n, rng):
+    """
+    Draws n indices from an alias table.
+
+    Params:
+        prob, alias (np.ndarray): table from build_alias_table
+        n (int): number of draws
+        rng (np.random.Generator)
+
+    Returns:
+        indices (np.ndarray): (n,) sampled indices
+    """
+    columns = rng.integers(0, len(prob), size=n)
+    accept = rng.random(n) < prob[columns]
+    return np.where(accept, columns, alias[columns])
+
+
+class CaseSampler:
+    """
+    Sampling tables for a list of disease templates: an alias table over the
+    disease priors, and per template alias tables for sex and race plus arrays of
+    symptom probabilities and vital means/stds. Build once and reuse for every
+    call to generate_cases.
+    """
+
+    def __init__(self, templates):
+        self.templates = templates
+
+        priors = np.array([d["prior"] for d in templates], dtype=float)
+        self.disease_prob, self.disease_alias = build_alias_table(priors)
+
+        # Normalized priors in the same shape generate_random_case returns them
+        total = priors.sum()
+        self.probabilities = dict(sorted((d["name"], d["prior"] / total) for d in templates))
+
+        self.tables = []
+        for d in templates:
+            sex_distribution = d["demographics"]["sex_distribution"]
+            race_distribution = d["demographics"]["race_distribution"]
+            self.tables.append({
+                "age": (d["demographics"]["age"]["mean"], d["demographics"]["age"]["std"]),
+                "sexes": list(sex_distribution),
+                "sex_alias": build_alias_table(list(sex_distribution.values())),
+                "races": list(race_distribution),
+                "race_alias": build_alias_table(list(race_distribution.values())),
+                "symptoms": list(d["symptoms"]),
+                "symptom_probs": np.array([s["probability"] for s in d["symptoms"].values()], dtype=float),
+                "vitals": list(d["vitals"]),
+                "vital_mean": np.array([v["mean"] for v in d["vitals"].values()], dtype=float),
+                "vital_std": np.array([v["std"] for v in d["vitals"].values()], dtype=float)
+            })
+
+
+    def sample(self, n, rng):
+        """
+        Draws n cases. Cases of the same disease are generated together, so the
+        work is one vectorized pass per disease that was drawn.
+
+        Params:
+            n (int): number of cases
+            rng (np.random.Generator)
+
+        Returns:
+            cases (list): list of case dicts, same shape as generate_random_case
+        """
+        diseases = sample_alias(self.disease_prob, self.disease_alias, n, rng)
+        cases = [None] * n
+
+        for d in np.unique(diseases):
+            rows = np.flatnonzero(diseases == d)
+            k = len(rows)
+            table = self.tables[d]
+            name = self.templates[d]["name"]
+
+            ages = np.maximum(np.trunc(rng.normal(table["age"][0], table["age"][1], size=k)), 0).astype(int).tolist()
+            sexes = sample_alias(*table["sex_alias"], k, rng).tolist()
+            races = sample_alias(*table["race_alias"], k, rng).tolist()
+            symptoms = (rng.random((k, len(table["symptoms"]))) < table["symptom_probs"]).tolist()
+            vitals = np.trunc(rng.normal(table["vital_mean"], table["vital_std"], size=(k, len(table["vitals"])))).astype(int).tolist()
+
+            for j, row in enumerate(rows.tolist()):
+                cases[row] = {
+                    "name": name,
+                    "probabilities": self.probabilities,
+                    "demographics": {
+                        "age": ages[j],
+                        "sex": table["sexes"][sexes[j]],
+                        "race": table["races"][races[j]]
+                        },
+                    "symptoms": dict(zip(table["symptoms"], symptoms[j])),
+                    "vitals": dict(zip(table["vitals"], vitals[j])),
+                    "tests": {}
+                }
+
+        return cases
+
+
+def generate_cases(templates, n, sampler=None, rng=None):
+    """
+    Generates n random cases in one batch. Equivalent to calling
+    generate_random_case n times, but the sampling tables are built once and the
+    draws are vectorized.
+
+    Note that every returned case shares the same "probabilities" dict (the
+    normalized priors); copy it before modifying.
+
+    Params:
+        templates (list): list of disease templates (dict)
+        n (int): number of cases
+        sampler (CaseSampler): prebuilt sampling tables for templates (optional)
+        rng (np.random.Generator/int): random generator or seed (optional)
+
+    Returns:
+        cases (list): list of {"name", "probabilities", "demographics", "symptoms", "vitals", "tests"}
+    """
+    if sampler is None:
+        sampler = CaseSampler(templates)
+    if not isinstance(rng, np.random.Generator):
+        rng = np.random.default_rng(rng)
+    return sampler.sample(n, rng)
+
+
 if __name__ == "__main__":
     templates = load_disease_templates()
     case = generate_random_case(templates)
@@ -0,0 +1,268 @@
+import functools
+import sys
+import threading
+import time
+from flask import g, request
+
+# Serialises instrument_functions, so concurrent callers do not wrap a function twice
+_instrument_lock = threading.Lock()
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Sharded:
+    """
+    Base for metrics that are written without locks: each thread updates its own
+    shard and render() sums the shards. The lock is only taken when a thread
+    writes for the first time, which also folds the shards of finished threads
+    into one, so the number of shards tracks the number of live threads.
+    """
+
+    def __init__(self, name, help, labelnames):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []  # (thread, shard)
+        self._retired = {}
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                alive = []
+                for thread, other in self._shards:
+                    if thread.is_alive():
+                        alive.append((thread, other))
+                    else:
+                        self._merge(self._retired, other)
+                alive.append((threading.current_thread(), shard))
+                self._shards = alive
+        return shard
+
+    def _collect(self):
+        """
+        Returns the sum of every shard: {label values: value}.
+        """
+        with self._lock:
+            shards = [self._retired] + [s for _, s in self._shards]
+        total = {}
+        for shard in shards:
+            self._merge(total, dict(shard))
+        return total
+
+    def _labels(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter(_Sharded):
+    """
+    Monotonic counter, optionally labelled.
+    """
+
+    def inc(self, *labelvalues, amount=1):
+        shard = self._shard()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+    def _merge(self, into, shard):
+        for key, value in shard.items():
+            into[key] = into.get(key, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._collect().items()):
+            lines.append(f"{self.name}{self._labels(key)} {_number(value)}")
+        return lines
+
+
+class Histogram(_Sharded):
+    """
+    Histogram with fixed buckets, optionally labelled.
+    """
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        shard = self._shard()
+        counts = shard.get(labelvalues)
+        if counts is None:
+            # One count per bucket, then +Inf, sum
+            counts = shard[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[len(self.buckets)] += 1
+        counts[-1] += value
+
+    def _merge(self, into, shard):
+        for key, counts in shard.items():
+            total = into.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, c in enumerate(counts):
+                total[i] += c
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, counts in sorted(self._collect().items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                lines.append(f"{self.name}_bucket{self._labels(key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """
+    Value read from a callback at scrape time. The callback returns a number, or
+    {label values (tuple): number} for a labelled gauge.
+    """
+
+    def __init__(self, name, help, callback, labelnames=()):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        value = self.callback()
+        values = value if isinstance(value, dict) else {(): value}
+        for key, v in sorted(values.items()):
+            labels = ",".join(f'{k}="{_escape(x)}"' for k, x in zip(self.labelnames, key))
+            lines.append(f"{self.name}{'{' + labels + '}' if labels else ''} {_number(v)}")
+        return lines
+
+
+class Registry:
+    """
+    Ordered collection of metrics rendered together in Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, callback, labelnames=()):
+        return self._add(Gauge(name, help, callback, labelnames))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+def timed(histogram, label):
+    """
+    Decorator observing each call's duration in histogram under label.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, label)
+        wrapper.__wrapped_by_metrics__ = True
+        return wrapper
+    return decorate
+
+
+def instrument_functions(histogram, targets):
+    """
+    Replaces functions (or methods) with timed wrappers, in place, so existing
+    callers are measured without changes. This affects every caller in the
+    process, so servers call it when they start rather than on import. Already
+    instrumented functions are skipped.
+
+    Params:
+        histogram (Histogram): histogram with one label (the function)
+        targets (list): (owner, attribute name, label) where owner is a module or class
+    """
+    with _instrument_lock:
+        for owner, attr, label in targets:
+            func = getattr(owner, attr)
+            if not getattr(func, "__wrapped_by_metrics__", False):
+                setattr(owner, attr, timed(histogram, label)(func))
+
+
+def instrument_app(app, registry):
+    """
+    Times every request by route and method and counts responses by status.
+    The timer starts before any other before_request hook.
+
+    Params:
+        app (Flask)
+        registry (Registry)
+    """
+    latency = registry.histogram("sympli_request_duration_seconds", "Request latency by route.", ("route", "method"))
+    responses = registry.counter("sympli_responses_total", "Responses by route and status code.", ("route", "method", "status"))
+
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    def observe(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            latency.observe(time.perf_counter() - start, route, request.method)
+            responses.inc(route, request.method, str(response.status_code))
+        return response
+
+    app.before_request_funcs.setdefault(None, []).insert(0, start_timer)
+    app.after_request(observe)
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Approximate memory in bytes held by obj and everything it references
+    (containers, and numpy arrays via nbytes).
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "nbytes") and hasattr(obj, "dtype"):
+        return size + (obj.nbytes if obj.base is None else 0)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(x, seen) for x in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_sizeof(getattr(obj, s), seen) for s in obj.__slots__ if hasattr(obj, s))
+    return size
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value) if value == value and abs(value) != float("inf") else ("+Inf" if value > 0 else "-Inf" if value < 0 else "NaN")
+    return str(value)
@@ -0,0 +1,722 @@
+import math
+import numpy as np
+import bayes
+
+# Log likelihood of a sex/race value, symptom or binary test result for a disease that does not list it
+_LOG_DEFAULT_CATEGORY = math.log(bayes.DEFAULT_CATEGORY_PROBABILITY)
+_LOG_DEFAULT_SYMPTOM_PRESENT = math.log(bayes.DEFAULT_SYMPTOM_PROBABILITY)
+_LOG_DEFAULT_SYMPTOM_ABSENT = math.log1p(-bayes.DEFAULT_SYMPTOM_PROBABILITY)
+_LOG_DEFAULT_POSITIVE = math.log(bayes.DEFAULT_TEST_SENSITIVITY)
+_LOG_DEFAULT_NEGATIVE = math.log1p(-bayes.DEFAULT_TEST_SPECIFICITY)
+
+# Integer ranges (inclusive) over which age and the standard vitals get
+# log-density tables; other vitals are tabulated over their means +- TABLE_SPREAD std
+AGE_RANGE = (0, 120)
+VITAL_RANGES = {
+    "body_temperature": (30, 45),
+    "pulse": (20, 250),
+    "respiratory_rate": (4, 70),
+    "blood_pressure_systolic": (50, 260),
+    "blood_pressure_diastolic": (20, 160)
+}
+TABLE_SPREAD = 6
+MAX_TABLE_WIDTH = 512
+
+class CompiledModel:
+    """
+    Array layout of a list of disease templates. Built once from
+    load_case.load_disease_templates() and used to score every disease for a
+    presentation in a few array operations.
+
+    Templates do not have to list the same features. Every vocabulary (sexes,
+    races, symptoms, vitals, tests) is the union over all templates, and a
+    feature a disease does not specify takes the defaults in bayes
+    (DEFAULT_SYMPTOM_PROBABILITY, DEFAULT_CATEGORY_PROBABILITY,
+    DEFAULT_TEST_SENSITIVITY/SPECIFICITY; unlisted vitals and multi-finding tests
+    contribute nothing). Symptoms, vitals and tests are stored sparsely, as the
+    (disease, value) entries that templates actually list, so scoring costs
+    O(listed entries of the features in a case) rather than diseases x vocabulary.
+
+    Symptoms and vitals are stored column by column (compressed sparse columns):
+    the entries of column j are positions ptr[j]:ptr[j + 1] of the rows and value
+    arrays.
+
+    The dict-based functions in bayes are the reference implementation; the
+    methods here must return the same likelihoods.
+
+    Attributes:
+        names (list): disease names, in template order (row order of every array)
+        priors (np.ndarray): (diseases,) prior of each disease
+        log_priors (np.ndarray): (diseases,) log of priors
+        age_mean, age_std (np.ndarray): (diseases,) age distribution of each disease
+        sexes, races (list): column order of sex_probs and race_probs
+        sex_probs, race_probs (np.ndarray): (diseases, sexes/races) P(sex|disease), P(race|disease)
+        symptoms (list): symptom vocabulary, column order of symptom_ptr
+        symptom_ptr, symptom_rows, symptom_probs (np.ndarray): P(symptom|disease) of every listed (disease, symptom)
+        vitals (list): vital vocabulary, column order of vital_ptr
+        vital_ptr, vital_rows, vital_mean, vital_std (np.ndarray): distribution of every listed (disease, vital)
+        age_table (np.ndarray): (AGE_RANGE values, diseases) log density of each integer age
+        vital_table, vital_table_ptr, vital_table_low, vital_table_width (np.ndarray): log density
+            tables of the vitals, see _vital_tables
+        tests (dict): test name => compiled test, see _compile_test
+    """
+
+    # Result-set cache size per multi-finding test
+    MAX_CACHED_RESULTS = 4096
+
+    # Most bytes of vital log-density tables per model; vitals that do not fit are
+    # scored analytically. A reloader retains up to 16 versions, and versions
+    # whose vitals did not change share one set of tables (see __init__).
+    MAX_TABLE_BYTES = 16 << 20
+
+    # Attributes written to and read back from snapshots (see to_arrays/from_arrays)
+    TABLES = ["names", "sexes", "races", "symptoms", "vitals"]
+    ARRAYS = ["priors", "log_priors", "age_mean", "age_std", "sex_probs", "race_probs",
+              "symptom_ptr", "symptom_rows", "symptom_probs", "vital_ptr", "vital_rows", "vital_mean", "vital_std",
+              "_log_sex_probs", "_log_race_probs", "_symptom_present_delta", "_symptom_absent_delta",
+              "age_table", "vital_table", "vital_table_ptr", "vital_table_low", "vital_table_width"]
+
+    def __init__(self, templates, previous=None):
+        self.templates = templates
+        self.names = [d["name"] for d in templates]
+
+        self.priors = np.array([d["prior"] for d in templates], dtype=float)
+
+        self.age_mean = np.array([d["demographics"]["age"]["mean"] for d in templates], dtype=float)
+        self.age_std = np.array([d["demographics"]["age"]["std"] for d in templates], dtype=float)
+
+        self.sexes = _vocabulary(d["demographics"]["sex_distribution"] for d in templates)
+        self.races = _vocabulary(d["demographics"]["race_distribution"] for d in templates)
+        self.symptoms = _vocabulary(d["symptoms"] for d in templates)
+        self.vitals = _vocabulary(d["vitals"] for d in templates)
+
+        # Sex and race have few values, so they stay dense with the default filled in
+        self.sex_probs = _table(templates, self.sexes, lambda d, k: d["demographics"]["sex_distribution"].get(k, bayes.DEFAULT_CATEGORY_PROBABILITY))
+        self.race_probs = _table(templates, self.races, lambda d, k: d["demographics"]["race_distribution"].get(k, bayes.DEFAULT_CATEGORY_PROBABILITY))
+
+        self.symptom_ptr, self.symptom_rows, (self.symptom_probs,) = _sparse_columns(
+            templates, self.symptoms, lambda d: d["symptoms"], ["probability"])
+        self.vital_ptr, self.vital_rows, (self.vital_mean, self.vital_std) = _sparse_columns(
+            templates, self.vitals, lambda d: d["vitals"], ["mean", "std"])
+
+        # Probabilities of exactly 0 or 1 are allowed and map to -inf. Symptom
+        # entries are stored relative to the default, which every case symptom
+        # contributes to every disease.
+        with np.errstate(divide="ignore"):
+            self.log_priors = np.log(self.priors)
+            self._log_sex_probs = np.log(self.sex_probs)
+            self._log_race_probs = np.log(self.race_probs)
+            self._symptom_present_delta = np.log(self.symptom_probs) - _LOG_DEFAULT_SYMPTOM_PRESENT
+            self._symptom_absent_delta = np.log1p(-self.symptom_probs) - _LOG_DEFAULT_SYMPTOM_ABSENT
+
+        # Cases have integer ages and vitals, so their log densities are looked
+        # up rather than computed; values outside the tables are computed. The
+        # tables are the largest arrays of a model, so they are taken over from
+        # previous when what they are built from is unchanged
+        if previous is not None and _equal_arrays(previous, self, ["age_mean", "age_std"]):
+            self.age_table = previous.age_table
+        else:
+            ages = np.arange(AGE_RANGE[0], AGE_RANGE[1] + 1, dtype=float)
+            self.age_table = log_normal_pdf(ages[:, None], self.age_mean, self.age_std)
+        if previous is not None and previous.vitals == self.vitals and _equal_arrays(previous, self, ["vital_ptr", "vital_mean", "vital_std"]):
+            self.vital_table, self.vital_table_ptr, self.vital_table_low, self.vital_table_width = (
+                previous.vital_table, previous.vital_table_ptr, previous.vital_table_low, previous.vital_table_width)
+        else:
+            self.vital_table, self.vital_table_ptr, self.vital_table_low, self.vital_table_width = _vital_tables(
+                self.vitals, self.vital_ptr, self.vital_mean, self.vital_std, self.MAX_TABLE_BYTES)
+
+        self._build_indexes()
+        self._test_entries = _test_entries(templates)
+
+        # A compiled test (and its likelihood cache) is reused from previous when
+        # the diseases are unchanged and every template's entry for the test is equal
+        reusable = previous is not None and previous.names == self.names
+        self.tests = {}
+        for t, entries in self._test_entries.items():
+            old_entries = previous._entries(t) if reusable else None
+            if old_entries is not None and all(a is b or a == b for a, b in zip(old_entries, entries)):
+                self.tests[t] = previous.tests[t]
+            else:
+                self.tests[t] = _compile_test(templates, t)
+
+
+    def _build_indexes(self):
+        """
+        Builds the name => position lookups. Shared by __init__ and from_arrays.
+        """
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self._lower_index = {name.lower(): i for i, name in enumerate(self.names)}
+        self._sex_index = {k: i for i, k in enumerate(self.sexes)}
+        self._race_index = {k: i for i, k in enumerate(self.races)}
+        self._symptom_index = {k: i for i, k in enumerate(self.symptoms)}
+        self._vital_index = {k: i for i, k in enumerate(self.vitals)}
+        self._disease_tests = None
+        self._largest = {}
+
+
+    def to_arrays(self):
+        """
+        Splits the model into name tables and numeric arrays, e.g. for writing a snapshot.
+
+        Returns:
+            tables (dict): JSON-serialisable name tables and test layout
+            arrays (dict): name => np.ndarray
+        """
+        tables = {k: getattr(self, k) for k in self.TABLES}
+        tables["tests"] = {}
+        arrays = {k: getattr(self, k) for k in self.ARRAYS}
+        for t, test in self.tests.items():
+            names = [k for k, v in test.items() if isinstance(v, np.ndarray)]
+            tables["tests"][t] = {"binary": test["binary"], "findings": test["findings"], "arrays": names}
+            for k in names:
+                arrays[f"tests/{t}/{k}"] = test[k]
+        return tables, arrays
+
+
+    @classmethod
+    def from_arrays(cls, tables, arrays, templates=None):
+        """
+        Rebuilds a model from the output of to_arrays without recompiling. The
+        arrays are used as given (e.g. read-only views of a memory-mapped file).
+
+        Params:
+            tables (dict): name tables, see to_arrays
+            arrays (dict): name => np.ndarray, see to_arrays
+            templates (list): list of disease templates (dict) the model was compiled from
+                (optional; snapshots do not store them, see diagnostic_tests)
+
+        Returns:
+            model (CompiledModel)
+        """
+        self = cls.__new__(cls)
+        self.templates = templates
+        for k in cls.TABLES:
+            setattr(self, k, tables[k])
+        for k in cls.ARRAYS:
+            setattr(self, k, arrays[k])
+        self._build_indexes()
+        self._test_entries = _test_entries(templates) if templates is not None else None
+
+        self.tests = {}
+        for t, layout in tables["tests"].items():
+            test = {"binary": layout["binary"], "findings": layout["findings"]}
+            for k in layout["arrays"]:
+                test[k] = arrays[f"tests/{t}/{k}"]
+            if not layout["binary"]:
+                test["finding_index"] = {f: i for i, f in enumerate(layout["findings"])}
+                test["cache"] = {}
+            self.tests[t] = test
+        return self
+
+
+    def template_for(self, name):
+        """
+        Returns the template of the disease called name (case-insensitive), or None.
+        Only for models compiled from templates; see diagnostic_tests.
+        """
+        i = self._lower_index.get(name.lower())
+        return None if i is None else self.templates[i]
+
+
+    def diagnostic_tests(self, name):
+        """
+        Returns the "diagnostic_tests" of the disease called name (case-insensitive)
+        as in its template, or None. Models read from a snapshot have no templates,
+        so their entries are rebuilt from the compiled tests.
+
+        Returns:
+            tests (dict): test name => entry, e.g. {"Binary": True, "sensitivity", "specificity"}
+        """
+        i = self._lower_index.get(name.lower())
+        if i is None:
+            return None
+        if self.templates is not None:
+            return self.templates[i]["diagnostic_tests"]
+        if self._disease_tests is None:
+            disease_tests = [{} for _ in self.names]
+            for t, test in self.tests.items():
+                for position, row in enumerate(test["rows"].tolist()):
+                    disease_tests[row][t] = position
+            self._disease_tests = disease_tests
+        return {t: self._test_entry(t, position) for t, position in self._disease_tests[i].items()}
+
+
+    def _test_entry(self, test_name, position):
+        """
+        Rebuilds the template entry of a test for the disease in row `position` of
+        the compiled test.
+        """
+        test = self.tests[test_name]
+        if test["binary"]:
+            return {"Binary": True, "sensitivity": float(test["sensitivity"][position]), "specificity": float(test["specificity"][position])}
+        entry = {"Binary": False}
+        for j in np.flatnonzero(test["listed"][position]).tolist():
+            entry[test["findings"][j]] = {"sensitivity": float(test["sensitivity"][position, j]), "specificity": float(test["specificity"][position, j])}
+        return entry
+
+
+    def _entries(self, test_name):
+        """
+        Returns every disease's template entry for a test (None where it is not
+        listed), or None if no disease lists it; used to tell whether a test changed.
+        """
+        if self._test_entries is not None:
+            return self._test_entries.get(test_name)
+        test = self.tests.get(test_name)
+        if test is None:
+            return None
+        entries = [None] * len(self.names)
+        for position, row in enumerate(test["rows"].tolist()):
+            entries[row] = self._test_entry(test_name, position)
+        return entries
+
+
+    def test_log_likelihood(self, test_name, result):
+        """
+        Computes log P(test result|disease) sparsely: every disease gets base,
+        and the diseases in rows additionally get values. Same model as
+        bayes.comp_test_likelihood. Binary outcomes are precomputed and
+        multi-finding results are cached by their set of findings, so repeated
+        orders cost a dict lookup.
+
+        Params:
+            test_name (str): name of test
+            result (str/list): "positive"/"negative" for binary tests, list of findings otherwise
+
+        Returns:
+            base (float): log likelihood of the diseases that do not list the test
+            rows (np.ndarray): positions of the diseases that list the test
+            values (np.ndarray): (rows,) read-only log likelihood of those diseases, relative to base
+        """
+        test = self.tests[test_name]
+        if test["binary"]:
+            if result == "positive":
+                return _LOG_DEFAULT_POSITIVE, test["rows"], test["log_positive"]
+            return _LOG_DEFAULT_NEGATIVE, test["rows"], test["log_negative"]
+
+        key = frozenset(result)
+        cached = test["cache"].get(key)
+        if cached is None:
+            columns = [test["finding_index"][f] for f in key if f in test["finding_index"]]
+            cached = test["log_base"] + test["log_delta"][:, columns].sum(axis=1)
+            cached.flags.writeable = False
+            if len(test["cache"]) >= self.MAX_CACHED_RESULTS:
+                test["cache"].clear()
+            test["cache"][key] = cached
+        return 0.0, test["rows"], cached
+
+
+    def test_log_likelihood_max(self, test_name, result):
+        """
+        Returns the largest of the values test_log_likelihood gives, cached like
+        the values themselves, so LogPosterior can bound the diseases it parks
+        without a pass over them.
+
+        Params:
+            test_name (str): name of test
+            result (str/list): "positive"/"negative" for binary tests, list of findings otherwise
+        """
+        key = (test_name, result if self.tests[test_name]["binary"] else frozenset(result))
+        largest = self._largest.get(key)
+        if largest is None:
+            values = self.test_log_likelihood(test_name, result)[2]
+            largest = float(values.max()) if len(values) else 0.0
+            if len(self._largest) >= self.MAX_CACHED_RESULTS:
+                self._largest.clear()
+            self._largest[key] = largest
+        return largest
+
+
+    def test_log_likelihood_array(self, test_name, result):
+        """
+        Dense form of test_log_likelihood.
+
+        Params:
+            test_name (str): name of test
+            result (str/list): "positive"/"negative" for binary tests, list of findings otherwise
+
+        Returns:
+            log_likelihoods (np.ndarray): (diseases,) log likelihood factor, in self.names order
+        """
+        base, rows, values = self.test_log_likelihood(test_name, result)
+        log_likelihood = np.full(len(self.names), base)
+        log_likelihood[rows] += values
+        return log_likelihood
+
+
+    def symptom_entries(self, symptom):
+        """
+        Returns the diseases that list symptom and their P(symptom|disease).
+
+        Returns:
+            rows (np.ndarray): positions of the diseases that list the symptom (empty if none do)
+            probs (np.ndarray): (rows,) P(symptom|disease)
+        """
+        j = self._symptom_index.get(symptom)
+        if j is None:
+            return self.symptom_rows[:0], self.symptom_probs[:0]
+        entries = slice(self.symptom_ptr[j], self.symptom_ptr[j + 1])
+        return self.symptom_rows[entries], self.symptom_probs[entries]
+
+
+    def dense_test(self, test_name):
+        """
+        Returns a test with one row per disease (built on first use and kept on the
+        compiled test), for code that scores every disease anyway, like recommend.
+
+        Binary tests have "sensitivity", "specificity" (defaults for diseases
+        without the test), "log_positive" and "log_negative". Multi-finding tests
+        have "listed", "sensitivity", "specificity" (NaN where not listed),
+        "log_base" and "log_delta" (zero where not listed), so their log likelihood
+        for a set of findings R is log_base + sum of log_delta over the columns in R.
+
+        Returns:
+            test (dict): {"binary", "findings", ...} with (diseases,) or (diseases, findings) arrays
+        """
+        test = self.tests[test_name]
+        dense = test.get("dense")
+        if dense is not None:
+            return dense
+
+        n, rows = len(self.names), test["rows"]
+        dense = {"binary": test["binary"], "findings": test["findings"]}
+        if test["binary"]:
+            for k, default in (("sensitivity", bayes.DEFAULT_TEST_SENSITIVITY), ("specificity", bayes.DEFAULT_TEST_SPECIFICITY),
+                               ("log_positive", _LOG_DEFAULT_POSITIVE), ("log_negative", _LOG_DEFAULT_NEGATIVE)):
+                dense[k] = np.full(n, default)
+                dense[k][rows] = test[k] + (default if k.startswith("log") else 0.0)
+        else:
+            shape = (n, len(test["findings"]))
+            for k, shape, fill in (("listed", shape, False), ("sensitivity", shape, np.nan), ("specificity", shape, np.nan),
+                                   ("log_base", n, 0.0), ("log_delta", shape, 0.0)):
+                dense[k] = np.full(shape, fill, dtype=test[k].dtype)
+                dense[k][rows] = test[k]
+        for k, v in dense.items():
+            if isinstance(v, np.ndarray):
+                v.flags.writeable = False
+        test["dense"] = dense
+        return dense
+
+
+    def log_starting_likelihood_array(self, demographics, symptoms, vitals):
+        """
+        Computes log P(demographics, symptoms, vitals|disease) for every disease.
+
+        Every case symptom contributes its default to every disease, and the
+        listed entries of its column correct that for the diseases that list it;
+        vitals only score the diseases that list them. Integer ages and vitals
+        within the tabulated ranges add a row of age_table/vital_table; other
+        values are scored with log_normal_pdf.
+
+        Params:
+            demographics (dict): {"age": (int), "sex": (str), "race": (str)}
+            symptoms (dict): {symptom: T/F}
+            vitals (dict): {vital: (int/float)}
+
+        Returns:
+            log_likelihoods (np.ndarray): (diseases,) log likelihood factor, in self.names order
+        """
+        n = len(self.names)
+        age = demographics["age"]
+        if age == int(age) and AGE_RANGE[0] <= age <= AGE_RANGE[1]:
+            log_likelihood = self.age_table[int(age) - AGE_RANGE[0]].copy()
+        else:
+            log_likelihood = log_normal_pdf(age, self.age_mean, self.age_std)
+        sex = self._sex_index.get(demographics["sex"])
+        log_likelihood += self._log_sex_probs[:, sex] if sex is not None else _LOG_DEFAULT_CATEGORY
+        race = self._race_index.get(demographics["race"])
+        log_likelihood += self._log_race_probs[:, race] if race is not None else _LOG_DEFAULT_CATEGORY
+
+        if symptoms:
+            present = np.fromiter(symptoms.values(), dtype=bool, count=len(symptoms))
+            log_likelihood += present.sum() * _LOG_DEFAULT_SYMPTOM_PRESENT + (~present).sum() * _LOG_DEFAULT_SYMPTOM_ABSENT
+            known = [(self._symptom_index[s], p) for s, p in zip(symptoms, present.tolist()) if s in self._symptom_index]
+            if known:
+                columns, present = zip(*known)
+                entries, which = _entries(self.symptom_ptr, columns)
+                deltas = np.where(np.array(present)[which], self._symptom_present_delta[entries], self._symptom_absent_delta[entries])
+                log_likelihood += np.bincount(self.symptom_rows[entries], deltas, minlength=n)
+
+        known = []
+        for v, x in vitals.items():
+            j = self._vital_index.get(v)
+            if j is None:
+                continue
+            k = x - self.vital_table_low[j]
+            if x != int(x) or not 0 <= k < self.vital_table_width[j]:
+                known.append((j, x))
+                continue
+            # Rows of the table are contiguous (value, entries of column j) slices
+            start, end = self.vital_ptr[j], self.vital_ptr[j + 1]
+            offset = self.vital_table_ptr[j] + int(k) * (end - start)
+            terms = self.vital_table[offset:offset + end - start]
+            if end - start == n:
+                log_likelihood += terms  # every disease lists the vital, in row order
+            else:
+                log_likelihood[self.vital_rows[start:end]] += terms
+        if known:
+            columns, x = zip(*known)
+            entries, which = _entries(self.vital_ptr, columns)
+            terms = log_normal_pdf(np.array(x, dtype=float)[which], self.vital_mean[entries], self.vital_std[entries])
+            log_likelihood += np.bincount(self.vital_rows[entries], terms, minlength=n)
+
+        return log_likelihood
+
+
+    def starting_likelihood_array(self, demographics, symptoms, vitals):
+        """
+        Computes P(demographics, symptoms, vitals|disease) for every disease.
+
+        Params:
+            demographics (dict): {"age": (int), "sex": (str), "race": (str)}
+            symptoms (dict): {symptom: T/F}
+            vitals (dict): {vital: (int/float)}
+
+        Returns:
+            likelihoods (np.ndarray): (diseases,) likelihood factor, in self.names order
+        """
+        return np.exp(self.log_starting_likelihood_array(demographics, symptoms, vitals))
+
+
+    def starting_likelihoods(self, demographics, symptoms, vitals):
+        """
+        Same as bayes.comp_starting_likelihoods, computed on the compiled arrays.
+
+        Params:
+            demographics (dict): {"age": (int), "sex": (str), "race": (str)}
+            symptoms (dict): {symptom: T/F}
+            vitals (dict): {vital: (int/float)}
+
+        Returns:
+            likelihoods (dict): name => adjusted likelihood factor
+        """
+        return self.to_dict(self.starting_likelihood_array(demographics, symptoms, vitals))
+
+
+    def to_dict(self, values):
+        """
+        Converts an array in self.names order to {name: value}.
+        """
+        return dict(zip(self.names, values.tolist()))
+
+
+    def to_array(self, values):
+        """
+        Converts {name: value} to an array in self.names order.
+        """
+        return np.array([values[name] for name in self.names], dtype=float)
+
+
+    def to_log_array(self, likelihoods):
+        """
+        Converts {name: likelihood} (e.g. from bayes.comp_test_likelihood) to a
+        log likelihood array in self.names order. Zero likelihoods map to -inf.
+        """
+        with np.errstate(divide="ignore"):
+            return np.log(self.to_array(likelihoods))
+
+
+def compile_model(templates, previous=None):
+    """
+    Returns CompiledModel for the given templates.
+
+    Params:
+        templates (list): list of disease templates (dict)
+        previous (CompiledModel): model of an earlier version of the same templates
+            (optional); compiled tests whose template entries are unchanged are reused
+
+    Returns:
+        model (CompiledModel)
+    """
+    return CompiledModel(templates, previous)
+
+
+def normal_pdf(x, mean, std):
+    """
+    Vectorized bayes.normal_pdf; broadcasts over x, mean and std.
+    """
+    var = std ** 2
+    return np.exp(-((x - mean) ** 2) / (2 * var)) / np.sqrt(2 * math.pi * var)
+
+
+def log_normal_pdf(x, mean, std):
+    """
+    Log of normal_pdf, computed without leaving log space.
+    """
+    var = std ** 2
+    return -((x - mean) ** 2) / (2 * var) - 0.5 * np.log(2 * math.pi * var)
+
+
+def _vital_tables(vitals, ptr, mean, std, max_bytes):
+    """
+    Builds log-density tables of the vitals' listed entries over integer values.
+    Standard vitals cover VITAL_RANGES; others their means +- TABLE_SPREAD std,
+    at most MAX_TABLE_WIDTH values. Vitals are tabulated in vocabulary order,
+    skipping any whose table would take the total past max_bytes.
+
+    Params:
+        vitals (list): vital vocabulary
+        ptr, mean, std (np.ndarray): compressed sparse columns of the vitals (see _sparse_columns)
+        max_bytes (int): most bytes of tables
+
+    Returns:
+        table (np.ndarray): every table flattened; the table of vital j starts at
+            table_ptr[j] and is (width[j], entries of column j) in row-major order,
+            row k holding the log densities of value low[j] + k
+        table_ptr, low, width (np.ndarray): (vitals,) int64; width 0 if vital j has no table
+    """
+    low = np.zeros(len(vitals), dtype=np.int64)
+    width = np.zeros(len(vitals), dtype=np.int64)
+    table_ptr = np.zeros(len(vitals), dtype=np.int64)
+    tables, size = [], 0
+    for j, vital in enumerate(vitals):
+        m, s = mean[ptr[j]:ptr[j + 1]], std[ptr[j]:ptr[j + 1]]
+        if not len(m):
+            continue
+        if vital in VITAL_RANGES:
+            lo, hi = VITAL_RANGES[vital]
+        else:
+            lo = int(math.floor(np.min(m - TABLE_SPREAD * s)))
+            hi = min(int(math.ceil(np.max(m + TABLE_SPREAD * s))), lo + MAX_TABLE_WIDTH - 1)
+        if (size + (hi - lo + 1) * len(m)) * 8 > max_bytes:
+            continue
+        values = np.arange(lo, hi + 1, dtype=float)
+        tables.append(log_normal_pdf(values[:, None], m, s).ravel())
+        low[j], width[j], table_ptr[j] = lo, hi - lo + 1, size
+        size += tables[-1].size
+    table = np.concatenate(tables) if tables else np.zeros(0)
+    return table, table_ptr, low, width
+
+
+def _equal_arrays(a, b, names):
+    """
+    Returns whether objects a and b have equal arrays under every attribute in names.
+    """
+    return all(np.array_equal(getattr(a, name), getattr(b, name)) for name in names)
+
+
+def _test_entries(templates):
+    """
+    Returns {test name: [each template's entry for the test, or None]}.
+    """
+    test_names = _vocabulary(d["diagnostic_tests"] for d in templates)
+    return {t: [d["diagnostic_tests"].get(t) for d in templates] for t in test_names}
+
+
+def _compile_test(templates, test_name):
+    """
+    Compiles one diagnostic test for the diseases that list it ("rows").
+
+    Binary tests get sensitivity/specificity arrays and the log likelihood of each
+    outcome, relative to the outcome's log likelihood for diseases without the
+    test (bayes.DEFAULT_TEST_SENSITIVITY/SPECIFICITY). Multi-finding tests get
+    the union of findings and (rows, finding) arrays; a finding a disease does
+    not list contributes nothing for it, as in bayes.comp_test_likelihood, and
+    diseases without the test are unaffected. Their log likelihood for a set of
+    findings R is log_base + sum of log_delta over the columns in R, where
+    log_base assumes no findings and log_delta swaps log(1 - spec) for log(sens).
+
+    Returns:
+        test (dict): {"binary", "findings", "rows", "sensitivity", "specificity", ...}
+    """
+    rows = [i for i, d in enumerate(templates) if test_name in d["diagnostic_tests"]]
+    entries = [templates[i]["diagnostic_tests"][test_name] for i in rows]
+    binary = entries[0]["Binary"]
+    rows = np.array(rows, dtype=np.int64)
+
+    with np.errstate(divide="ignore"):
+        if binary:
+            sens = np.array([e["sensitivity"] for e in entries], dtype=float)
+            spec = np.array([e["specificity"] for e in entries], dtype=float)
+            test = {
+                "binary": True,
+                "findings": [],
+                "rows": rows,
+                "sensitivity": sens,
+                "specificity": spec,
+                "log_positive": np.log(sens) - _LOG_DEFAULT_POSITIVE,
+                "log_negative": np.log1p(-spec) - _LOG_DEFAULT_NEGATIVE
+            }
+            test["log_positive"].flags.writeable = False
+            test["log_negative"].flags.writeable = False
+            return test
+
+        findings = _vocabulary({f: None for f in e if f != "Binary"} for e in entries)
+
+        # NaN marks findings a disease does not list
+        sens = _table(entries, findings, lambda e, f: e.get(f, {}).get("sensitivity", np.nan))
+        spec = _table(entries, findings, lambda e, f: e.get(f, {}).get("specificity", np.nan))
+        listed = ~np.isnan(sens)
+        log_present = np.where(listed, np.log(np.where(listed, sens, 1.0)), 0.0)
+        log_absent = np.where(listed, np.log1p(-np.where(listed, spec, 0.0)), 0.0)
+
+    return {
+        "binary": False,
+        "findings": findings,
+        "finding_index": {f: i for i, f in enumerate(findings)},
+        "rows": rows,
+        "listed": listed,
+        "sensitivity": sens,
+        "specificity": spec,
+        "log_base": log_absent.sum(axis=1),
+        "log_delta": log_present - log_absent,
+        "cache": {}
+    }
+
+
+def _table(items, columns, get):
+    """
+    Builds a (items, columns) float array with get(item, column) in each cell.
+    """
+    table = np.empty((len(items), len(columns)), dtype=float)
+    for i, d in enumerate(items):
+        for j, k in enumerate(columns):
+            table[i, j] = get(d, k)
+    return table
+
+
+def _vocabulary(dicts):
+    """
+    Returns the union of the keys of dicts, in order of first appearance.
+    """
+    return list(dict.fromkeys(k for d in dicts for k in d))
+
+
+def _sparse_columns(templates, columns, get, fields):
+    """
+    Builds compressed sparse columns of the entries templates list.
+
+    Params:
+        templates (list): list of disease templates (dict)
+        columns (list): vocabulary, column order
+        get (function): template => {column: info} (e.g. its symptoms)
+        fields (list): keys of info stored for each entry
+
+    Returns:
+        ptr (np.ndarray): (columns + 1,) the entries of column j are ptr[j]:ptr[j + 1]
+        rows (np.ndarray): (entries,) disease of each entry
+        arrays (tuple): one (entries,) float array per field
+    """
+    position = {k: j for j, k in enumerate(columns)}
+    entries = [[] for _ in columns]
+    for i, d in enumerate(templates):
+        for k, info in get(d).items():
+            entries[position[k]].append([i] + [info[f] for f in fields])
+
+    ptr = np.zeros(len(columns) + 1, dtype=np.int64)
+    ptr[1:] = np.cumsum([len(e) for e in entries])
+    table = np.array([entry for column in entries for entry in column], dtype=float).reshape(-1, 1 + len(fields))
+    return ptr, table[:, 0].astype(np.int64), tuple(np.ascontiguousarray(table[:, 1 + j]) for j in range(len(fields)))
+
+
+def _entries(ptr, columns):
+    """
+    Returns the positions of every entry in the given columns of compressed
+    sparse columns, and for each entry the index in columns it came from.
+    """
+    columns = np.asarray(columns, dtype=np.int64)
+    starts = ptr[columns]
+    lengths = ptr[columns + 1] - starts
+    which = np.repeat(np.arange(len(columns)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts[which] + offsets, which
@@ -0,0 +1,321 @@
+import numpy as np
+
+# Shared by every posterior with nothing parked (never written in place)
+_NO_POSITIONS = np.empty(0, dtype=np.int64)
+_NO_POSITIONS.flags.writeable = False
+_NO_CEILINGS = np.empty(0)
+_NO_CEILINGS.flags.writeable = False
+
+class LogPosterior:
+    """
+    Unnormalised log-posterior over the diseases of a CompiledModel.
+
+    Evidence is accumulated by adding log likelihood vectors in place; the
+    vector is only normalised (with log-sum-exp) when probabilities are read,
+    so long test sequences never underflow to all zeros the way repeated
+    bayes.update calls can.
+
+    With epsilon set, diseases whose probability drops below
+    epsilon * PARK_MARGIN are parked: sparse updates skip them, so an update costs O(active diseases)
+    rather than O(diseases it names). A parked disease's log_post stays at its
+    value when parked (plus dense updates, which reach every disease), and an
+    upper bound on its current value is log_post + the sum, over the sparse
+    updates since, of the largest value each update gave any disease. When
+    that bound could put a parked disease back above epsilon, the updates it
+    missed are replayed for it and it is active again; the margin keeps a
+    disease parked just under the line from coming back on the next update. Parked diseases read as
+    probability 0; parked_mass_bound() bounds the probability they hold.
+
+    Attributes:
+        names (list): disease names, in the order of log_post
+        log_post (np.ndarray): (diseases,) unnormalised log-posterior, up to offset
+        offset (float): log factor shared by every disease, kept out of log_post
+            so sparse updates only touch the diseases they name
+        epsilon (float): probability a parked disease is guaranteed to stay under, or None to never park
+        active (np.ndarray): sorted positions of the diseases not parked, or None while none are
+    """
+
+    # Diseases are parked this far below epsilon
+    PARK_MARGIN = 1e-3
+
+    # One posterior is held per session, so instances carry no __dict__
+    __slots__ = ("names", "log_post", "offset", "epsilon", "active", "_parked", "_parked_update", "_parked_ceiling",
+                 "_parked_top", "_ceiling", "_updates", "_missed", "_missed_start")
+
+    def __init__(self, names, log_priors, epsilon=None):
+        self.names = names
+        self.log_post = np.array(log_priors, dtype=float)
+        self.offset = 0.0
+        self.epsilon = epsilon
+        self.active = None
+        self._parked = _NO_POSITIONS
+        self._parked_update = _NO_POSITIONS     # sparse updates applied before each was parked
+        self._parked_ceiling = _NO_CEILINGS     # _ceiling when each was parked
+        self._parked_top = -np.inf   # max of log_post - _parked_ceiling over the parked diseases
+        self._ceiling = 0.0      # sum of the largest value of every sparse update so far
+        self._updates = 0        # number of sparse updates so far
+        self._missed = None      # (rows, values) of the sparse updates since _missed_start, while any are parked
+        self._missed_start = 0
+
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+    def add(self, log_likelihoods):
+        """
+        Multiplies the posterior by a likelihood vector, in log space.
+
+        Params:
+            log_likelihoods (np.ndarray): (diseases,) log likelihood factor, in self.names order
+        """
+        self.log_post += log_likelihoods
+        if len(self._parked):
+            self._parked_top = float((self.log_post[self._parked] - self._parked_ceiling).max())
+        if self.epsilon is not None:
+            self._prune()
+
+
+    def add_sparse(self, base, rows, values, largest=None):
+        """
+        Multiplies the posterior by a likelihood given sparsely (see
+        CompiledModel.test_log_likelihood), touching only rows (only the
+        active ones of rows when diseases are parked).
+
+        Params:
+            base (float): log likelihood factor of every disease
+            rows (np.ndarray): positions of the diseases that get values on top of base, sorted without repeats
+            values (np.ndarray): (rows,) log likelihood of those diseases, relative to base
+            largest (float): max(values) (optional; see CompiledModel.test_log_likelihood_max).
+                Only used with parked diseases, where it saves a pass over values.
+        """
+        self.offset += base
+        n = len(self.log_post)
+        if len(self._parked) == 0:
+            if len(rows) == n:
+                # Every disease: rows is 0..n-1, and a plain add skips the gather/scatter
+                self.log_post += values
+            else:
+                self.log_post[rows] += values
+        else:
+            active = self.active
+            if len(rows) == n:
+                self.log_post[active] += values[active]
+            elif len(rows):
+                at = np.minimum(np.searchsorted(rows, active), len(rows) - 1)
+                hit = rows[at] == active
+                self.log_post[active[hit]] += values[at[hit]]
+            if largest is None:
+                largest = float(values.max()) if len(values) else 0.0
+            self._ceiling += max(largest, 0.0)
+            self._missed.append((rows, values))
+        self._updates += 1
+        if self.epsilon is not None:
+            self._prune()
+
+
+    def parked_mass_bound(self):
+        """
+        Returns an upper bound on the total probability of the parked diseases.
+        """
+        if len(self._parked) == 0:
+            return 0.0
+        bounds = self.log_post[self._parked] - self._parked_ceiling + self._ceiling
+        return float(np.exp(bounds - self._active_log_normaliser()).sum())
+
+
+    def _active_log_normaliser(self):
+        """
+        Returns log-sum-exp of log_post over the active diseases (without offset).
+        """
+        values = self.log_post if self.active is None else self.log_post[self.active]
+        top = values.max() if len(values) else -np.inf
+        if not np.isfinite(top):
+            return top
+        return top + np.log(np.exp(values - top).sum())
+
+
+    def _prune(self):
+        """
+        Re-admits parked diseases whose bound reaches epsilon, then parks active
+        diseases below epsilon * PARK_MARGIN. Costs O(active) unless diseases are re-admitted.
+        """
+        threshold = self._active_log_normaliser() + np.log(self.epsilon)
+        if not np.isfinite(threshold):
+            return
+
+        # Only the largest bound is checked on every update. Once it reaches
+        # epsilon, every disease whose bound is above the parking line is
+        # brought up to date, and those still below it are parked again with
+        # a fresh (tight) bound, so the next check has the whole margin to go.
+        if self._parked_top + self._ceiling >= threshold:
+            bounds = self.log_post[self._parked] - self._parked_ceiling + self._ceiling
+            self._readmit(bounds >= threshold + np.log(self.PARK_MARGIN))
+            threshold = self._active_log_normaliser() + np.log(self.epsilon)
+
+        active = np.arange(len(self.log_post)) if self.active is None else self.active
+        low = self.log_post[active] < threshold + np.log(self.PARK_MARGIN)
+        if low.any():
+            parked = active[low]
+            self.active = active[~low]
+            if self._missed is None:
+                self._missed = []
+            self._parked = np.concatenate([self._parked, parked])
+            self._parked_update = np.concatenate([self._parked_update, np.full(len(parked), self._updates)])
+            self._parked_ceiling = np.concatenate([self._parked_ceiling, np.full(len(parked), self._ceiling)])
+            self._parked_top = max(self._parked_top, float(self.log_post[parked].max()) - self._ceiling)
+        self._trim_missed()
+
+
+    def _readmit(self, back):
+        """
+        Replays the sparse updates parked diseases missed and makes them active.
+
+        Params:
+            back (np.ndarray): (parked,) bool, the parked diseases to re-admit
+        """
+        diseases, since = self._parked[back], self._parked_update[back]
+        n = len(self.log_post)
+        for u, (rows, values) in enumerate(self._missed, self._missed_start):
+            missed = diseases[since <= u]
+            if len(rows) == n:
+                self.log_post[missed] += values[missed]
+            elif len(missed) and len(rows):
+                at = np.minimum(np.searchsorted(rows, missed), len(rows) - 1)
+                hit = rows[at] == missed
+                self.log_post[missed[hit]] += values[at[hit]]
+        # Active and parked diseases are disjoint, so a sort is enough
+        self.active = np.sort(np.concatenate([self.active, diseases]))
+        self._parked, self._parked_update, self._parked_ceiling = self._parked[~back], self._parked_update[~back], self._parked_ceiling[~back]
+        if len(self._parked):
+            self._parked_top = float((self.log_post[self._parked] - self._parked_ceiling).max())
+        else:
+            self.active, self._parked_top = None, -np.inf
+
+
+    def _trim_missed(self):
+        """
+        Drops the logged updates that no parked disease still needs.
+        """
+        if len(self._parked) == 0:
+            self._missed, self._missed_start = None, self._updates
+            return
+        oldest = self._parked_update.min()
+        if oldest > self._missed_start:
+            del self._missed[:oldest - self._missed_start]
+            self._missed_start = oldest
+
+
+    def probability_array(self):
+        """
+        Returns normalised posterior probabilities.
+
+        Returns:
+            probs (np.ndarray): (diseases,) posterior, in self.names order. All
+            zeros if every disease has been ruled out (matches bayes.update).
+        """
+        if len(self._parked):
+            probs = np.zeros(len(self.log_post))
+            probs[self.active] = _normalise(self.log_post[self.active])
+            return probs
+        return _normalise(self.log_post)
+
+
+    def probabilities(self):
+        """
+        Returns normalised posterior probabilities.
+
+        Returns:
+            probs (dict): {name: prob (float)}
+        """
+        return dict(zip(self.names, self.probability_array().tolist()))
+
+
+    def top(self, k):
+        """
+        Returns the k most probable diseases, found by partial selection so only
+        those k are sorted.
+
+        Params:
+            k (int): number of diseases
+
+        Returns:
+            probs (dict): {name: prob (float)} of the top k, most probable first
+            other (float): total probability of every other disease
+        """
+        if len(self._parked):
+            # Parked diseases have probability 0, so only the active ones are ranked
+            probs = _normalise(self.log_post[self.active])
+            top = top_indices(probs, k)
+            selected = probs[top]
+            names = [self.names[i] for i in self.active[top].tolist()]
+        else:
+            probs = self.probability_array()
+            top = top_indices(probs, k)
+            selected = probs[top]
+            names = [self.names[i] for i in top.tolist()]
+        return dict(zip(names, selected.tolist())), max(float(probs.sum() - selected.sum()), 0.0)
+
+
+    def log_normaliser(self):
+        """
+        Returns log of the sum of the unnormalised posterior (log-sum-exp), over
+        the active diseases.
+        """
+        return self.offset + self._active_log_normaliser()
+
+
+def _normalise(log_values):
+    """
+    Returns exp(log_values) normalised to sum to 1, or all zeros if every value is -inf.
+    """
+    top = log_values.max() if len(log_values) else -np.inf
+    if not np.isfinite(top):
+        return np.zeros(len(log_values))
+    probs = np.exp(log_values - top)
+    probs /= probs.sum()
+    return probs
+
+
+def top_indices(values, k):
+    """
+    Returns the positions of the k largest values, largest first, in
+    O(n + k log k) instead of sorting everything.
+    """
+    k = min(k, len(values))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-values, k - 1)[:k]
+    return top[np.argsort(-values[top], kind="stable")]
+
+
+def changes(names, before, after, threshold):
+    """
+    Returns {name: new probability} of the diseases whose probability moved by more than threshold.
+
+    Params:
+        names (list): disease names, in the order of before and after
+        before, after (np.ndarray): (diseases,) probabilities
+        threshold (float): minimum absolute change reported
+    """
+    moved = np.flatnonzero(np.abs(after - before) > threshold)
+    return dict(zip([names[i] for i in moved.tolist()], after[moved].tolist()))
+
+
+def from_model(model, epsilon=None):
+    """
+    Returns a LogPosterior starting at the priors of model.
+
+    Params:
+        model (CompiledModel)
+        epsilon (float): park diseases below this probability (optional, see LogPosterior)
+
+    Returns:
+        posterior (LogPosterior)
+    """
+    return LogPosterior(model.names, model.log_priors, epsilon)
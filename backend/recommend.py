@@ -0,0 +1,167 @@
+import numpy as np
+
+# Maximum number of outcomes scored per test. Multi-finding tests with more
+# possible finding sets than this are estimated from this many sampled outcomes.
+DEFAULT_BUDGET = 1024
+
+# Outcome tables of tests small enough to enumerate are kept on the compiled
+# test (so they go with the model version), unless larger than this
+MAX_CACHED_OUTCOME_BYTES = 16 << 20
+_OUTCOMES_KEY = "outcomes"
+
+# Most (outcome, disease) cells scored at once. Larger outcome tables are
+# scored in chunks of rows, so memory stays bounded whatever the budget.
+MAX_CHUNK_CELLS = 1 << 20
+
+
+def entropy(probs):
+    """
+    Returns the entropy in bits of each row of probs (or of a single vector).
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = np.where(probs > 0, probs * np.log2(probs), 0.0)
+    return -terms.sum(axis=-1)
+
+
+def expected_information_gain(compiled, probs, test_name, budget=DEFAULT_BUDGET, rng=None):
+    """
+    Scores a test by the expected reduction in entropy of the posterior from ordering it.
+
+    Outcomes are weighted and scored with one model: the likelihoods the
+    posterior is updated with (CompiledModel.test_log_likelihood, i.e.
+    bayes.comp_test_likelihood), normalised per disease into P(outcome|disease).
+    A listed binary test is positive with probability sens / (sens + 1 - spec),
+    a listed finding is reported with probability sens / (sens + 1 - spec), and
+    findings the update ignores are reported half the time. The update itself
+    also scales each disease by the normaliser (e.g. sens + 1 - spec), whatever
+    the result; that shift says nothing about which disease it is and is left
+    out, so the gain is the mutual information between disease and outcome and
+    never negative (up to sampling noise when outcomes are sampled). Outcomes
+    are scored as (outcomes, diseases) arrays of at most MAX_CHUNK_CELLS cells.
+
+    Params:
+        compiled (CompiledModel)
+        probs (np.ndarray): (diseases,) current posterior, in compiled.names order
+        test_name (str): name of test
+        budget (int): maximum outcomes to score; multi-finding tests with more
+            than budget finding sets are estimated from budget sampled outcomes
+        rng (np.random.Generator): used only when sampling (optional)
+
+    Returns:
+        gain (float): expected information gain in bits
+    """
+    test = compiled.dense_test(test_name)
+
+    with np.errstate(divide="ignore"):
+        log_probs = np.log(probs)
+
+    expected, total = 0.0, 0.0
+    for log_generate, weights in _outcomes(test, probs, budget, rng):
+        # P(outcome) = sum over diseases of P(disease) * P(outcome|disease)
+        if weights is None:
+            weights = np.exp(log_generate + log_probs).sum(axis=1)
+
+        # Posterior after each outcome, normalised per row in log space
+        log_post = log_probs + log_generate
+        top = log_post.max(axis=1, keepdims=True)
+        top[~np.isfinite(top)] = 0.0
+        post = np.exp(log_post - top)
+        totals = post.sum(axis=1, keepdims=True)
+        post = np.divide(post, totals, out=np.zeros_like(post), where=totals > 0)
+
+        expected += float((weights * entropy(post)).sum())
+        total += float(weights.sum())
+    return float(entropy(probs)) - expected / total
+
+
+def recommend_tests(compiled, probs, ordered=(), budget=DEFAULT_BUDGET, rng=None):
+    """
+    Ranks every test that has not been ordered by expected information gain.
+
+    Params:
+        compiled (CompiledModel)
+        probs (np.ndarray): (diseases,) current posterior, in compiled.names order
+        ordered (iterable): names of tests already ordered
+        budget (int): see expected_information_gain
+        rng (np.random.Generator): see expected_information_gain
+
+    Returns:
+        ranked (list): [{"test": name, "expected_information_gain": bits}], best first
+    """
+    rng = rng or np.random.default_rng()
+    ranked = []
+    for test_name in compiled.tests:
+        if test_name not in ordered:
+            ranked.append({"test": test_name, "expected_information_gain": expected_information_gain(compiled, probs, test_name, budget, rng)})
+    ranked.sort(key=lambda r: r["expected_information_gain"], reverse=True)
+    return ranked
+
+
+def _outcomes(test, probs, budget, rng):
+    """
+    Yields the outcomes of a test to score, in chunks of at most MAX_CHUNK_CELLS
+    (outcome, disease) cells.
+
+    Yields:
+        log_generate (np.ndarray): (outcomes, diseases) log P(outcome|disease)
+        weights (np.ndarray): (outcomes,) sample counts when sampled; None when enumerated
+    """
+    rows = max(1, MAX_CHUNK_CELLS // max(1, len(probs)))
+
+    if not test["binary"] and 2 ** len(test["findings"]) > budget:
+        # Too many finding sets: sample budget outcomes from P(outcome|disease)
+        rng = rng or np.random.default_rng()
+        diseases = rng.choice(len(probs), size=budget, p=probs / probs.sum())
+        subsets = (rng.random((budget, len(test["findings"]))) < _finding_probability(test)[diseases]).astype(np.int64)
+        subsets, counts = np.unique(subsets, axis=0, return_counts=True)
+        counts = counts.astype(float)
+        for start in range(0, len(subsets), rows):
+            yield _log_generate(test, subsets[start:start + rows]), counts[start:start + rows]
+        return
+
+    cached = test.get(_OUTCOMES_KEY)
+    if cached is not None or test["binary"]:
+        if cached is None:
+            cached = test[_OUTCOMES_KEY] = _log_generate(test, None)
+        yield cached, None
+        return
+
+    # Every subset of findings as a row of 0/1, in chunks unless the whole table is small enough to keep
+    findings = len(test["findings"])
+    outcomes = 2 ** findings
+    if outcomes * len(probs) * 8 <= MAX_CACHED_OUTCOME_BYTES:
+        rows = outcomes
+    for start in range(0, outcomes, rows):
+        chunk = _log_generate(test, (np.arange(start, min(start + rows, outcomes))[:, None] >> np.arange(findings)) & 1)
+        if len(chunk) == outcomes:
+            test[_OUTCOMES_KEY] = chunk
+        yield chunk, None
+
+
+def _log_generate(test, subsets):
+    """
+    Returns (outcomes, diseases) log P(outcome|disease): the update log
+    likelihood of each outcome (positive, negative for binary tests; each finding
+    set in subsets otherwise) less the disease's log normaliser. A disease no
+    outcome is possible for gets -inf throughout.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if test["binary"]:
+            log_update = np.stack([test["log_positive"], test["log_negative"]])
+            log_norm = np.logaddexp(test["log_positive"], test["log_negative"])
+        else:
+            # Findings multiply independently: sens + 1 - spec if listed, 1 + 1 if ignored
+            log_update = test["log_base"] + subsets @ test["log_delta"].T
+            log_norm = np.where(test["listed"], np.log(np.where(test["listed"], test["sensitivity"] + 1.0 - test["specificity"], 1.0)), np.log(2.0)).sum(axis=1)
+        return np.where(np.isfinite(log_norm), log_update - log_norm, -np.inf)
+
+
+def _finding_probability(test):
+    """
+    Returns (diseases, findings) probability that each finding is reported,
+    matching _log_generate: sens / (sens + 1 - spec) for listed findings, 1/2
+    for findings the update ignores.
+    """
+    sens = np.where(test["listed"], test["sensitivity"], 1.0)
+    total = sens + 1.0 - np.where(test["listed"], test["specificity"], 0.0)
+    return np.where(test["listed"] & (total > 0), sens / np.where(total > 0, total, 1.0), 0.5)
@@ -0,0 +1,492 @@
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+import load_case
+import model
+import snapshot
+
+logger = logging.getLogger(__name__)
+
+class StaleVersionError(LookupError):
+    """
+    Raised when the templates of a version read from a snapshot are needed but
+    its source files have changed since, so they can no longer be read.
+    """
+
+
+class ModelVersion:
+    """
+    One immutable version of a template folder: the parsed templates and
+    everything derived from them. Sessions keep the version they started with.
+
+    Attributes:
+        version (str): fingerprint of the source files (names, mtimes and sizes)
+        model (CompiledModel): compiled templates
+        loaded_at (float): time.time() when this version was built
+        segment (str): path of the shared-memory segment backing model's arrays, or None
+
+    Params:
+        templates (list): list of disease templates (dict), or None to read them
+            with read_templates(version) when first needed
+    """
+
+    def __init__(self, version, templates, compiled, segment=None, read_templates=None):
+        self.version = version
+        self.model = compiled
+        self.loaded_at = time.time()
+        self.segment = segment
+        self._templates = templates
+        self._read_templates = read_templates
+        self._sampler = None
+        self._lock = threading.Lock()
+
+
+    @property
+    def templates(self):
+        """
+        List of disease templates (dict). Versions read from a snapshot or shared
+        segment read them from the source files on first use, since only case
+        generation needs them.
+
+        Raises:
+            StaleVersionError: if the source files have changed since
+        """
+        if self._templates is None:
+            with self._lock:
+                if self._templates is None:
+                    self._templates = self._read_templates(self)
+        return self._templates
+
+
+    @property
+    def sampler(self):
+        """
+        Case sampling tables (load_case.CaseSampler), built on first use.
+        """
+        if self._sampler is None:
+            templates = self.templates
+            with self._lock:
+                if self._sampler is None:
+                    self._sampler = load_case.CaseSampler(templates)
+        return self._sampler
+
+
+class TemplateReloader:
+    """
+    Watches a template folder and swaps in a new ModelVersion when its JSON
+    files change, without a restart.
+
+    Files are compared by mtime and size; only changed files are re-parsed, and
+    compiled tests whose entries did not change are carried over from the
+    previous model. The current version is replaced with a single assignment, so
+    requests always see a complete version. The last `retain` versions stay
+    available through get() for sessions that started on them.
+
+    A file that fails to parse (e.g. while it is being saved) or a template that
+    fails validation keeps the current version in place and is retried on the
+    next check.
+
+    The first version is read from the folder's snapshot (see snapshot.py) when
+    one exists and matches the files, and parsed from JSON otherwise.
+
+    With shared_memory, every process watching the folder shares one copy of
+    each version's compiled arrays: a process maps the shared-memory segment
+    named after the version's fingerprint when one exists, and otherwise
+    compiles the templates and publishes them there for the others (see
+    snapshot.publish_shared). After a reload the fingerprint changes, so each
+    process attaches to the new segment on its next check. Segments a process
+    published are removed when it drops the version, closes the reloader or exits.
+
+    Params:
+        folder (dir): folder with JSON disease templates
+        check_interval (float): minimum seconds between checks made by maybe_check()
+        retain (int): number of versions kept for existing sessions
+        snapshot_path (str): snapshot file (optional, defaults to snapshot.default_path(folder));
+            pass False to always parse JSON
+        shared_memory (str): prefix of shared-memory segment names (optional, no sharing if None)
+    """
+
+    def __init__(self, folder, check_interval=2.0, retain=16, snapshot_path=None, shared_memory=None):
+        self.folder = folder
+        self.check_interval = check_interval
+        self.retain = retain
+        self.shared_memory = shared_memory
+        self.versions = OrderedDict()
+        self.current = None
+        self._files = {}  # filename => (mtime_ns, size, template)
+        self._published = {}  # path => pid of the process that created the segment
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+
+        loaded = None
+        if shared_memory is None and snapshot_path is not False:
+            loaded = snapshot.load_fresh_snapshot(folder, snapshot_path)
+        if loaded:
+            self._install_loaded(*loaded)
+        else:
+            self.check()
+        if self.current is None:
+            raise ValueError(f"No valid disease templates in '{folder}'")
+
+
+    def get(self, version):
+        """
+        Returns the ModelVersion with the given fingerprint, or None if it is no longer retained.
+        """
+        return self.versions.get(version)
+
+
+    def current_for_cases(self):
+        """
+        Returns the current version with its templates read, for generating cases.
+        If the source files changed since it was read from a snapshot, picks up
+        the change first.
+        """
+        version = self.current
+        try:
+            version.templates
+        except StaleVersionError:
+            self.check()
+            version = self.current
+            version.templates
+        return version
+
+
+    def maybe_check(self):
+        """
+        Runs check() if check_interval has passed since the last one. Cheap enough
+        to call on every request; concurrent callers skip instead of waiting.
+        """
+        if time.monotonic() - self._last_check < self.check_interval:
+            return False
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            return self._check()
+        finally:
+            self._lock.release()
+
+
+    def check(self):
+        """
+        Re-reads changed files and swaps in a new version if anything changed.
+
+        Returns:
+            changed (bool): whether a new version was installed
+        """
+        with self._lock:
+            return self._check()
+
+
+    def close(self):
+        """
+        Removes the shared-memory segments this process published for its
+        versions. Processes still using them keep their mappings; new ones can
+        no longer attach and compile the templates instead.
+        """
+        with self._lock:
+            for path, creator in list(self._published.items()):
+                if creator == os.getpid():
+                    _remove_segment(path)
+            self._published.clear()
+
+
+    def start(self, interval=None):
+        """
+        Checks for changes on a background daemon thread every interval seconds
+        (defaults to check_interval), instead of relying on maybe_check().
+        """
+        interval = interval or self.check_interval
+
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check()
+                except Exception:
+                    logger.exception("Template reload of '%s' failed", self.folder)
+
+        thread = threading.Thread(target=poll, name=f"reloader-{self.folder}", daemon=True)
+        thread.start()
+        return thread
+
+
+    def _check(self):
+        """
+        check() without the lock. Caller holds self._lock.
+        """
+        self._last_check = time.monotonic()
+
+        stats = load_case.template_file_stats(self.folder)
+
+        if self.current is not None and stats.keys() == self._files.keys() and all(self._files[f][:2] == stats[f] for f in stats):
+            return False
+
+        fingerprint = load_case.templates_fingerprint(stats)
+        if self.shared_memory is not None:
+            path = snapshot.shared_segment_path(self.shared_memory, fingerprint)
+            attached = snapshot.attach_shared(path, stats)
+            if attached:
+                self._install_loaded(*attached, segment=path)
+                return True
+
+        files = {}
+        for filename, (mtime, size) in stats.items():
+            old = self._files.get(filename)
+            # Versions read from a snapshot have no parsed templates (None) to reuse
+            if old is not None and old[:2] == (mtime, size) and old[2] is not None:
+                files[filename] = old
+                continue
+            try:
+                with open(os.path.join(self.folder, filename), 'r') as f:
+                    files[filename] = (mtime, size, load_case.normalize_template(json.load(f)))
+            except (OSError, ValueError):
+                logger.exception("Could not load template '%s'; keeping version %s", filename, self.current and self.current.version)
+                return False
+
+        templates = [files[f][2] for f in sorted(files)]
+        if not templates:
+            logger.error("No templates in '%s'; keeping version %s", self.folder, self.current and self.current.version)
+            return False
+
+        try:
+            snapshot.validate_templates(templates)
+        except snapshot.SnapshotError as e:
+            logger.error("%s\nKeeping version %s", e, self.current and self.current.version)
+            return False
+
+        previous = self.current.model if self.current is not None else None
+        compiled = model.compile_model(templates, previous)
+        segment = None
+        if self.shared_memory is not None:
+            path = snapshot.shared_segment_path(self.shared_memory, fingerprint)
+            published = snapshot.publish_shared(path, compiled, stats)
+            if published:
+                _, compiled = published
+                segment = path
+                self._published[path] = os.getpid()
+                atexit.register(_remove_published, path, os.getpid())
+        self._files = files
+        self._install(ModelVersion(fingerprint, templates, compiled, segment))
+        return True
+
+
+    def _install_loaded(self, header, compiled, segment=None):
+        """
+        Installs a version read from a snapshot file or shared-memory segment. Its
+        templates are read from the folder when first needed (see ModelVersion.templates).
+        """
+        self._files = {f: (*stat, None) for f, stat in header["sources"].items()}
+        self._install(ModelVersion(header["version"], None, compiled, segment, self._read_templates))
+
+
+    def _read_templates(self, version):
+        """
+        Reads the templates of a version installed from a snapshot or shared
+        segment from the folder, if the files are still the ones it was built from.
+
+        Raises:
+            StaleVersionError: if they are not
+        """
+        try:
+            if load_case.templates_fingerprint(load_case.template_file_stats(self.folder)) == version.version:
+                templates = load_case.load_disease_templates(self.folder)
+                if load_case.templates_fingerprint(load_case.template_file_stats(self.folder)) == version.version:
+                    return templates
+        except (OSError, ValueError):
+            logger.exception("Could not read the templates of version %s from '%s'", version.version, self.folder)
+        raise StaleVersionError(f"Templates of version {version.version} in '{self.folder}' have changed")
+
+
+    def _install(self, version):
+        """
+        Makes version current and drops versions beyond the retain limit.
+        """
+        self.versions[version.version] = version
+        self.versions.move_to_end(version.version)
+        while len(self.versions) > self.retain:
+            _, dropped = self.versions.popitem(last=False)
+            if self._published.pop(dropped.segment, None) == os.getpid():
+                # Processes still using it keep their mapping; new ones can no longer attach
+                _remove_segment(dropped.segment)
+        self.current = version
+        logger.info("Loaded templates from '%s' as version %s (%d diseases)", self.folder, version.version, len(version.model.names))
+
+
+class KnowledgeBaseCache:
+    """
+    Named knowledge bases (template folders), each loaded as a TemplateReloader
+    on first use and shared by every session. At most max_resident stay loaded;
+    the least recently used is dropped beyond that (removing the shared-memory
+    segments this process published for it) and loaded again (from its
+    snapshot when fresh) the next time it is asked for. Cases keep their version
+    string, so a case whose knowledge base was dropped and reloaded unchanged
+    still finds its version.
+
+    Params:
+        folders (dict): name => template folder
+        default (str): name used when none is given
+        max_resident (int): maximum number of loaded knowledge bases
+        check_interval (float): passed to each TemplateReloader
+        shared_memory (str): prefix of shared-memory segment names (optional); each
+            knowledge base's TemplateReloader gets "<prefix>_<name>"
+    """
+
+    def __init__(self, folders, default, max_resident=4, check_interval=2.0, shared_memory=None):
+        if default not in folders:
+            raise ValueError(f"Default knowledge base '{default}' is not configured")
+        self.folders = dict(folders)
+        self.default = default
+        self.max_resident = max_resident
+        self.check_interval = check_interval
+        self.shared_memory = shared_memory
+        self.loads = 0
+        self.evictions = 0
+        self._resident = OrderedDict()  # name => TemplateReloader, least recently used first
+        self._loading = {name: threading.Lock() for name in self.folders}
+        self._lock = threading.Lock()
+        self._checker = None
+
+
+    def names(self):
+        """
+        Returns the configured knowledge-base names.
+        """
+        return list(self.folders)
+
+
+    def resident(self):
+        """
+        Returns {name: TemplateReloader} of the loaded knowledge bases.
+        """
+        with self._lock:
+            return dict(self._resident)
+
+
+    def get(self, name=None):
+        """
+        Returns the TemplateReloader of a knowledge base, loading it if needed.
+        Loading one knowledge base does not block requests for the others.
+
+        Params:
+            name (str): knowledge-base name (optional, defaults to self.default)
+
+        Returns:
+            knowledge_base (TemplateReloader)
+
+        Raises:
+            KeyError: if name is not configured
+        """
+        name = name or self.default
+        if name not in self.folders:
+            raise KeyError(name)
+
+        with self._lock:
+            kb = self._resident.get(name)
+            if kb is not None:
+                self._resident.move_to_end(name)
+                return kb
+
+        with self._loading[name]:
+            with self._lock:
+                kb = self._resident.get(name)
+            if kb is None:
+                prefix = f"{self.shared_memory}_{re.sub(r'[^A-Za-z0-9]', '_', name)}" if self.shared_memory else None
+                kb = TemplateReloader(self.folders[name], check_interval=self.check_interval, shared_memory=prefix)
+                self.loads += 1
+            evicted = []
+            with self._lock:
+                self._resident[name] = kb
+                self._resident.move_to_end(name)
+                while len(self._resident) > self.max_resident:
+                    dropped, dropped_kb = self._resident.popitem(last=False)
+                    self.evictions += 1
+                    logger.info("Dropped knowledge base '%s' (over %d resident)", dropped, self.max_resident)
+                    evicted.append(dropped_kb)
+            for dropped_kb in evicted:
+                dropped_kb.close()
+            return kb
+
+
+    def maybe_check(self):
+        """
+        Calls maybe_check() on every loaded knowledge base.
+        """
+        for kb in self.resident().values():
+            kb.maybe_check()
+
+
+    @property
+    def started(self):
+        """
+        Whether start() has been called.
+        """
+        return self._checker is not None
+
+
+    def start(self, interval=None):
+        """
+        Checks every loaded knowledge base for changed templates on one background
+        daemon thread every interval seconds (defaults to check_interval), so no
+        request pays for the file stats or a recompile. Later calls do nothing.
+        """
+        interval = interval or self.check_interval
+
+        def poll():
+            while True:
+                time.sleep(interval)
+                for kb in self.resident().values():
+                    try:
+                        kb.check()
+                    except Exception:
+                        logger.exception("Template reload of '%s' failed", kb.folder)
+
+        with self._lock:
+            if self._checker is None:
+                self._checker = threading.Thread(target=poll, name="knowledge-base-checker", daemon=True)
+                self._checker.start()
+
+
+def _remove_segment(path):
+    """
+    Removes a published shared-memory segment, if still there.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_published(path, creator):
+    """
+    atexit handler: removes a segment when the process exiting is the one that
+    published it. Workers forked from that process inherit the handler, and must
+    not remove a segment their siblings are still attaching to.
+    """
+    if os.getpid() == creator:
+        _remove_segment(path)
+
+
+def parse_knowledge_bases(spec):
+    """
+    Parses a knowledge-base list like "digestive=digestive diseases;other=other-diseases".
+
+    Params:
+        spec (str): name=folder pairs separated by ";"
+
+    Returns:
+        folders (dict): name => folder, in the order given
+    """
+    folders = {}
+    for pair in spec.split(";"):
+        if pair.strip():
+            name, sep, folder = pair.partition("=")
+            if not sep or not name.strip() or not folder.strip():
+                raise ValueError(f"Invalid knowledge base '{pair}'; expected name=folder")
+            folders[name.strip()] = folder.strip()
+    return folders
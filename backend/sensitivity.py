@@ -0,0 +1,206 @@
+import argparse
+import json
+import numpy as np
+import load_case
+import model
+
+DEFAULT_SAMPLES = 2000
+DEFAULT_CONCENTRATION = 50.0
+DEFAULT_LEVEL = 0.95
+
+# Most (sample, disease) log posteriors held at once while sampling
+CHUNK_ELEMENTS = 1 << 22
+
+# Perturbed probabilities are kept inside (0, 1) so their logs stay finite
+_EPSILON = 1e-12
+
+
+def case_parameters(compiled, case):
+    """
+    Collects the template probabilities the likelihood of a case depends on:
+    P(symptom|disease) for every case symptom a disease lists, and the
+    sensitivity or specificity of every ordered test (or listed finding) that
+    a disease lists. Defaults for unlisted features are not published values
+    and are left out.
+
+    Params:
+        compiled (model.CompiledModel)
+        case (dict): {"demographics", "symptoms", "vitals", "tests"}, as from load_case
+
+    Returns:
+        rows (np.ndarray): disease of each parameter
+        values (np.ndarray): published probability p
+        complement (np.ndarray): True where the case's likelihood uses 1 - p rather than p
+            (absent symptoms and findings, negative tests)
+    """
+    rows, values, complement = [], [], []
+
+    for symptom, present in case["symptoms"].items():
+        symptom_rows, probs = compiled.symptom_entries(symptom)
+        rows.append(symptom_rows)
+        values.append(probs)
+        complement.append(np.full(len(probs), not present))
+
+    for test_name, result in case["tests"].items():
+        test = compiled.tests.get(test_name)
+        if test is None:
+            continue
+        if test["binary"]:
+            positive = result == "positive"
+            rows.append(test["rows"])
+            values.append(test["sensitivity"] if positive else test["specificity"])
+            complement.append(np.full(len(test["rows"]), not positive))
+        else:
+            found = np.array([f in result for f in test["findings"]], dtype=bool)
+            r, f = np.nonzero(test["listed"])
+            rows.append(test["rows"][r])
+            values.append(np.where(found[f], test["sensitivity"][r, f], test["specificity"][r, f]))
+            complement.append(~found[f])
+
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=bool)
+    return np.concatenate(rows).astype(np.int64), np.concatenate(values).astype(float), np.concatenate(complement)
+
+
+def log_posterior(compiled, case):
+    """
+    Returns the unnormalised log posterior of a case under the published
+    templates (log prior + starting likelihood + ordered tests).
+    """
+    values = compiled.log_priors + compiled.log_starting_likelihood_array(case["demographics"], case["symptoms"], case["vitals"])
+    for test_name, result in case["tests"].items():
+        if test_name in compiled.tests:
+            values = values + compiled.test_log_likelihood_array(test_name, result)
+    return values
+
+
+def perturbed_log_posteriors(point, rows, values, complement, sampled):
+    """
+    Log posteriors of a batch of perturbed models: the point estimate with
+    every parameter's log factor swapped for its perturbed value.
+
+    Params:
+        point (np.ndarray): (diseases,) log posterior under the published parameters
+        rows, values, complement (np.ndarray): (parameters,) as from case_parameters
+        sampled (np.ndarray): (samples, parameters) perturbed values
+
+    Returns:
+        log_posteriors (np.ndarray): (samples, diseases)
+    """
+    m, n = len(sampled), len(point)
+    published = np.where(complement, np.log1p(-values), np.log(values))
+    perturbed = np.where(complement, np.log1p(-sampled), np.log(sampled))
+    index = (np.arange(m)[:, None] * n + rows).ravel()
+    shift = np.bincount(index, (perturbed - published).ravel(), minlength=m * n).reshape(m, n)
+    return point + shift
+
+
+def analyse(compiled, case, samples=DEFAULT_SAMPLES, concentration=DEFAULT_CONCENTRATION, level=DEFAULT_LEVEL, top=None, seed=None):
+    """
+    Measures how robust the posterior of a case is to uncertainty in the
+    published probabilities. Every parameter p the case depends on (see
+    case_parameters) is redrawn from Beta(concentration * p,
+    concentration * (1 - p)), which has mean p and about the spread of a
+    proportion estimated from concentration patients, and the posterior is
+    evaluated under every perturbed model. All models are scored together as
+    (samples, diseases) arrays, a chunk of samples at a time.
+
+    Parameters of exactly 0 or 1 are kept fixed.
+
+    Params:
+        compiled (model.CompiledModel)
+        case (dict): {"demographics", "symptoms", "vitals", "tests"}
+        samples (int): number of perturbed models
+        concentration (float): Beta concentration; larger means less uncertainty
+        level (float): credible interval mass, e.g. 0.95
+        top (int): only report the top diseases by posterior (optional, defaults to all)
+        seed (int): random seed (optional)
+
+    Returns:
+        analysis (dict): {"samples", "concentration", "level", "parameters",
+            "diseases": [{"name", "probability", "mean", "lower", "upper", "top_frequency"}]}
+            with diseases by descending published posterior; top_frequency is the
+            fraction of perturbed models in which the disease is the most probable.
+    """
+    rng = np.random.default_rng(seed)
+    point = log_posterior(compiled, case)
+    n = len(point)
+    with np.errstate(over="ignore", invalid="ignore"):
+        probability = np.exp(point - point.max())
+    probability /= probability.sum()
+
+    order = np.argsort(-probability, kind="stable")
+    reported = order if top is None else order[:top]
+
+    rows, values, complement = case_parameters(compiled, case)
+    free = (values > 0) & (values < 1)
+    rows, values, complement = rows[free], values[free], complement[free]
+    a, b = concentration * values, concentration * (1 - values)
+
+    kept = np.empty((samples, len(reported)), dtype=np.float32)
+    top_counts = np.zeros(n, dtype=np.int64)
+    chunk = max(1, CHUNK_ELEMENTS // max(n, len(values), 1))
+    for start in range(0, samples, chunk):
+        m = min(chunk, samples - start)
+        sampled = np.clip(rng.beta(a, b, size=(m, len(values))), _EPSILON, 1 - _EPSILON)
+        log_posteriors = perturbed_log_posteriors(point, rows, values, complement, sampled)
+        log_posteriors -= log_posteriors.max(axis=1, keepdims=True)
+        probs = np.exp(log_posteriors)
+        probs /= probs.sum(axis=1, keepdims=True)
+        kept[start:start + m] = probs[:, reported]
+        top_counts += np.bincount(probs.argmax(axis=1), minlength=n)
+
+    lower, upper = np.quantile(kept, [(1 - level) / 2, (1 + level) / 2], axis=0)
+    mean = kept.mean(axis=0, dtype=float)
+    return {
+        "samples": samples,
+        "concentration": concentration,
+        "level": level,
+        "parameters": len(values),
+        "diseases": [{
+            "name": compiled.names[d],
+            "probability": float(probability[d]),
+            "mean": float(mean[i]),
+            "lower": float(lower[i]),
+            "upper": float(upper[i]),
+            "top_frequency": float(top_counts[d] / samples)
+        } for i, d in enumerate(reported.tolist())]
+    }
+
+
+def format_report(analysis):
+    """
+    Returns an analysis as a text table, one row per disease.
+    """
+    width = max([len(d["name"]) for d in analysis["diseases"]] + [7])
+    pct = f"{analysis['level']:.0%}"
+    lines = [f"{analysis['samples']} models, {analysis['parameters']} perturbed parameters, concentration {analysis['concentration']:g}",
+             f"{'disease':<{width}}{'posterior':>11}{'mean':>9}{pct + ' interval':>22}{'top':>8}"]
+    for d in analysis["diseases"]:
+        interval = f"[{d['lower']:.4f}, {d['upper']:.4f}]"
+        lines.append(f"{d['name']:<{width}}{d['probability']:>11.4f}{d['mean']:>9.4f}{interval:>22}{d['top_frequency']:>8.1%}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Credible intervals of a case's posterior under perturbed template probabilities.")
+    parser.add_argument("case", help="case file: a hand-written case like sample_case.json, or a case as returned by the API")
+    parser.add_argument("--folder", action="append", help="template folder (repeat for several; default: digestive diseases and other-diseases)")
+    parser.add_argument("--samples", type=int, default=DEFAULT_SAMPLES)
+    parser.add_argument("--concentration", type=float, default=DEFAULT_CONCENTRATION)
+    parser.add_argument("--level", type=float, default=DEFAULT_LEVEL)
+    parser.add_argument("--top", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    args = parser.parse_args()
+
+    templates = []
+    for folder in args.folder or ["digestive diseases", "other-diseases"]:
+        templates.extend(load_case.load_disease_templates(folder))
+    with open(args.case) as f:
+        case = json.load(f)
+    if "demographics" not in case:
+        case = load_case.convert_sample_case(case, templates)
+
+    analysis = analyse(model.compile_model(templates), case, args.samples, args.concentration, args.level, args.top, args.seed)
+    print(json.dumps(analysis, indent=2) if args.json else format_report(analysis))
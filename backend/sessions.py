@@ -0,0 +1,403 @@
+import abc
+import itertools
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Limits of the store create_store makes when none are given or configured:
+# enough sessions for a busy node, and idle sessions expire after two hours
+DEFAULT_MAX_ENTRIES = 200000
+DEFAULT_TTL = 2 * 3600.0
+
+
+class SessionStore(abc.ABC):
+    """
+    Interface for storing cases by session_id. Used like a dict:
+
+        store[session_id] = case
+        case = store.get(session_id)
+        store.pop(session_id, None)
+
+    Stores may hand out copies, so a case modified after get() must be written
+    back with store[session_id] = case.
+
+    Every store keeps counters for hits, misses and evictions (see stats()).
+    If on_evict is set, it is called with the list of session_ids after each
+    batch of evictions (for expired or surplus entries, not pop), so state kept
+    elsewhere about those sessions can be dropped too.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.on_evict = None
+
+
+    @abc.abstractmethod
+    def get(self, key, default=None):
+        """
+        Returns the case stored for key (counting a hit or miss), or default.
+        """
+
+
+    @abc.abstractmethod
+    def __setitem__(self, key, value):
+        """
+        Stores a case for key, evicting entries over the store's limits.
+        """
+
+
+    @abc.abstractmethod
+    def pop(self, key, default=None):
+        """
+        Removes and returns the case stored for key, or default.
+        """
+
+
+    @abc.abstractmethod
+    def __len__(self):
+        """
+        Returns the number of stored sessions.
+        """
+
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+    @abc.abstractmethod
+    def sample(self, k):
+        """
+        Returns up to k stored cases without counting as accesses (for size estimates).
+        """
+
+
+    def _evicted(self, keys):
+        """
+        Counts evicted keys and passes them to on_evict. Caller must not hold a lock.
+        """
+        if keys:
+            self.evictions += len(keys)
+            if self.on_evict is not None:
+                self.on_evict(keys)
+
+
+    def stats(self):
+        """
+        Returns {"entries", "hits", "misses", "evictions"}.
+        """
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class MemorySessionStore(SessionStore):
+    """
+    In-process session store with a cap on the number of entries, an idle TTL
+    and least-recently-used eviction.
+
+    Entries are kept in access order, so the oldest are always at the front.
+    Expired entries are swept there, a few at a time on every write and fully at
+    most once per sweep_interval seconds, so no background thread is needed.
+
+    Params:
+        max_entries (int): maximum number of sessions (optional, unbounded if None)
+        ttl (float): seconds a session may stay idle before it expires (optional, never if None)
+        sweep_interval (float): seconds between full sweeps of expired entries
+    """
+
+    def __init__(self, max_entries=None, ttl=None, sweep_interval=60):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._entries = OrderedDict()  # key => (value, last access)
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expired = self.ttl is not None and now - entry[1] > self.ttl
+            if expired:
+                del self._entries[key]
+                self.misses += 1
+            else:
+                self._entries[key] = (entry[0], now)
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if expired:
+            self._evicted([key])
+            return default
+        return entry[0]
+
+
+    def __setitem__(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = (value, now)
+            self._entries.move_to_end(key)
+            evicted = self._sweep(now, full=now - self._last_sweep >= self.sweep_interval)
+            while self.max_entries is not None and len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+        self._evicted(evicted)
+
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def sample(self, k):
+        with self._lock:
+            return [value for value, _ in itertools.islice(self._entries.values(), k)]
+
+
+    def sweep(self):
+        """
+        Removes every expired entry now.
+        """
+        now = time.monotonic()
+        with self._lock:
+            evicted = self._sweep(now, full=True)
+        self._evicted(evicted)
+
+
+    def _sweep(self, now, full, batch=8):
+        """
+        Removes expired entries from the front (least recently used end). Stops at
+        the first live entry, or after batch entries unless full. Caller holds the
+        lock, and passes the returned keys to _evicted once it is released.
+
+        Returns:
+            keys (list): removed keys
+        """
+        removed = []
+        if self.ttl is None:
+            return removed
+        while self._entries and (full or len(removed) < batch):
+            key, (_, accessed) = next(iter(self._entries.items()))
+            if now - accessed <= self.ttl:
+                break
+            del self._entries[key]
+            removed.append(key)
+        if full:
+            self._last_sweep = now
+        return removed
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Session store in a SQLite database, so several worker processes can share
+    sessions. Cases are pickled; an entry that no longer loads (LookupError,
+    e.g. a case whose knowledge-base version is gone, see
+    compact_case.set_layout_resolver) reads as missing. Has the same max_entries and ttl limits as
+    MemorySessionStore; expired and surplus entries are swept at most once per
+    sweep_interval seconds on write. Counters are per process.
+
+    Params:
+        path (str): database file
+        max_entries (int): maximum number of sessions (optional, unbounded if None)
+        ttl (float): seconds a session may stay idle before it expires (optional, never if None)
+        sweep_interval (float): seconds between sweeps
+    """
+
+    def __init__(self, path, max_entries=None, ttl=None, sweep_interval=60):
+        super().__init__()
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._last_sweep = 0.0
+
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, value BLOB NOT NULL, accessed REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS sessions_accessed ON sessions (accessed)")
+
+
+    def _connect(self):
+        """
+        Returns this thread's connection (sqlite3 connections are not shared across threads).
+        """
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+
+    def get(self, key, default=None):
+        now = time.time()
+        db = self._connect()
+        row = db.execute("SELECT value, accessed FROM sessions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        if self.ttl is not None and now - row[1] > self.ttl:
+            with db:
+                db.execute("DELETE FROM sessions WHERE key = ?", (key,))
+            self.misses += 1
+            self._evicted([key])
+            return default
+        try:
+            value = pickle.loads(row[0])
+        except LookupError:
+            self.misses += 1
+            return default
+        with db:
+            db.execute("UPDATE sessions SET accessed = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return value
+
+
+    def __setitem__(self, key, value):
+        now = time.time()
+        db = self._connect()
+        with db:
+            db.execute("INSERT OR REPLACE INTO sessions (key, value, accessed) VALUES (?, ?, ?)", (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now))
+        if now - self._last_sweep >= self.sweep_interval:
+            self.sweep()
+
+
+    def pop(self, key, default=None):
+        db = self._connect()
+        with db:
+            row = db.execute("SELECT value FROM sessions WHERE key = ?", (key,)).fetchone()
+            db.execute("DELETE FROM sessions WHERE key = ?", (key,))
+        return default if row is None else _loads(row[0], default)
+
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+    def sample(self, k):
+        rows = self._connect().execute("SELECT value FROM sessions LIMIT ?", (k,)).fetchall()
+        return [value for value in (_loads(row[0], None) for row in rows) if value is not None]
+
+
+    def sweep(self):
+        """
+        Removes expired entries, then the least recently used entries over max_entries.
+        """
+        now = time.time()
+        db = self._connect()
+        evicted = []
+        with db:
+            if self.ttl is not None:
+                evicted += db.execute("DELETE FROM sessions WHERE accessed < ? RETURNING key", (now - self.ttl,)).fetchall()
+            if self.max_entries is not None:
+                evicted += db.execute(
+                    "DELETE FROM sessions WHERE key IN (SELECT key FROM sessions ORDER BY accessed DESC LIMIT -1 OFFSET ?) RETURNING key",
+                    (self.max_entries,)
+                ).fetchall()
+        self._last_sweep = now
+        self._evicted([row[0] for row in evicted])
+
+
+def _loads(data, default):
+    """
+    Unpickles a stored value, or returns default if it no longer loads (LookupError).
+    """
+    try:
+        return pickle.loads(data)
+    except LookupError:
+        return default
+
+
+class SessionLocks:
+    """
+    One lock per session, so concurrent requests of a session that read its
+    case, change it and write it back run one at a time instead of overwriting
+    each other's changes. A session's lock exists only while a request holds
+    or waits for it.
+
+        with locks.hold(session_id):
+            case = store.get(session_id)
+            ...
+            store[session_id] = case
+    """
+
+    def __init__(self):
+        self._locks = {}  # session_id => [lock, requests holding or waiting for it]
+        self._lock = threading.Lock()
+
+
+    @contextmanager
+    def hold(self, session_id):
+        with self._lock:
+            entry = self._locks.get(session_id)
+            if entry is None:
+                entry = self._locks[session_id] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[session_id]
+
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locks)
+
+
+def create_store(spec=None, max_entries=None, ttl=None):
+    """
+    Returns a session store from a spec string.
+
+    Params:
+        spec (str): "memory" or "sqlite:<path>" (optional, defaults to the
+            SYMPLI_SESSION_STORE environment variable, then "memory")
+        max_entries (int): maximum number of sessions (optional, defaults to
+            SYMPLI_SESSION_MAX, then DEFAULT_MAX_ENTRIES; 0 for unbounded)
+        ttl (float): idle seconds before a session expires (optional, defaults to
+            SYMPLI_SESSION_TTL, then DEFAULT_TTL; 0 for never)
+
+    Returns:
+        store (SessionStore)
+    """
+    spec = spec or os.environ.get("SYMPLI_SESSION_STORE", "memory")
+    if max_entries is None:
+        max_entries = int(os.environ.get("SYMPLI_SESSION_MAX", DEFAULT_MAX_ENTRIES))
+    if ttl is None:
+        ttl = float(os.environ.get("SYMPLI_SESSION_TTL", DEFAULT_TTL))
+    max_entries = max_entries or None
+    ttl = ttl or None
+
+    if spec == "memory":
+        return MemorySessionStore(max_entries=max_entries, ttl=ttl)
+    if spec.startswith("sqlite:"):
+        return SQLiteSessionStore(spec[len("sqlite:"):], max_entries=max_entries, ttl=ttl)
+    raise ValueError(f"Unknown session store '{spec}'")
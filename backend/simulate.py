@@ -0,0 +1,298 @@
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import numpy as np
+import load_case
+import model
+import posterior
+
+CALIBRATION_BINS = 10
+
+# Per-worker state, set once by _init_worker
+_templates = None
+_model = None
+_tests = None
+
+
+def policy_none(case, tests, rng):
+    """
+    Orders no tests; the diagnosis is read from the starting posterior.
+    """
+    return []
+
+
+def policy_all(case, tests, rng):
+    """
+    Orders every available test in catalog order.
+    """
+    return list(tests)
+
+
+def make_policy(spec):
+    """
+    Returns a policy function from its command line spec.
+
+    A policy is called as policy(case, tests, rng) and returns the list of test
+    names to order, in order.
+
+    Params:
+        spec (str): "none", "all", "random:<k>" (k tests chosen at random) or
+            "fixed:<test>,<test>,..." (the same sequence for every case)
+
+    Returns:
+        policy (function)
+    """
+    name, _, arg = spec.partition(":")
+    if name == "none":
+        return policy_none
+    if name == "all":
+        return policy_all
+    if name == "random":
+        k = int(arg)
+        return lambda case, tests, rng: rng.sample(tests, min(k, len(tests)))
+    if name == "fixed":
+        fixed = arg.split(",")
+        return lambda case, tests, rng: [t for t in fixed if t in tests]
+    raise ValueError(f"Unknown policy '{spec}'")
+
+
+def available_tests(templates):
+    """
+    Returns tests any template defines, in order of first appearance. A case can
+    only be given the ones its own disease defines (as in the app).
+    """
+    return list(dict.fromkeys(t for d in templates for t in d["diagnostic_tests"]))
+
+
+def simulate_case(templates, compiled, tests, policy, rng):
+    """
+    Plays out one synthetic case the way the app does: generate, order the tests
+    chosen by policy with randomly sampled results, read the posterior.
+
+    Params:
+        templates (list): list of disease templates (dict)
+        compiled (CompiledModel): compiled templates
+        tests (list): tests the policy may order
+        policy (function): see make_policy
+        rng (random.Random)
+
+    Returns:
+        case (dict): generated case, with "tests" filled in
+        probs (np.ndarray): (diseases,) final posterior, in compiled.names order
+    """
+    case = load_case.generate_random_case(templates, rng)
+    post = posterior.from_model(compiled)
+    post.add(compiled.log_starting_likelihood_array(case["demographics"], case["symptoms"], case["vitals"]))
+
+    test_data = compiled.template_for(case["name"])["diagnostic_tests"]
+    for test_name in policy(case, [t for t in tests if t in test_data], rng):
+        result = load_case.sample_test_result(test_data[test_name], rng)
+        case["tests"][test_name] = result
+        post.add_sparse(*compiled.test_log_likelihood(test_name, result))
+
+    return case, post.probability_array()
+
+
+def new_stats(diseases):
+    """
+    Returns empty aggregate statistics for a run over the given number of diseases.
+    """
+    return {
+        "cases": 0,
+        "correct": 0,
+        "brier": 0.0,
+        "confusion": {},
+        "calibration_count": np.zeros((diseases, CALIBRATION_BINS), dtype=np.int64),
+        "calibration_hits": np.zeros((diseases, CALIBRATION_BINS), dtype=np.int64),
+        "calibration_prob": np.zeros((diseases, CALIBRATION_BINS))
+    }
+
+
+def merge_stats(total, part):
+    """
+    Adds the statistics in part to total, in place.
+    """
+    total["cases"] += part["cases"]
+    total["correct"] += part["correct"]
+    total["brier"] += part["brier"]
+    for key, count in part["confusion"].items():
+        total["confusion"][key] = total["confusion"].get(key, 0) + count
+    for key in ("calibration_count", "calibration_hits", "calibration_prob"):
+        total[key] += part[key]
+
+
+def _init_worker(folder):
+    """
+    Loads and compiles the templates once per worker process.
+    """
+    global _templates, _model, _tests
+    _templates = load_case.load_disease_templates(folder)
+    _model = model.compile_model(_templates)
+    _tests = available_tests(_templates)
+
+
+def _simulate_chunk(args):
+    """
+    Simulates a chunk of n cases with its own seeded RNG.
+
+    Returns:
+        lines (list): one compact JSON record per case
+        stats (dict): aggregate statistics of the chunk (see new_stats)
+    """
+    seed, n, policy_spec = args
+    rng = random.Random(seed)
+    policy = make_policy(policy_spec)
+    rows = np.arange(len(_model.names))
+
+    lines = []
+    stats = new_stats(len(_model.names))
+    for _ in range(n):
+        case, probs = simulate_case(_templates, _model, _tests, policy, rng)
+        true = _model.index[case["name"]]
+        guess = int(probs.argmax())
+
+        stats["cases"] += 1
+        stats["correct"] += guess == true
+        stats["confusion"][(true, guess)] = stats["confusion"].get((true, guess), 0) + 1
+
+        hits = rows == true
+        stats["brier"] += float(((probs - hits) ** 2).sum())
+        bins = np.minimum((probs * CALIBRATION_BINS).astype(int), CALIBRATION_BINS - 1)
+        np.add.at(stats["calibration_count"], (rows, bins), 1)
+        np.add.at(stats["calibration_hits"], (rows, bins), hits)
+        np.add.at(stats["calibration_prob"], (rows, bins), probs)
+
+        lines.append(json.dumps({"d": true, "m": guess, "p": round(float(probs[guess]), 4), "pt": round(float(probs[true]), 4), "t": case["tests"]}, separators=(",", ":")))
+
+    return lines, stats
+
+
+def report(names, stats):
+    """
+    Builds the accuracy, confusion matrix and calibration report from aggregate statistics.
+
+    Params:
+        names (list): disease names, in the row order of the statistics
+        stats (dict): see new_stats
+
+    Returns:
+        report (dict): {"cases", "accuracy", "brier", "confusion", "per_disease"}
+    """
+    n = stats["cases"]
+    confusion = {name: {} for name in names}
+    for (true, guess), count in sorted(stats["confusion"].items()):
+        confusion[names[true]][names[guess]] = count
+
+    per_disease = {}
+    for i, name in enumerate(names):
+        cases = sum(confusion[name].values())
+        calibration = []
+        for b in range(CALIBRATION_BINS):
+            count = int(stats["calibration_count"][i, b])
+            if count:
+                calibration.append({
+                    "bin": [b / CALIBRATION_BINS, (b + 1) / CALIBRATION_BINS],
+                    "count": count,
+                    "mean_predicted": float(stats["calibration_prob"][i, b] / count),
+                    "observed": float(stats["calibration_hits"][i, b] / count)
+                })
+        per_disease[name] = {
+            "cases": cases,
+            "accuracy": confusion[name].get(name, 0) / cases if cases else None,
+            "calibration": calibration
+        }
+
+    return {
+        "cases": n,
+        "accuracy": stats["correct"] / n if n else None,
+        "brier": stats["brier"] / n if n else None,
+        "confusion": confusion,
+        "per_disease": per_disease
+    }
+
+
+def run(folder="digestive diseases", n_cases=10000, policy="all", workers=None, seed=0, output=None, chunk_size=1000):
+    """
+    Simulates n_cases synthetic cases over a process pool and returns the report.
+
+    Cases are split into chunks, each with an RNG seeded from seed, so results
+    do not depend on the number of workers. Per-case records are streamed to
+    output as JSON lines as chunks finish (first line is a header with the
+    disease names the records index into).
+
+    Params:
+        folder (dir): folder with JSON disease templates
+        n_cases (int): number of cases to simulate
+        policy (str): test ordering policy, see make_policy
+        workers (int): number of processes (optional, defaults to CPU count; 1 runs in-process)
+        seed (int): base seed
+        output (str): path of the JSON lines output (optional)
+        chunk_size (int): cases per task, at least 1
+
+    Returns:
+        report (dict): see report
+    """
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be at least 1, got {chunk_size}")
+    make_policy(policy)  # fail early on a bad spec
+    chunks = []
+    seeds = np.random.SeedSequence(seed).spawn((n_cases + chunk_size - 1) // chunk_size)
+    for i, s in enumerate(seeds):
+        chunks.append((int(s.generate_state(1)[0]), min(chunk_size, n_cases - i * chunk_size), policy))
+
+    names = model.compile_model(load_case.load_disease_templates(folder)).names
+    stats = new_stats(len(names))
+    out = open(output, "w") if output else None
+    try:
+        if out:
+            out.write(json.dumps({"diseases": names, "policy": policy, "seed": seed}) + "\n")
+
+        if workers == 1:
+            _init_worker(folder)
+            results = map(_simulate_chunk, chunks)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(folder,))
+            results = pool.imap_unordered(_simulate_chunk, chunks)
+
+        for lines, part in results:
+            merge_stats(stats, part)
+            if out:
+                out.write("\n".join(lines) + "\n")
+
+        if pool:
+            pool.close()
+            pool.join()
+    finally:
+        if out:
+            out.close()
+
+    return report(names, stats)
+
+
+def _positive_int(value):
+    """
+    argparse type of options that must be an integer of at least 1.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo simulation of diagnostic accuracy over synthetic cases.")
+    parser.add_argument("--folder", default="digestive diseases", help="folder with JSON disease templates")
+    parser.add_argument("--cases", type=int, default=10000, help="number of cases to simulate")
+    parser.add_argument("--policy", default="all", help='"none", "all", "random:<k>" or "fixed:<test>,<test>,..."')
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON lines file for per-case records")
+    parser.add_argument("--chunk-size", type=_positive_int, default=1000, help="cases per task")
+    args = parser.parse_args()
+
+    result = run(args.folder, args.cases, args.policy, args.workers, args.seed, args.output, args.chunk_size)
+    json.dump(result, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,291 @@
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import numpy as np
+import load_case
+import model
+
+logger = logging.getLogger(__name__)
+
+# File layout: MAGIC, header length (little-endian uint64), JSON header, then the
+# arrays, each starting on an ALIGNMENT byte boundary. The header records the
+# source file stats, the model's name tables and test layout, and each array's
+# dtype, shape and offset. The templates themselves are not stored: serving
+# only needs the compiled model, and case generation reads them from the
+# source files when first needed (see reloader.ModelVersion.templates).
+MAGIC = b"SYMPLI\x00\x01"
+FORMAT_VERSION = 4
+ALIGNMENT = 64
+
+
+class SnapshotError(Exception):
+    """
+    Raised when a snapshot cannot be built or read.
+    """
+
+
+def default_path(folder):
+    """
+    Returns the snapshot path used for a template folder: "<folder>.snapshot" next to it.
+    """
+    return os.path.normpath(folder) + ".snapshot"
+
+
+def validate_templates(templates):
+    """
+    Raises SnapshotError listing every problem found in the templates.
+
+    Params:
+        templates (list): list of disease templates (dict)
+    """
+    problems = []
+    binary = {}
+    for template in templates:
+        name = template.get("name", "<unnamed>")
+        problems.extend(f"{name}: {p}" for p in load_case.validate_template(template))
+        for test_name, test_data in template.get("diagnostic_tests", {}).items():
+            # A test is compiled once across templates, so they must agree on its kind
+            if binary.setdefault(test_name, test_data.get("Binary")) != test_data.get("Binary"):
+                problems.append(f"{name}: diagnostic_tests.{test_name} is binary in some templates and not in others")
+    if problems:
+        raise SnapshotError("Invalid templates:\n  " + "\n  ".join(problems))
+
+
+def build_snapshot(folder, path=None):
+    """
+    Validates and compiles the templates in folder and writes them to a single
+    snapshot file. The file is written next to its final path and renamed into
+    place, so readers never see a partial snapshot.
+
+    Params:
+        folder (dir): folder with JSON disease templates
+        path (str): snapshot file (optional, defaults to default_path(folder))
+
+    Returns:
+        path (str): snapshot file written
+    """
+    path = path or default_path(folder)
+    stats = load_case.template_file_stats(folder)
+    templates = load_case.load_disease_templates(folder)
+    validate_templates(templates)
+    compiled = model.compile_model(templates)
+
+    data = snapshot_bytes(compiled, stats)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def snapshot_bytes(compiled, stats):
+    """
+    Serialises a compiled model to the snapshot format.
+
+    Params:
+        compiled (CompiledModel): compiled templates
+        stats (dict): {filename: (mtime_ns, size)} of the source files
+
+    Returns:
+        data (bytes)
+    """
+    tables, arrays = compiled.to_arrays()
+
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += array.nbytes
+
+    header = json.dumps({
+        "format": FORMAT_VERSION,
+        "version": load_case.templates_fingerprint(stats),
+        "sources": stats,
+        "tables": tables,
+        "arrays": layout
+    }).encode()
+
+    start = _align(len(MAGIC) + 8 + len(header))
+    data = bytearray(start + offset)
+    data[:len(MAGIC)] = MAGIC
+    data[len(MAGIC):len(MAGIC) + 8] = struct.pack("<Q", len(header))
+    data[len(MAGIC) + 8:len(MAGIC) + 8 + len(header)] = header
+    for name, array in arrays.items():
+        begin = start + layout[name]["offset"]
+        data[begin:begin + array.nbytes] = np.ascontiguousarray(array).tobytes()
+    return bytes(data)
+
+
+def read_snapshot(buffer):
+    """
+    Reads a snapshot from a buffer (bytes, mmap or shared memory) without copying
+    the arrays; they are read-only views of the buffer.
+
+    Params:
+        buffer (buffer): snapshot contents
+
+    Returns:
+        header (dict): {"format", "version", "sources", "tables", "arrays"}
+        compiled (CompiledModel): without templates, see CompiledModel.from_arrays
+    """
+    view = memoryview(buffer)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise SnapshotError("Not a snapshot file")
+    (length,) = struct.unpack("<Q", view[len(MAGIC):len(MAGIC) + 8])
+    header = json.loads(bytes(view[len(MAGIC) + 8:len(MAGIC) + 8 + length]))
+    if header["format"] != FORMAT_VERSION:
+        raise SnapshotError(f"Unsupported snapshot format {header['format']}")
+
+    start = _align(len(MAGIC) + 8 + length)
+    arrays = {}
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"])
+        count = int(np.prod(info["shape"], dtype=np.int64))
+        array = np.frombuffer(view, dtype=dtype, count=count, offset=start + info["offset"]).reshape(info["shape"])
+        array.flags.writeable = False
+        arrays[name] = array
+
+    header["sources"] = {f: tuple(s) for f, s in header["sources"].items()}
+    return header, model.CompiledModel.from_arrays(header["tables"], arrays)
+
+
+def load_snapshot(path):
+    """
+    Memory-maps a snapshot file. Pages are shared between every process that maps
+    the same file, and are only read when used.
+
+    Params:
+        path (str): snapshot file
+
+    Returns:
+        header (dict): see read_snapshot
+        compiled (CompiledModel)
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return read_snapshot(buffer)
+
+
+def load_fresh_snapshot(folder, path=None):
+    """
+    Loads the snapshot of folder if it exists and matches the current template
+    files (names, mtimes and sizes).
+
+    Params:
+        folder (dir): folder with JSON disease templates
+        path (str): snapshot file (optional, defaults to default_path(folder))
+
+    Returns:
+        header (dict), compiled (CompiledModel); or None if there is no usable snapshot
+    """
+    path = path or default_path(folder)
+    if not os.path.exists(path):
+        return None
+    try:
+        header, compiled = load_snapshot(path)
+    except (OSError, ValueError, KeyError, SnapshotError):
+        logger.exception("Could not read snapshot '%s'; falling back to JSON templates", path)
+        return None
+    if header["sources"] != load_case.template_file_stats(folder):
+        logger.info("Snapshot '%s' is stale; falling back to JSON templates", path)
+        return None
+    return header, compiled
+
+
+def shared_segment_path(prefix, version):
+    """
+    Returns the path of the shared-memory segment of a knowledge-base version:
+    a file in SYMPLI_SHARED_MODEL_DIR, else /dev/shm (memory-backed), else the
+    temp folder. The version (templates fingerprint) in the name is the stamp
+    workers compare to notice a reload.
+    """
+    folder = os.environ.get("SYMPLI_SHARED_MODEL_DIR") or ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+    return os.path.join(folder, f"{prefix}_{version}.snapshot")
+
+
+def publish_shared(path, compiled, stats):
+    """
+    Writes a compiled model to a shared-memory segment in the snapshot format
+    and maps it, for other processes to attach with attach_shared. The segment
+    is renamed into place once complete, so no process sees a partial one.
+
+    Params:
+        path (str): segment path, see shared_segment_path
+        compiled (CompiledModel): compiled templates
+        stats (dict): {filename: (mtime_ns, size)} of the source files
+
+    Returns:
+        header (dict), compiled (CompiledModel) backed by the segment; or None
+        if the segment already exists (another process published it first)
+    """
+    if os.path.exists(path):
+        return None
+    data = snapshot_bytes(compiled, stats)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    try:
+        # link fails if another process published first, unlike rename
+        os.link(tmp, path)
+    except FileExistsError:
+        return None
+    finally:
+        os.remove(tmp)
+    return load_snapshot(path)
+
+
+def attach_shared(path, stats=None):
+    """
+    Maps a segment written by publish_shared, read-only and without copying.
+    Every process mapping it shares the same physical pages.
+
+    Params:
+        path (str): segment path, see shared_segment_path
+        stats (dict): {filename: (mtime_ns, size)} the segment must have been built from (optional)
+
+    Returns:
+        header (dict), compiled (CompiledModel) backed by the segment; or None
+        if there is no usable segment at path
+    """
+    try:
+        header, compiled = load_snapshot(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, SnapshotError):
+        logger.warning("Shared model '%s' is unreadable; compiling locally", path)
+        return None
+    if stats is not None and header["sources"] != stats:
+        return None
+    return header, compiled
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile a folder of disease templates into a snapshot file.")
+    parser.add_argument("folder", nargs="?", default="digestive diseases", help="folder with JSON disease templates")
+    parser.add_argument("-o", "--output", default=None, help="snapshot file (default: <folder>.snapshot)")
+    parser.add_argument("--check", action="store_true", help="only report whether the snapshot is up to date")
+    args = parser.parse_args()
+
+    if args.check:
+        fresh = load_fresh_snapshot(args.folder, args.output) is not None
+        print("up to date" if fresh else "stale or missing")
+        sys.exit(0 if fresh else 1)
+
+    try:
+        written = build_snapshot(args.folder, args.output)
+    except SnapshotError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    print(f"Wrote {written}")
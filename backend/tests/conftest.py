@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The backend modules are flat and import each other by name (import model),
+# as when run from the backend folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Tests that import app build cases on the request thread, without the
+# background case pool (see tests/test_case_pool.py)
+os.environ.setdefault("SYMPLI_CASE_POOL_HIGH", "0")
@@ -0,0 +1,64 @@
+import pytest
+import analytics
+import app
+
+
+@pytest.fixture
+def aggregates():
+    aggregates = analytics.DiagnosisAnalytics(flush_interval=3600)
+    yield aggregates
+    aggregates.close()
+
+
+def test_submissions_are_aggregated(aggregates):
+    known = {"flu", "cold"}
+    aggregates.diagnosis_submitted("kb", "Flu", "flu", True, {"Swab": False, "Exam": True}, seconds=20, known=known)
+    aggregates.diagnosis_submitted("kb", "Flu", "cold", False, {"Swab": False}, seconds=4000, known=known)
+    aggregates.flush()
+    aggregates.diagnosis_submitted("kb", "Cold", "cold", True, {}, known=known)
+
+    stats = aggregates.stats()
+    assert (stats["submissions"], stats["correct"]) == (3, 2)
+    flu = stats["diseases"]["kb"]["Flu"]
+    assert (flu["submissions"], flu["accuracy"]) == (2, 0.5)
+    assert flu["guesses"] == {"flu": 1, "cold": 1}
+    assert stats["by_kind"]["both"]["submissions"] == 1
+    assert stats["by_kind"]["none"]["correct"] == 1
+    assert stats["by_test"]["kb"]["Swab"] == {"submissions": 2, "correct": 1, "accuracy": 0.5}
+    assert list(stats["by_test_count"]) == ["0", "1", "2"]
+    assert stats["time_to_diagnosis"]["count"] == 2
+    assert stats["time_to_diagnosis"]["buckets"] == {"<=30": 1, "more": 1}
+
+
+def test_unknown_guesses_are_counted_as_other(aggregates):
+    for guess in ("made up", "another made up"):
+        aggregates.diagnosis_submitted("kb", "Flu", guess, False, {}, known={"flu"})
+    assert aggregates.stats()["diseases"]["kb"]["Flu"]["guesses"] == {analytics.OTHER_GUESS: 2}
+
+
+def test_counters_survive_in_the_database(tmp_path):
+    path = str(tmp_path / "analytics.db")
+    first = analytics.DiagnosisAnalytics(path, flush_interval=3600)
+    first.diagnosis_submitted("kb", "Flu", "flu", True, {})
+    first.close()
+
+    second = analytics.DiagnosisAnalytics(path, flush_interval=3600)
+    second.diagnosis_submitted("kb", "Flu", "cold", False, {})
+    assert second.stats()["diseases"]["kb"]["Flu"]["submissions"] == 2
+    second.close()
+
+
+def test_each_case_is_counted_once(monkeypatch):
+    aggregates = analytics.DiagnosisAnalytics(flush_interval=3600)
+    monkeypatch.setattr(app, "ANALYTICS", aggregates)
+    client = app.app.test_client()
+    client.get("/api/session_stats")
+    client.get("/api/new_case")
+    for _ in range(3):
+        assert client.post("/submit_diagnosis", json={"diagnosis": "not a disease"}).status_code == 200
+
+    stats = client.get("/api/stats").get_json()
+    assert stats["submissions"] == 1
+    (guesses,) = [d["guesses"] for kb in stats["diseases"].values() for d in kb.values()]
+    assert guesses == {analytics.OTHER_GUESS: 1}
+    aggregates.close()
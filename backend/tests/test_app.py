@@ -0,0 +1,217 @@
+import threading
+import time
+import numpy as np
+import pytest
+import app
+import journal
+import sessions
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def ordered_test(session_id):
+    """
+    Returns a test the case of session_id lists and has not ordered yet.
+    """
+    case = app.get_case(session_id)
+    tests = app.KNOWLEDGE_BASES.get(case.knowledge_base).get(case.model_version).model.diagnostic_tests(case.name)
+    return next(t for t in tests if t not in case.tests)
+
+
+def test_requests_without_cookies_share_test_user():
+    cookieless = app.app.test_client(use_cookies=False)
+    assert cookieless.get("/api/new_case").status_code == 200
+    assert cookieless.get("/api/current_case").status_code == 200
+    response = cookieless.post("/api/order_test", json={"test": ordered_test("test_user")})
+    assert response.status_code == 200
+
+
+def test_clients_with_cookies_get_their_own_session(client):
+    other = app.app.test_client()
+    client.get("/api/session_stats")
+    other.get("/api/session_stats")
+    client.get("/api/new_case")
+    assert other.get("/api/current_case").status_code == 404
+    assert client.get("/api/current_case").status_code == 200
+
+
+def test_new_cases_sends_the_priors_once(client):
+    response = client.get("/api/new_cases?n=20")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert sum(data["probabilities"].values()) == pytest.approx(1.0)
+    assert len(data["cases"]) == 20
+    assert all("probabilities" not in case and "name" not in case for case in data["cases"])
+
+    labelled = client.get("/api/new_cases?n=3&labels=true").get_json()["cases"]
+    assert all(case["name"] in data["probabilities"] for case in labelled)
+
+    assert client.get(f"/api/new_cases?n={app.MAX_BULK_CASES + 1}").status_code == 400
+    assert client.get("/api/new_cases?n=0").status_code == 400
+
+
+def session_id(client):
+    with client.session_transaction() as s:
+        return s["session_id"]
+
+
+def test_recommend_tests_ranks_unordered_tests(client):
+    client.get("/api/session_stats")
+    client.get("/api/new_case")
+    test_name = ordered_test(session_id(client))
+    assert client.post("/api/order_test", json={"test": test_name}).status_code == 200
+
+    data = client.get("/api/recommend_tests?budget=64").get_json()
+    gains = [r["expected_information_gain"] for r in data["recommendations"]]
+    assert gains == sorted(gains, reverse=True)
+    assert test_name not in [r["test"] for r in data["recommendations"]]
+    assert data["entropy"] >= gains[0] - 1e-9
+
+    assert client.get("/api/recommend_tests?budget=0").status_code == 400
+    assert client.get(f"/api/recommend_tests?budget={app.MAX_RECOMMEND_BUDGET + 1}").status_code == 400
+
+    other = app.app.test_client()
+    other.get("/api/session_stats")
+    assert other.get("/api/recommend_tests").status_code == 400
+
+
+def test_case_is_rebuilt_from_the_journal(client, tmp_path, monkeypatch):
+    events = journal.SessionJournal(str(tmp_path), snapshot_every=None)
+    monkeypatch.setattr(app, "JOURNAL", events)
+    client.get("/api/session_stats")
+    client.get("/api/new_case")
+    sid = session_id(client)
+    client.post("/api/order_test", json={"test": ordered_test(sid)})
+
+    case = app.user_cases.pop(sid)
+    rebuilt = app.get_case(sid)
+    assert rebuilt.to_dict() == case.to_dict()
+    assert rebuilt.created_at == case.created_at
+    np.testing.assert_allclose(rebuilt.posterior.probability_array(), case.posterior.probability_array())
+    events.close()
+
+
+def test_concurrent_orders_of_one_session_are_all_kept(client, tmp_path, monkeypatch):
+    # A store that hands out copies, so unserialised orders would overwrite each other
+    monkeypatch.setattr(app, "user_cases", sessions.SQLiteSessionStore(str(tmp_path / "sessions.db")))
+    client.get("/api/session_stats")
+    client.get("/api/new_case")
+    sid = session_id(client)
+    case = app.get_case(sid)
+    names = list(app.case_version(case).model.diagnostic_tests(case.name))
+    cookie = client.get_cookie(app.app.config["SESSION_COOKIE_NAME"]).value
+
+    # Widen the window between reading the case and storing it again
+    order_test_on = app.order_test_on
+
+    def slow_order_test_on(*args):
+        time.sleep(0.01)
+        return order_test_on(*args)
+
+    monkeypatch.setattr(app, "order_test_on", slow_order_test_on)
+    statuses = []
+
+    def order(test_name):
+        other = app.app.test_client()
+        other.set_cookie(app.app.config["SESSION_COOKIE_NAME"], cookie)
+        statuses.append(other.post("/api/order_test", json={"test": test_name}).status_code)
+
+    threads = [threading.Thread(target=order, args=(t,)) for t in names]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert statuses == [200] * len(names)
+    assert sorted(app.get_case(sid).tests) == sorted(names)
+
+
+def test_sensitivity_bounds_samples_times_top(client, monkeypatch):
+    client.get("/api/session_stats")
+    client.get("/api/new_case")
+    data = client.get("/api/sensitivity?samples=50&top=1").get_json()
+    assert len(data["diseases"]) == 1 and data["samples"] == 50
+
+    # top beyond the number of diseases means all of them
+    diseases = len(app.get_case(session_id(client)).layout.names)
+    assert len(client.get("/api/sensitivity?samples=20&top=100000000").get_json()["diseases"]) == diseases
+
+    monkeypatch.setattr(app, "MAX_SENSITIVITY_CELLS", 50 * diseases - 1)
+    assert client.get("/api/sensitivity?samples=50&top=1").status_code == 200
+    assert client.get("/api/sensitivity?samples=50&top=100000000").status_code == 400
+
+
+@pytest.mark.parametrize("value, expected", [(None, None), ("", None), ("1e-4", 1e-4), ("0.5", 0.5)])
+def test_active_set_epsilon_is_parsed(value, expected):
+    assert app.parse_active_set_epsilon(value) == expected
+
+
+@pytest.mark.parametrize("value", ["0", "1", "-0.1", "1.5", "nan", "inf", "often"])
+def test_active_set_epsilon_outside_0_1_is_rejected(value):
+    with pytest.raises(ValueError, match="SYMPLI_ACTIVE_SET_EPSILON"):
+        app.parse_active_set_epsilon(value)
+
+
+def test_order_tests_applies_the_panel_at_once(client):
+    client.get("/api/session_stats")
+    client.get("/api/new_case")
+    sid = session_id(client)
+    case = app.get_case(sid)
+    compiled = app.case_version(case).model
+    names = list(compiled.diagnostic_tests(case.name))[:2]
+    assert len(names) == 2
+    before = case.posterior.probability_array()
+
+    # Nothing is ordered unless every test is valid
+    assert client.post("/api/order_tests", json={"tests": names + ["No such test"]}).status_code == 404
+    assert client.post("/api/order_tests", json={"tests": names[:1] * 2}).status_code == 400
+    assert client.post("/api/order_tests", json={"tests": []}).status_code == 400
+    assert app.get_case(sid).tests == {}
+
+    data = client.post("/api/order_tests", json={"tests": names}).get_json()
+    assert [r["test_name"] for r in data["results"]] == names
+    log_likelihood = np.zeros(len(before))
+    for r in data["results"]:
+        base, rows, values = compiled.test_log_likelihood(r["test_name"], r["result"])
+        log_likelihood += base
+        log_likelihood[rows] += values
+    expected = before * np.exp(log_likelihood - log_likelihood.max())
+    expected /= expected.sum()
+    probabilities = data["probabilities"]
+    np.testing.assert_allclose([probabilities[name] for name in case.posterior.names], expected, atol=1e-12)
+
+    response = client.post("/api/order_tests", json={"tests": names[:1]})
+    assert response.status_code == 400 and names[0] in response.get_json()["error"]
+
+
+def test_current_case_is_not_sent_again_while_unchanged(client):
+    client.get("/api/session_stats")
+    client.get("/api/new_case")
+    first = client.get("/api/current_case")
+    etag = first.headers["ETag"]
+    unchanged = client.get("/api/current_case", headers={"If-None-Match": etag})
+    assert unchanged.status_code == 304 and unchanged.data == b""
+    assert client.get("/api/current_case?top=1", headers={"If-None-Match": etag}).status_code == 200
+
+    client.post("/api/order_test", json={"test": ordered_test(session_id(client))})
+    changed = client.get("/api/current_case", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+
+
+def test_top_and_delta_shorten_the_probabilities(client):
+    client.get("/api/session_stats")
+    data = client.get("/api/new_case?top=1").get_json()
+    assert len(data["probabilities"]) == 1
+    assert sum(data["probabilities"].values()) + data["other_probability"] == pytest.approx(1.0)
+
+    sid = session_id(client)
+    before = app.get_case(sid).posterior.probabilities()
+    data = client.post("/api/order_test?delta=0", json={"test": ordered_test(sid)}).get_json()
+    assert "probabilities" not in data
+    after = app.get_case(sid).posterior.probabilities()
+    assert data["changes"] == {name: p for name, p in after.items() if abs(p - before[name]) > 0}
+
+    assert client.post("/api/order_test?delta=2", json={"test": ordered_test(sid)}).status_code == 400
+    assert client.get("/api/current_case?top=0").status_code == 400
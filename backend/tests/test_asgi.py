@@ -0,0 +1,115 @@
+import asyncio
+import json
+import threading
+import pytest
+import app as wsgi
+import asgi
+import sessions
+
+
+@pytest.fixture(autouse=True)
+def limiter(monkeypatch):
+    # The limiter's semaphore belongs to the event loop it was first used on
+    monkeypatch.setattr(asgi, "LIMITER", asgi.Limiter(4, 16))
+
+
+async def request(method, path, body=None, headers=()):
+    """
+    Sends one request through asgi.app and returns (status, headers, body).
+    """
+    body = json.dumps(body).encode() if body is not None else b""
+    path, _, query = path.partition("?")
+    scope = {"type": "http", "method": method, "path": path, "query_string": query.encode(),
+             "headers": [(k.encode(), v.encode()) for k, v in headers]}
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi.app(scope, receive, send)
+    start = sent[0]
+    response_headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    return start["status"], response_headers, b"".join(m.get("body", b"") for m in sent[1:])
+
+
+def cookie_of(headers):
+    return [("cookie", headers["set-cookie"].split(";")[0])]
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_case_routes():
+    async def scenario():
+        status, headers, _ = await request("GET", "/api/reset")
+        cookie = cookie_of(headers)
+        status, _, body = await request("GET", "/api/new_case?top=3", headers=cookie)
+        assert status == 200 and "name" not in json.loads(body)
+
+        status, headers, body = await request("GET", "/api/current_case", headers=cookie)
+        assert status == 200
+        etag = headers["etag"]
+        status, _, body = await request("GET", "/api/current_case", headers=cookie + [("if-none-match", etag)])
+        assert status == 304 and body == b""
+
+        status, _, body = await request("POST", "/api/order_test", {"test": "No Such Test"}, headers=cookie)
+        assert status == 404
+        status, _, _ = await request("GET", "/api/unknown", headers=cookie)
+        assert status == 404
+        status, headers, _ = await request("POST", "/api/current_case", headers=cookie)
+        assert status == 405 and headers["allow"] == "GET"
+
+        await request("GET", "/api/reset", headers=cookie)
+        status, _, _ = await request("GET", "/api/current_case", headers=cookie)
+        assert status == 404
+    run(scenario())
+
+
+def test_concurrent_orders_of_one_session_are_all_kept(tmp_path, monkeypatch):
+    # A store that hands out copies, so unserialised orders would overwrite each other
+    monkeypatch.setattr(wsgi, "user_cases", sessions.SQLiteSessionStore(str(tmp_path / "sessions.db")))
+
+    async def scenario():
+        _, headers, _ = await request("GET", "/api/reset")
+        cookie = cookie_of(headers)
+        await request("GET", "/api/new_case", headers=cookie)
+        session_id = asgi.session_for(dict(cookie))[0]
+        case = wsgi.get_case(session_id)
+        names = list(wsgi.case_version(case).model.diagnostic_tests(case.name))
+        responses = await asyncio.gather(*(request("POST", "/api/order_test", {"test": t}, headers=cookie) for t in names))
+        assert [status for status, _, _ in responses] == [200] * len(names)
+        assert sorted(wsgi.get_case(session_id).tests) == sorted(names)
+        assert len(asgi.SESSION_LOCKS) == 0
+    run(scenario())
+
+
+def test_limiter_rejects_beyond_the_queue():
+    release = threading.Event()
+
+    async def scenario():
+        limiter = asgi.Limiter(1, 1)
+        running = asyncio.ensure_future(limiter.run(release.wait))
+        await asyncio.sleep(0.05)
+        queued = asyncio.ensure_future(limiter.run(lambda: "queued"))
+        await asyncio.sleep(0.05)
+        with pytest.raises(asgi.Overloaded):
+            await limiter.run(lambda: None)
+        release.set()
+        assert await running and await queued == "queued"
+    run(scenario())
+
+
+def test_overloaded_server_answers_503(monkeypatch):
+    async def overloaded(func, *args):
+        raise asgi.Overloaded()
+
+    monkeypatch.setattr(asgi, "compute", overloaded)
+
+    async def scenario():
+        status, headers, body = await request("GET", "/api/new_case")
+        assert status == 503 and headers["retry-after"] == "1"
+    run(scenario())
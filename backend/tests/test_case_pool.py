@@ -0,0 +1,97 @@
+import itertools
+import threading
+import time
+import types
+import pytest
+import case_pool
+
+
+class Knowledge:
+    """
+    make_case for a CasePool: numbered cases of the current version of each
+    knowledge base, and KeyError for the ones in unloaded.
+    """
+
+    def __init__(self):
+        self.versions = {"kb": "v1", "other": "v1"}
+        self.unloaded = set()
+        self.seeds = itertools.count()
+        self.lock = threading.Lock()
+
+
+    def __call__(self, kb):
+        if kb in self.unloaded:
+            raise KeyError(kb)
+        with self.lock:
+            seed = next(self.seeds)
+        return seed, types.SimpleNamespace(model_version=self.versions[kb])
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+@pytest.fixture
+def knowledge():
+    return Knowledge()
+
+
+@pytest.fixture
+def pool(knowledge):
+    pool = case_pool.CasePool(knowledge, low=2, high=5)
+    yield pool
+    pool.close()
+
+
+def test_pool_is_empty_until_started(pool):
+    assert pool.take("kb", "v1") is None
+    assert (pool.hits, pool.misses) == (0, 1)
+    assert pool.sizes() == {"kb": 0}
+
+
+def test_watched_pool_is_filled_to_high_and_refilled_below_low(pool):
+    pool.watch("kb")
+    pool.start()
+    wait_for(lambda: pool.sizes() == {"kb": 5})
+
+    taken = [pool.take("kb", "v1") for _ in range(3)]
+    assert [seed for seed, _ in taken] == [0, 1, 2]
+    assert pool.hits == 3
+    # Dropping below low refills up to high again
+    for _ in range(2):
+        pool.take("kb", "v1")
+    wait_for(lambda: pool.sizes() == {"kb": 5})
+
+
+def test_cases_of_an_older_version_are_dropped(pool, knowledge):
+    pool.watch("kb")
+    pool.start()
+    wait_for(lambda: pool.sizes() == {"kb": 5})
+
+    knowledge.versions["kb"] = "v2"
+    # Every pooled case is of v1, so none is handed out for v2
+    assert pool.take("kb", "v2") is None
+    wait_for(lambda: pool.sizes() == {"kb": 5})
+    seed, case = pool.take("kb", "v2")
+    assert case.model_version == "v2" and seed >= 5
+
+
+def test_unloaded_knowledge_base_stops_being_refilled(pool, knowledge):
+    knowledge.unloaded.add("other")
+    pool.watch("kb")
+    pool.watch("other")
+    pool.start()
+    wait_for(lambda: pool.sizes() == {"kb": 5})
+
+
+def test_zero_high_watermark_turns_the_pool_off(monkeypatch):
+    monkeypatch.setenv("SYMPLI_CASE_POOL_HIGH", "0")
+    assert case_pool.create_pool(Knowledge()) is None
+    monkeypatch.setenv("SYMPLI_CASE_POOL_HIGH", "8")
+    monkeypatch.setenv("SYMPLI_CASE_POOL_LOW", "100")
+    pool = case_pool.create_pool(Knowledge())
+    assert (pool.low, pool.high) == (8, 8)
+    assert not pool.started
@@ -0,0 +1,99 @@
+import os
+import pickle
+import random
+import numpy as np
+import pytest
+import compact_case
+import load_case
+import model
+import posterior
+import sessions
+from benchmarks import synthetic
+
+
+@pytest.fixture(scope="module")
+def templates():
+    return synthetic.generate_templates(40, n_symptoms=12, n_vitals=7, seed=9)
+
+
+@pytest.fixture(scope="module")
+def compiled(templates):
+    return model.compile_model(templates)
+
+
+def make_case(templates, compiled, seed=0, key=("kb", "v1")):
+    case = load_case.generate_random_case(templates, random.Random(seed))
+    post = posterior.from_model(compiled)
+    post.add(compiled.log_starting_likelihood_array(case["demographics"], case["symptoms"], case["vitals"]))
+    return case, compact_case.from_case(case, compiled, post, "id", *key)
+
+
+def test_fields_round_trip(templates, compiled):
+    layout = compact_case.layout_for(compiled)
+    rng = random.Random(3)
+    for _ in range(50):
+        case = load_case.generate_random_case(templates, rng)
+        # Cases need not list every symptom or vital
+        symptoms = dict(list(case["symptoms"].items())[::2])
+        vitals = dict(list(case["vitals"].items())[1::2])
+        assert layout.decode(layout.encode(case["demographics"], symptoms, vitals)) == (case["demographics"], symptoms, vitals)
+
+
+@pytest.mark.parametrize("value", [98.6, 2 ** 40])
+def test_vitals_that_do_not_pack_are_rejected(compiled, value):
+    layout = compact_case.layout_for(compiled)
+    with pytest.raises(ValueError):
+        layout.encode({"age": 30, "sex": layout.sexes[0], "race": layout.races[0]}, {}, {layout.vitals[0]: value})
+
+
+def test_case_matches_the_generated_case(templates, compiled):
+    case, compact = make_case(templates, compiled)
+    assert compact.to_dict() == {"name": case["name"], "knowledge_base": "kb", "demographics": case["demographics"],
+                                 "symptoms": case["symptoms"], "vitals": case["vitals"], "tests": case["tests"]}
+    assert compact.layout is compact_case.layout_for(compiled)
+
+
+def test_pickled_case_refers_to_its_layout(templates, compiled):
+    case, compact = make_case(templates, compiled)
+    data = pickle.dumps(compact, pickle.HIGHEST_PROTOCOL)
+    # Neither the vocabularies nor the posterior's names travel with the case
+    assert compiled.names[0].encode() not in data and compiled.symptoms[0].encode() not in data
+
+    restored = pickle.loads(data)
+    assert restored.layout is compact.layout
+    assert restored.posterior.names is compiled.names
+    assert restored.to_dict() == compact.to_dict()
+    np.testing.assert_array_equal(restored.posterior.probability_array(), compact.posterior.probability_array())
+
+
+def test_layout_is_resolved_after_a_restart(templates, monkeypatch):
+    compiled = model.compile_model(templates)
+    _, compact = make_case(templates, compiled, key=("kb", "v2"))
+    data = pickle.dumps(compact)
+    monkeypatch.setattr(compact_case, "_layouts_by_key", {})
+    monkeypatch.setattr(compact_case, "_layouts", {})
+    resolved = []
+
+    def resolve(kb, version):
+        resolved.append((kb, version))
+        return compiled
+
+    monkeypatch.setattr(compact_case, "_resolve_model", resolve)
+    assert pickle.loads(data).to_dict() == compact.to_dict()
+    assert pickle.loads(data).layout is pickle.loads(data).layout
+    assert resolved == [("kb", "v2")]
+
+
+def test_case_of_a_dropped_version_reads_as_missing(templates, monkeypatch, tmp_path):
+    compiled = model.compile_model(templates)
+    store = sessions.SQLiteSessionStore(os.path.join(tmp_path, "s.db"))
+    _, compact = make_case(templates, compiled, key=("kb", "v3"))
+    store["a"] = compact
+    monkeypatch.setattr(compact_case, "_layouts_by_key", {})
+
+    def resolve(kb, version):
+        raise LookupError(version)
+
+    monkeypatch.setattr(compact_case, "_resolve_model", resolve)
+    assert store.get("a") is None and store.misses == 1
+    assert store.sample(5) == []
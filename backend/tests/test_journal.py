@@ -0,0 +1,109 @@
+import json
+import os
+import time
+import pytest
+import journal
+
+
+@pytest.fixture
+def folder(tmp_path):
+    return os.path.join(tmp_path, "journal")
+
+
+def open_journal(folder, **kwargs):
+    return journal.SessionJournal(folder, fsync_interval=0.01, snapshot_every=None, **kwargs)
+
+
+def record_session(j, session_id, tests=("Test A", "Test B")):
+    j.case_created(session_id, "digestive", "v1", 42, "case-" + session_id, 1000.0)
+    for test_name in tests:
+        j.test_ordered(session_id, test_name, "positive")
+
+
+def test_replay_restores_sessions(folder):
+    j = open_journal(folder)
+    record_session(j, "a")
+    record_session(j, "b", tests=["Imaging"])
+    j.test_ordered("b", "Imaging", "positive")  # replayed twice, still ordered once
+    j.diagnosis_submitted("b", "Appendicitis", True)
+    record_session(j, "c")
+    j.reset("c")
+    j.close()
+
+    j = open_journal(folder)
+    assert sorted(j.sessions) == ["a", "b"]
+    a = j.sessions["a"]
+    assert (a.kb, a.version, a.seed, a.case_id, a.created_at) == ("digestive", "v1", 42, "case-a", 1000.0)
+    assert a.tests == (("Test A", "positive"), ("Test B", "positive")) and not a.diagnosed
+    assert j.sessions["b"].tests == (("Imaging", "positive"),) and j.sessions["b"].diagnosed
+    j.close()
+
+
+def test_torn_last_line_is_ignored(folder):
+    j = open_journal(folder)
+    record_session(j, "a")
+    j.close()
+    segment = j._segment(j.generation)
+    with open(segment, "a") as f:
+        f.write('{"e": "test", "s": "a", "te')
+
+    j = open_journal(folder)
+    assert len(j.sessions["a"].tests) == 2
+    j.close()
+
+
+def test_expired_sessions_are_dropped(folder):
+    j = open_journal(folder)
+    record_session(j, "a")
+    record_session(j, "b")
+    j.expired(["a"])
+    j.close()
+
+    j = open_journal(folder)
+    assert sorted(j.sessions) == ["b"]
+    j.close()
+
+
+def test_idle_sessions_expire_after_ttl(folder):
+    j = open_journal(folder)
+    record_session(j, "old")
+    time.sleep(0.2)
+    record_session(j, "new")
+    j.close()
+
+    j = open_journal(folder, ttl=0.1)
+    assert sorted(j.sessions) == ["new"]
+    j.close()
+
+
+def test_snapshot_replaces_older_segments(folder):
+    j = open_journal(folder)
+    record_session(j, "a")
+    j.snapshot()
+    record_session(j, "b")
+    j.close()
+
+    segments = [g for _, g in j._segments()]
+    with open(os.path.join(folder, "snapshot.json")) as f:
+        snapshot = json.load(f)
+    assert min(segments) == snapshot["generation"]
+    assert sorted(snapshot["sessions"]) == ["a"]
+
+    j = open_journal(folder)
+    assert sorted(j.sessions) == ["a", "b"]
+    assert j.sessions["a"].created_at == 1000.0 and len(j.sessions["a"].tests) == 2
+    j.close()
+
+
+def test_events_without_created_at_use_their_time(folder):
+    os.makedirs(folder)
+    with open(os.path.join(folder, "journal.00000001.log"), "w") as f:
+        f.write(json.dumps({"e": "new", "s": "a", "kb": "digestive", "v": "v1", "seed": 1, "id": "x", "t": 500.0}) + "\n")
+    j = open_journal(folder)
+    assert j.sessions["a"].created_at == 500.0
+    j.close()
+
+
+def test_create_journal_is_off_without_a_folder(monkeypatch):
+    monkeypatch.delenv("SYMPLI_JOURNAL", raising=False)
+    assert journal.create_journal() is None
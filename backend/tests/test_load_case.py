@@ -0,0 +1,43 @@
+import random
+import numpy as np
+import pytest
+import load_case
+from benchmarks import synthetic
+
+
+@pytest.fixture(scope="module")
+def templates():
+    return synthetic.generate_templates(20, seed=4)
+
+
+@pytest.mark.parametrize("weights", [[1, 1, 1, 1], [0.7, 0.2, 0.1], [5, 0, 3, 2, 0, 10]])
+def test_alias_table_samples_in_proportion(weights):
+    prob, alias = load_case.build_alias_table(weights)
+    draws = load_case.sample_alias(prob, alias, 200000, np.random.default_rng(0))
+    frequencies = np.bincount(draws, minlength=len(weights)) / len(draws)
+    np.testing.assert_allclose(frequencies, np.array(weights) / sum(weights), atol=0.005)
+
+
+def test_generated_cases_follow_the_priors(templates):
+    cases = load_case.generate_cases(templates, 50000, rng=1)
+    priors = np.array([t["prior"] for t in templates])
+    counts = {t["name"]: 0 for t in templates}
+    for case in cases:
+        counts[case["name"]] += 1
+    np.testing.assert_allclose(np.array(list(counts.values())) / len(cases), priors / priors.sum(), atol=0.01)
+
+
+def test_generated_cases_have_the_shape_of_a_random_case(templates):
+    single = load_case.generate_random_case(templates, random.Random(0))
+    for case in load_case.generate_cases(templates, 100, rng=2):
+        assert case.keys() == single.keys()
+        template = next(t for t in templates if t["name"] == case["name"])
+        assert case["symptoms"].keys() == template["symptoms"].keys()
+        assert case["vitals"].keys() == template["vitals"].keys()
+        assert all(isinstance(v, int) for v in case["vitals"].values())
+        assert case["demographics"]["sex"] in template["demographics"]["sex_distribution"]
+        assert case["probabilities"] == single["probabilities"]
+
+
+def test_same_seed_same_cases(templates):
+    assert load_case.generate_cases(templates, 200, rng=3) == load_case.generate_cases(templates, 200, rng=3)
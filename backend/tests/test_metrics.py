@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+import types
+import metrics
+
+
+def test_instrumented_functions_are_timed_once():
+    registry = metrics.Registry()
+    latency = registry.histogram("engine_seconds", "Engine time.", ("function",))
+    owner = types.SimpleNamespace(double=lambda x: 2 * x)
+    targets = [(owner, "double", "double")]
+
+    metrics.instrument_functions(latency, targets)
+    wrapped = owner.double
+    metrics.instrument_functions(latency, targets)
+    assert owner.double is wrapped
+    assert owner.double(3) == 6
+    assert 'engine_seconds_count{function="double"} 1' in registry.render()
+
+
+def test_importing_app_leaves_engine_functions_alone():
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = (
+        "import app, model, recommend\n"
+        "wrapped = [getattr(getattr(o, a), '__wrapped_by_metrics__', False) for o, a, _ in app.ENGINE_FUNCTIONS]\n"
+        "assert not any(wrapped), wrapped\n"
+        "app.enable_engine_timings()\n"
+        "assert model.compile_model.__wrapped_by_metrics__\n"
+        "assert recommend.recommend_tests.__wrapped_by_metrics__\n"
+    )
+    subprocess.run([sys.executable, "-c", script], cwd=backend, check=True, env=dict(os.environ, SYMPLI_CASE_POOL_HIGH="0"))
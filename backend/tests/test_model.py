@@ -0,0 +1,41 @@
+import random
+import numpy as np
+import pytest
+import bayes
+import load_case
+import model
+from benchmarks import synthetic
+
+
+@pytest.fixture(scope="module", params=["digestive diseases", "other-diseases", "synthetic"])
+def templates(request):
+    if request.param == "synthetic":
+        return synthetic.generate_templates(200, n_findings=5, seed=7)
+    return load_case.load_disease_templates(request.param)
+
+
+@pytest.fixture(scope="module")
+def compiled(templates):
+    return model.compile_model(templates)
+
+
+def test_starting_likelihoods_match_bayes(templates, compiled):
+    rng = random.Random(0)
+    for _ in range(20):
+        case = load_case.generate_random_case(templates, rng)
+        expected = compiled.to_log_array(bayes.comp_starting_likelihoods(templates, case["demographics"], case["symptoms"], case["vitals"]))
+        actual = compiled.log_starting_likelihood_array(case["demographics"], case["symptoms"], case["vitals"])
+        np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-9)
+
+
+def test_test_likelihoods_match_bayes(templates, compiled):
+    rng = random.Random(2)
+    for template in templates[:20]:
+        for test_name, test_data in template["diagnostic_tests"].items():
+            result = load_case.sample_test_result(test_data, rng)
+            expected = compiled.to_log_array(bayes.comp_test_likelihood(templates, test_name, result))
+            np.testing.assert_allclose(compiled.test_log_likelihood_array(test_name, result), expected, rtol=1e-9, atol=1e-9)
+
+            base, rows, values = compiled.test_log_likelihood(test_name, result)
+            if len(values):
+                assert compiled.test_log_likelihood_max(test_name, result) == pytest.approx(values.max())
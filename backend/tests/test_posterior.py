@@ -0,0 +1,82 @@
+import pickle
+import random
+import numpy as np
+import pytest
+import load_case
+import model
+import posterior
+from benchmarks import synthetic
+
+EPSILON = 1e-4
+
+
+@pytest.fixture(scope="module")
+def templates():
+    return synthetic.generate_templates(300, n_findings=5, seed=11)
+
+
+@pytest.fixture(scope="module")
+def compiled(templates):
+    return model.compile_model(templates)
+
+
+def sessions(templates, compiled, count=10, tests=8, seed=0):
+    """
+    Yields (plain, parking) posteriors after the same random case and test
+    orders, one pair after every update.
+    """
+    rng = random.Random(seed)
+    for _ in range(count):
+        case = load_case.generate_random_case(templates, rng)
+        plain, parking = posterior.from_model(compiled), posterior.from_model(compiled, EPSILON)
+        start = compiled.log_starting_likelihood_array(case["demographics"], case["symptoms"], case["vitals"])
+        plain.add(start)
+        parking.add(start)
+        yield plain, parking
+        template = compiled.template_for(case["name"])
+        names = sorted(template["diagnostic_tests"])
+        for test_name in rng.sample(names, min(tests, len(names))):
+            result = load_case.sample_test_result(template["diagnostic_tests"][test_name], rng)
+            sparse = compiled.test_log_likelihood(test_name, result)
+            plain.add_sparse(*sparse)
+            parking.add_sparse(*sparse, compiled.test_log_likelihood_max(test_name, result))
+            yield plain, parking
+
+
+def test_parked_diseases_stay_below_epsilon(templates, compiled):
+    parked_any = False
+    for plain, parking in sessions(templates, compiled):
+        exact = plain.probability_array()
+        if parking.active is not None:
+            parked = np.setdiff1d(np.arange(len(exact)), parking.active)
+            parked_any = parked_any or len(parked) > 0
+            assert (exact[parked] < EPSILON).all()
+    assert parked_any
+
+
+def test_parked_mass_bound_holds(templates, compiled):
+    for plain, parking in sessions(templates, compiled):
+        approx = parking.probability_array()
+        exact = plain.probability_array()
+        parked_mass = exact[approx == 0].sum()
+        assert parked_mass <= parking.parked_mass_bound() + 1e-12
+        # Active diseases are the exact posterior renormalised over the active set
+        np.testing.assert_allclose(approx, np.where(approx > 0, exact / (1 - parked_mass), 0), rtol=1e-6, atol=1e-12)
+
+
+def test_without_epsilon_nothing_is_parked(templates, compiled):
+    for plain, _ in sessions(templates, compiled, count=3):
+        assert plain.active is None
+        assert plain.parked_mass_bound() == 0.0
+
+
+def test_pickled_posterior_continues_the_same(templates, compiled):
+    rng = random.Random(5)
+    for plain, parking in sessions(templates, compiled, count=3, seed=3):
+        restored = pickle.loads(pickle.dumps(parking))
+        template = compiled.templates[rng.randrange(len(compiled.templates))]
+        test_name = sorted(template["diagnostic_tests"])[0]
+        result = load_case.sample_test_result(template["diagnostic_tests"][test_name], rng)
+        for post in (parking, restored):
+            post.add_sparse(*compiled.test_log_likelihood(test_name, result), compiled.test_log_likelihood_max(test_name, result))
+        np.testing.assert_array_equal(restored.probability_array(), parking.probability_array())
@@ -0,0 +1,85 @@
+import random
+import numpy as np
+import pytest
+import load_case
+import model
+import recommend
+from benchmarks import synthetic
+
+
+@pytest.fixture(scope="module", params=["digestive diseases", "other-diseases", "synthetic"])
+def compiled(request):
+    if request.param == "synthetic":
+        templates = synthetic.generate_templates(50, n_findings=5, seed=3)
+    else:
+        templates = load_case.load_disease_templates(request.param)
+    return model.compile_model(templates)
+
+
+def posteriors(compiled, count=20, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(compiled.names)
+    yield compiled.priors / compiled.priors.sum()
+    yield np.full(n, 1.0 / n)
+    for _ in range(count):
+        probs = rng.dirichlet(np.full(n, 0.3))
+        # Some diseases already ruled out
+        probs[rng.random(n) < 0.2] = 0.0
+        if probs.sum() > 0:
+            yield probs / probs.sum()
+
+
+def test_information_gain_is_not_negative(compiled):
+    for probs in posteriors(compiled):
+        for test_name in compiled.tests:
+            gain = recommend.expected_information_gain(compiled, probs, test_name)
+            assert gain >= -1e-9, (test_name, gain)
+
+
+def test_information_gain_of_certain_posterior_is_zero(compiled):
+    probs = np.zeros(len(compiled.names))
+    probs[0] = 1.0
+    for test_name in compiled.tests:
+        assert recommend.expected_information_gain(compiled, probs, test_name) == pytest.approx(0.0, abs=1e-9)
+
+
+def test_information_gain_at_most_entropy(compiled):
+    for probs in posteriors(compiled, count=5):
+        for test_name in compiled.tests:
+            assert recommend.expected_information_gain(compiled, probs, test_name) <= recommend.entropy(probs) + 1e-9
+
+
+def test_sampled_outcomes_estimate_enumerated_gain():
+    templates = synthetic.generate_templates(30, n_finding_tests=1, n_findings=6, seed=5)
+    compiled = model.compile_model(templates)
+    test_name = next(t for t, test in compiled.tests.items() if not test["binary"])
+    probs = np.random.default_rng(1).dirichlet(np.ones(30))
+    exact = recommend.expected_information_gain(compiled, probs, test_name, budget=64)
+    sampled = recommend.expected_information_gain(compiled, probs, test_name, budget=32, rng=np.random.default_rng(2))
+    assert sampled == pytest.approx(exact, abs=0.1)
+
+
+def test_recommend_ranks_unordered_tests(compiled):
+    random.seed(0)
+    probs = compiled.priors / compiled.priors.sum()
+    ordered = list(compiled.tests)[:1]
+    ranked = recommend.recommend_tests(compiled, probs, ordered)
+    assert [r["test"] for r in ranked if r["test"] in ordered] == []
+    gains = [r["expected_information_gain"] for r in ranked]
+    assert gains == sorted(gains, reverse=True)
+
+
+@pytest.mark.parametrize("budget", [64, 32])
+def test_chunked_outcomes_give_the_same_gain(monkeypatch, budget):
+    templates = synthetic.generate_templates(30, n_finding_tests=1, n_findings=6, seed=5)
+    compiled = model.compile_model(templates)
+    test_name = next(t for t, test in compiled.tests.items() if not test["binary"])
+    probs = np.random.default_rng(1).dirichlet(np.ones(30))
+    whole = recommend.expected_information_gain(compiled, probs, test_name, budget, np.random.default_rng(2))
+
+    # A few outcomes per chunk, and no cached table to fall back on
+    monkeypatch.setattr(recommend, "MAX_CHUNK_CELLS", 100)
+    monkeypatch.setattr(recommend, "MAX_CACHED_OUTCOME_BYTES", 0)
+    compiled = model.compile_model(templates)
+    chunked = recommend.expected_information_gain(compiled, probs, test_name, budget, np.random.default_rng(2))
+    assert chunked == pytest.approx(whole, rel=1e-9)
@@ -0,0 +1,133 @@
+import json
+import os
+import time
+import pytest
+import reloader
+from benchmarks import synthetic
+
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = os.path.join(tmp_path, "templates")
+    synthetic.write_templates(synthetic.generate_templates(20, seed=3), folder)
+    return folder
+
+
+def change_prior(folder, index, prior):
+    path = os.path.join(folder, f"disease_{index:05d}.json")
+    with open(path) as f:
+        template = json.load(f)
+    template["prior"] = prior
+    with open(path, "w") as f:
+        json.dump(template, f)
+    # Make sure the change shows on filesystems with coarse mtimes
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_changed_template_is_swapped_in(folder):
+    kb = reloader.TemplateReloader(folder, snapshot_path=False)
+    old = kb.current
+    assert not kb.check()
+
+    change_prior(folder, 4, 0.5)
+    assert kb.check()
+    assert kb.current is not old and kb.current.version != old.version
+    assert kb.current.model.template_for("Synthetic Disease 00004")["prior"] == 0.5
+    # Sessions that started on the old version still find it
+    assert kb.get(old.version) is old
+    assert old.model.template_for("Synthetic Disease 00004")["prior"] != 0.5
+
+
+def test_broken_template_keeps_current_version(folder):
+    kb = reloader.TemplateReloader(folder, snapshot_path=False)
+    old = kb.current
+    with open(os.path.join(folder, "disease_00002.json"), "w") as f:
+        f.write("{ half written")
+    assert not kb.check()
+    assert kb.current is old
+
+
+def test_only_retained_versions_are_kept(folder):
+    kb = reloader.TemplateReloader(folder, retain=2, snapshot_path=False)
+    first = kb.current
+    for prior in (0.2, 0.3):
+        change_prior(folder, 0, prior)
+        assert kb.check()
+    assert kb.get(first.version) is None
+    assert len(kb.versions) == 2
+
+
+def test_background_checker_picks_up_changes(folder):
+    cache = reloader.KnowledgeBaseCache({"kb": folder}, "kb", check_interval=0.05)
+    old = cache.get().current
+    cache.start()
+    assert cache.started
+
+    change_prior(folder, 1, 0.7)
+    deadline = time.monotonic() + 10
+    while cache.get().current is old and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert cache.get().current is not old
+
+
+def test_least_recently_used_knowledge_base_is_dropped(tmp_path):
+    folders = {}
+    for i, name in enumerate("abc"):
+        folders[name] = os.path.join(tmp_path, name)
+        synthetic.write_templates(synthetic.generate_templates(5, seed=i), folders[name])
+    cache = reloader.KnowledgeBaseCache(folders, "a", max_resident=2)
+
+    a = cache.get("a")
+    assert cache.get() is a
+    cache.get("b")
+    cache.get("a")
+    cache.get("c")
+    assert sorted(cache.resident()) == ["a", "c"]
+    assert cache.loads == 3 and cache.evictions == 1
+
+    # A dropped knowledge base is loaded again, with the same version string
+    version = cache.get("b").current.version
+    assert cache.loads == 4 and sorted(cache.resident()) == ["b", "c"]
+    assert version == reloader.TemplateReloader(folders["b"], snapshot_path=False).current.version
+
+    with pytest.raises(KeyError):
+        cache.get("missing")
+
+
+def test_default_knowledge_base_must_be_configured(folder):
+    with pytest.raises(ValueError):
+        reloader.KnowledgeBaseCache({"kb": folder}, "other")
+
+
+def test_shared_segments_are_published_and_attached(folder, tmp_path, monkeypatch):
+    monkeypatch.setenv("SYMPLI_SHARED_MODEL_DIR", str(tmp_path))
+    publisher = reloader.TemplateReloader(folder, shared_memory="test")
+    segment = publisher.current.segment
+    assert segment and os.path.exists(segment)
+
+    attached = reloader.TemplateReloader(folder, shared_memory="test")
+    assert attached.current.segment == segment
+    assert attached.current.version == publisher.current.version
+    assert attached.current.model.names == publisher.current.model.names
+
+    # Only the reloader that published a segment removes it
+    attached.close()
+    assert os.path.exists(segment)
+    publisher.close()
+    assert not os.path.exists(segment)
+
+
+def test_dropped_knowledge_base_removes_its_segments(tmp_path, monkeypatch):
+    monkeypatch.setenv("SYMPLI_SHARED_MODEL_DIR", str(tmp_path))
+    folders = {}
+    for i, name in enumerate("ab"):
+        folders[name] = os.path.join(tmp_path, name)
+        synthetic.write_templates(synthetic.generate_templates(5, seed=i), folders[name])
+    cache = reloader.KnowledgeBaseCache(folders, "a", max_resident=1, shared_memory="test")
+
+    segment = cache.get("a").current.segment
+    assert os.path.exists(segment)
+    cache.get("b")
+    assert not os.path.exists(segment)
+    assert os.path.exists(cache.get("b").current.segment)
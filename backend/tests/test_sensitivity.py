@@ -0,0 +1,66 @@
+import random
+import numpy as np
+import pytest
+import load_case
+import model
+import sensitivity
+from benchmarks import synthetic
+
+
+@pytest.fixture(scope="module")
+def templates():
+    return synthetic.generate_templates(25, n_findings=3, seed=4)
+
+
+@pytest.fixture(scope="module")
+def compiled(templates):
+    return model.compile_model(templates)
+
+
+@pytest.fixture(scope="module")
+def case(templates, compiled):
+    case = load_case.generate_random_case(templates, random.Random(2))
+    test_data = compiled.template_for(case["name"])["diagnostic_tests"]
+    rng = random.Random(3)
+    for test_name in sorted(test_data)[:3]:
+        case["tests"][test_name] = load_case.sample_test_result(test_data[test_name], rng)
+    return case
+
+
+def test_perturbed_parameters_reproduce_the_published_posterior(compiled, case):
+    point = sensitivity.log_posterior(compiled, case)
+    rows, values, complement = sensitivity.case_parameters(compiled, case)
+    assert len(rows) == len(values) == len(complement) > 0
+    # "Perturbing" every parameter to its published value changes nothing
+    unchanged = sensitivity.perturbed_log_posteriors(point, rows, values, complement, np.tile(values, (3, 1)))
+    np.testing.assert_allclose(unchanged, np.tile(point, (3, 1)), rtol=1e-12, atol=1e-9)
+
+
+def test_report_follows_the_published_posterior(compiled, case):
+    analysis = sensitivity.analyse(compiled, case, samples=200, top=5, seed=1)
+    diseases = analysis["diseases"]
+    assert len(diseases) == 5 and analysis["samples"] == 200
+    probabilities = [d["probability"] for d in diseases]
+    assert probabilities == sorted(probabilities, reverse=True)
+    for d in diseases:
+        assert 0 <= d["lower"] <= d["mean"] <= d["upper"] <= 1
+
+    everything = sensitivity.analyse(compiled, case, samples=200, seed=1)
+    assert len(everything["diseases"]) == len(compiled.names)
+    assert sum(d["top_frequency"] for d in everything["diseases"]) == pytest.approx(1.0)
+    assert sum(d["probability"] for d in everything["diseases"]) == pytest.approx(1.0)
+
+
+def test_intervals_narrow_with_concentration(compiled, case):
+    loose = sensitivity.analyse(compiled, case, samples=300, concentration=5, top=3, seed=2)
+    tight = sensitivity.analyse(compiled, case, samples=300, concentration=1e6, top=3, seed=2)
+    for wide, narrow in zip(loose["diseases"], tight["diseases"]):
+        assert narrow["upper"] - narrow["lower"] <= wide["upper"] - wide["lower"] + 1e-9
+        assert narrow["mean"] == pytest.approx(narrow["probability"], abs=1e-3)
+
+
+def test_same_seed_same_analysis(compiled, case, monkeypatch):
+    first = sensitivity.analyse(compiled, case, samples=100, top=4, seed=7)
+    # Chunking the samples does not change the draws' results
+    monkeypatch.setattr(sensitivity, "CHUNK_ELEMENTS", 1)
+    assert sensitivity.analyse(compiled, case, samples=100, top=4, seed=7)["diseases"] == first["diseases"]
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+import pytest
+import sessions
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, tmp_path):
+    def make(**limits):
+        if request.param == "memory":
+            return sessions.MemorySessionStore(**limits)
+        return sessions.SQLiteSessionStore(os.path.join(tmp_path, "sessions.db"), sweep_interval=0, **limits)
+    return make
+
+
+def test_store_round_trip(make_store):
+    store = make_store()
+    store["a"] = {"case": 1}
+    assert store.get("a") == {"case": 1}
+    assert "a" in store and len(store) == 1
+    assert store.pop("a") == {"case": 1}
+    assert store.get("a") is None
+    with pytest.raises(KeyError):
+        store["a"]
+    assert store.stats() == {"entries": 0, "hits": 2, "misses": 2, "evictions": 0}
+
+
+def test_least_recently_used_is_evicted(make_store):
+    store = make_store(max_entries=2)
+    evicted = []
+    store.on_evict = evicted.extend
+    store["a"] = 1
+    time.sleep(0.01)
+    store["b"] = 2
+    time.sleep(0.01)
+    store.get("a")
+    time.sleep(0.01)
+    store["c"] = 3
+    assert evicted == ["b"]
+    assert store.get("b") is None
+    assert store.get("a") == 1 and store.get("c") == 3
+    assert store.evictions == 1
+
+
+def test_idle_sessions_expire(make_store):
+    store = make_store(ttl=0.05)
+    evicted = []
+    store.on_evict = evicted.extend
+    store["a"] = 1
+    time.sleep(0.1)
+    assert store.get("a") is None
+    assert evicted == ["a"]
+    assert len(store) == 0
+
+
+def test_pop_is_not_an_eviction(make_store):
+    store = make_store(max_entries=2)
+    evicted = []
+    store.on_evict = evicted.extend
+    store["a"] = 1
+    store.pop("a")
+    assert evicted == [] and store.evictions == 0
+
+
+def test_create_store(tmp_path, monkeypatch):
+    monkeypatch.delenv("SYMPLI_SESSION_MAX", raising=False)
+    monkeypatch.delenv("SYMPLI_SESSION_TTL", raising=False)
+    store = sessions.create_store("memory")
+    assert store.max_entries == sessions.DEFAULT_MAX_ENTRIES and store.ttl == sessions.DEFAULT_TTL
+
+    # 0 means unbounded
+    store = sessions.create_store("memory", max_entries=0, ttl=0)
+    assert store.max_entries is None and store.ttl is None
+
+    store = sessions.create_store("sqlite:" + os.path.join(tmp_path, "s.db"), max_entries=5)
+    assert isinstance(store, sessions.SQLiteSessionStore) and store.max_entries == 5
+
+    with pytest.raises(ValueError):
+        sessions.create_store("redis://localhost")
+
+
+def test_session_store_is_abstract():
+    with pytest.raises(TypeError):
+        sessions.SessionStore()
+
+
+def test_session_locks_serialise_one_session():
+    locks = sessions.SessionLocks()
+    inside, overlaps = [], []
+
+    def work(session_id):
+        with locks.hold(session_id):
+            if session_id in inside:
+                overlaps.append(session_id)
+            inside.append(session_id)
+            time.sleep(0.01)
+            inside.remove(session_id)
+
+    threads = [threading.Thread(target=work, args=(s,)) for s in ["a"] * 5 + ["b"] * 5]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert overlaps == []
+    assert len(locks) == 0
@@ -0,0 +1,18 @@
+import pytest
+import simulate
+
+
+@pytest.mark.parametrize("chunk_size", [0, -5])
+def test_chunk_size_must_be_positive(chunk_size):
+    with pytest.raises(ValueError):
+        simulate.run(n_cases=10, workers=1, chunk_size=chunk_size)
+
+
+def test_results_do_not_depend_on_workers():
+    single = simulate.run(n_cases=60, policy="random:2", workers=1, seed=4, chunk_size=16)
+    pooled = simulate.run(n_cases=60, policy="random:2", workers=2, seed=4, chunk_size=16)
+    # Chunks merge in finishing order, so float sums may differ in the last bits
+    assert single["confusion"] == pooled["confusion"]
+    assert single["brier"] == pytest.approx(pooled["brier"])
+    assert single["cases"] == 60
+    assert sum(d["cases"] for d in single["per_disease"].values()) == 60
@@ -0,0 +1,97 @@
+import json
+import os
+import random
+import numpy as np
+import pytest
+import load_case
+import model
+import reloader
+import snapshot
+from benchmarks import synthetic
+
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = os.path.join(tmp_path, "templates")
+    synthetic.write_templates(synthetic.generate_templates(30, n_findings=3, seed=5), folder)
+    return folder
+
+
+def touch(folder, index):
+    path = os.path.join(folder, f"disease_{index:05d}.json")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_snapshot_round_trip(folder):
+    snapshot.build_snapshot(folder)
+    header, loaded = snapshot.load_fresh_snapshot(folder)
+    assert "templates" not in header and loaded.templates is None
+
+    templates = load_case.load_disease_templates(folder)
+    compiled = model.compile_model(templates)
+    assert loaded.names == compiled.names
+    rng = random.Random(1)
+    for _ in range(10):
+        case = load_case.generate_random_case(templates, rng)
+        np.testing.assert_array_equal(loaded.log_starting_likelihood_array(case["demographics"], case["symptoms"], case["vitals"]),
+                                      compiled.log_starting_likelihood_array(case["demographics"], case["symptoms"], case["vitals"]))
+        for test_name, test_data in case_tests(templates, case["name"]).items():
+            result = load_case.sample_test_result(test_data, rng)
+            np.testing.assert_array_equal(loaded.test_log_likelihood_array(test_name, result), compiled.test_log_likelihood_array(test_name, result))
+
+    # The per-disease test entries the order routes need are rebuilt from the arrays
+    for template in templates:
+        assert loaded.diagnostic_tests(template["name"]) == template["diagnostic_tests"]
+    assert loaded.diagnostic_tests("No Such Disease") is None
+
+
+def case_tests(templates, name):
+    return next(t["diagnostic_tests"] for t in templates if t["name"] == name)
+
+
+def test_changed_files_make_the_snapshot_stale(folder):
+    snapshot.build_snapshot(folder)
+    assert snapshot.load_fresh_snapshot(folder) is not None
+    touch(folder, 3)
+    assert snapshot.load_fresh_snapshot(folder) is None
+
+
+def test_unreadable_snapshot_is_ignored(folder):
+    with open(snapshot.default_path(folder), "wb") as f:
+        f.write(b"not a snapshot")
+    assert snapshot.load_fresh_snapshot(folder) is None
+
+
+def test_invalid_templates_are_reported(folder):
+    path = os.path.join(folder, "disease_00000.json")
+    with open(path) as f:
+        template = json.load(f)
+    template["prior"] = -1
+    with open(path, "w") as f:
+        json.dump(template, f)
+    with pytest.raises(snapshot.SnapshotError, match="prior"):
+        snapshot.build_snapshot(folder)
+
+
+def test_reloader_reads_templates_only_when_needed(folder):
+    snapshot.build_snapshot(folder)
+    kb = reloader.TemplateReloader(folder)
+    version = kb.current
+    assert version._templates is None
+    assert [t["name"] for t in version.templates] == version.model.names
+    assert len(version.sampler.probabilities) == len(version.model.names)
+
+
+def test_stale_snapshot_version_is_replaced_for_new_cases(folder):
+    snapshot.build_snapshot(folder)
+    kb = reloader.TemplateReloader(folder)
+    old = kb.current
+    touch(folder, 0)
+    with pytest.raises(reloader.StaleVersionError):
+        old.templates
+
+    version = kb.current_for_cases()
+    assert version is not old and version.templates
+    # Tests whose entries did not change are carried over from the snapshot model
+    assert all(version.model.tests[t] is old.model.tests[t] for t in old.model.tests)
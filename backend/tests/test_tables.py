@@ -0,0 +1,54 @@
+import random
+import numpy as np
+import pytest
+import bayes
+import load_case
+import model
+from benchmarks import synthetic
+
+
+@pytest.fixture(scope="module", params=["digestive diseases", "synthetic"])
+def templates(request):
+    if request.param == "synthetic":
+        return synthetic.generate_templates(200, seed=7)
+    return load_case.load_disease_templates(request.param)
+
+
+@pytest.fixture(scope="module")
+def compiled(templates):
+    return model.compile_model(templates)
+
+
+def test_tables_hold_the_log_densities(compiled):
+    ages = np.arange(model.AGE_RANGE[0], model.AGE_RANGE[1] + 1, dtype=float)
+    np.testing.assert_allclose(compiled.age_table, model.log_normal_pdf(ages[:, None], compiled.age_mean, compiled.age_std))
+
+
+def test_untabulated_vitals_match_bayes(templates, compiled, monkeypatch):
+    # Every vital scored analytically rather than looked up
+    monkeypatch.setattr(model.CompiledModel, "MAX_TABLE_BYTES", 0)
+    untabulated = model.compile_model(templates)
+    assert not untabulated.vital_table_width.any()
+    rng = random.Random(1)
+    for _ in range(10):
+        case = load_case.generate_random_case(templates, rng)
+        expected = compiled.to_log_array(bayes.comp_starting_likelihoods(templates, case["demographics"], case["symptoms"], case["vitals"]))
+        actual = untabulated.log_starting_likelihood_array(case["demographics"], case["symptoms"], case["vitals"])
+        np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-9)
+
+
+def test_unchanged_tables_are_shared_with_previous_version(templates, compiled):
+    changed = [dict(t) for t in templates]
+    changed[0] = dict(changed[0], prior=changed[0]["prior"] / 2)
+    recompiled = model.compile_model(changed, compiled)
+    assert recompiled.age_table is compiled.age_table
+    assert recompiled.vital_table is compiled.vital_table
+
+
+def test_changed_vitals_are_tabulated_again(templates, compiled):
+    changed = [dict(t) for t in templates]
+    vital = next(iter(changed[0]["vitals"]))
+    changed[0]["vitals"] = {**changed[0]["vitals"], vital: {**changed[0]["vitals"][vital], "mean": changed[0]["vitals"][vital]["mean"] + 5}}
+    recompiled = model.compile_model(changed, compiled)
+    assert recompiled.vital_table is not compiled.vital_table
+    np.testing.assert_array_equal(recompiled.vital_table, model.compile_model(changed).vital_table)